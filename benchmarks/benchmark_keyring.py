@@ -0,0 +1,25 @@
+"""
+A keyring backend that hands out dummy Spotify API credentials, so benchmark runs
+never touch (or prompt for) the real system keyring. Selected by run_benchmarks.py
+with PYTHON_KEYRING_BACKEND=benchmark_keyring.BenchmarkKeyring.
+"""
+
+from keyring.backend import KeyringBackend
+
+CREDENTIALS = {
+    "client_id": "benchmark-client-id",
+    "client_secret": "benchmark-client-secret",
+}
+
+
+class BenchmarkKeyring(KeyringBackend):
+    priority = 1
+
+    def get_password(self, service: str, username: str) -> str | None:
+        return CREDENTIALS.get(username)
+
+    def set_password(self, service: str, username: str, password: str) -> None:
+        pass
+
+    def delete_password(self, service: str, username: str) -> None:
+        pass
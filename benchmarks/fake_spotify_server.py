@@ -0,0 +1,600 @@
+"""
+A local stand-in for the parts of the Spotify Web API that spotify-snapshot uses,
+serving a synthetic library of whatever size you like, so backups can be run (and
+timed) without touching the real API.
+
+Everything in the library is generated on demand from its index, so even very large
+libraries take no time to set up and very little memory. Requests can be slowed down
+with a fixed latency, and a fraction of them can be answered with a 429.
+
+Run it on its own with:
+
+    python benchmarks/fake_spotify_server.py --liked-songs 100000 --playlists 2000
+
+and point the client at it with SPOTIFY_SNAPSHOT_API_PREFIX=http://127.0.0.1:<port>/v1/
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+BASE62_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+# Roughly the number of markets the real API lists for a track when no market is given
+MARKETS = [f"{a}{b}" for a in "ABCDEFGHIJKLM" for b in "ABCDEFGHIJKLMN"]
+LIBRARY_START_TIME = datetime(2015, 1, 1, tzinfo=timezone.utc)
+
+MAX_PAGE_SIZE = {"tracks": 50, "albums": 50, "playlists": 50, "items": 100}
+
+
+def make_id(kind: str, index: int) -> str:
+    """A stable, 22 character base62 ID, like the ones Spotify uses."""
+    number = int.from_bytes(hashlib.sha1(f"{kind}:{index}".encode()).digest(), "big")
+    chars = []
+    for _ in range(22):
+        number, remainder = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[remainder])
+    return "".join(chars)
+
+
+def format_timestamp(seconds_since_start: int) -> str:
+    timestamp = LIBRARY_START_TIME + timedelta(seconds=seconds_since_start)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_fields(fields: str) -> dict:
+    """
+    Parse a Spotify `fields` filter such as "items(added_at,track(name,id)),next"
+    into a nested dict, where a value of None means the whole field is kept.
+    """
+    root: dict = {}
+    stack = [root]
+    name = ""
+    for char in fields:
+        if char == ",":
+            if name:
+                stack[-1][name.strip()] = None
+            name = ""
+        elif char == "(":
+            child: dict = {}
+            stack[-1][name.strip()] = child
+            stack.append(child)
+            name = ""
+        elif char == ")":
+            if name:
+                stack[-1][name.strip()] = None
+            name = ""
+            stack.pop()
+        else:
+            name += char
+    if name:
+        stack[-1][name.strip()] = None
+    return root
+
+
+def apply_fields(value, fields: dict | None):
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: apply_fields(value[key], sub_fields)
+            for key, sub_fields in fields.items()
+            if key in value
+        }
+    return value
+
+
+@dataclass
+class SyntheticLibrary:
+    liked_songs: int = 2000
+    albums: int = 200
+    playlists: int = 50
+    # Playlists get anywhere between 0 and twice this many tracks
+    mean_tracks_per_playlist: int = 100
+    # Size of the pools that artists and albums are picked from, so that names repeat
+    # across the library like they do in real ones
+    artist_pool: int = 5000
+    album_pool: int = 10000
+    # One in this many playlist items has no track, like tracks that were taken down
+    unavailable_track_every: int = 1000
+    seed: int = 0
+    username: str = "benchmark-user"
+    # Bumped by mutate(), to simulate the library changing between runs
+    new_liked_songs: int = 0
+    playlist_versions: dict[int, int] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    _playlist_indexes: dict[str, int] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._playlist_indexes = {
+            make_id("playlist", index): index for index in range(self.playlists)
+        }
+
+    def _random(self, *key) -> random.Random:
+        return random.Random(f"{self.seed}:{':'.join(map(str, key))}")
+
+    def artist(self, index: int) -> dict:
+        artist_id = make_id("artist", index)
+        return {
+            "external_urls": {
+                "spotify": f"https://open.spotify.com/artist/{artist_id}"
+            },
+            "href": f"https://api.spotify.com/v1/artists/{artist_id}",
+            "id": artist_id,
+            "name": f"Artist {index}",
+            "type": "artist",
+            "uri": f"spotify:artist:{artist_id}",
+        }
+
+    def album(self, index: int, market: str | None) -> dict:
+        rng = self._random("album", index)
+        album_id = make_id("album", index)
+        album = {
+            "album_type": "album",
+            "artists": [self.artist(rng.randrange(self.artist_pool))],
+            "external_urls": {"spotify": f"https://open.spotify.com/album/{album_id}"},
+            "href": f"https://api.spotify.com/v1/albums/{album_id}",
+            "id": album_id,
+            "images": [
+                {"height": size, "width": size, "url": f"https://i.scdn.co/{album_id}"}
+                for size in (640, 300, 64)
+            ],
+            "name": f"Album {index}",
+            "release_date": f"{1960 + index % 65}-01-01",
+            "release_date_precision": "day",
+            "total_tracks": 12,
+            "type": "album",
+            "uri": f"spotify:album:{album_id}",
+        }
+        if market is None:
+            album["available_markets"] = MARKETS
+        return album
+
+    def track(self, index: int, market: str | None) -> dict:
+        rng = self._random("track", index)
+        track_id = make_id("track", index)
+        artist_count = 1 + (rng.random() < 0.3) + (rng.random() < 0.1)
+        track = {
+            "album": self.album(rng.randrange(self.album_pool), market),
+            "artists": [
+                self.artist(rng.randrange(self.artist_pool))
+                for _ in range(artist_count)
+            ],
+            "disc_number": 1,
+            "duration_ms": rng.randrange(90_000, 400_000),
+            "explicit": rng.random() < 0.2,
+            "external_ids": {"isrc": f"US{track_id[:10].upper()}"},
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+            "href": f"https://api.spotify.com/v1/tracks/{track_id}",
+            "id": track_id,
+            "is_local": False,
+            "name": f"Track {index}",
+            "popularity": rng.randrange(100),
+            "preview_url": None,
+            "track_number": rng.randrange(1, 13),
+            "type": "track",
+            "uri": f"spotify:track:{track_id}",
+        }
+        if market is None:
+            track["available_markets"] = MARKETS
+        return track
+
+    @property
+    def liked_songs_total(self) -> int:
+        return self.liked_songs + self.new_liked_songs
+
+    def liked_song_item(self, position: int, market: str | None) -> dict:
+        # Newest first, like the real API. Songs added by mutate() go at the top
+        index = self.liked_songs_total - 1 - position
+        return {
+            "added_at": format_timestamp(index * 3600),
+            "track": self.track(index, market),
+        }
+
+    def saved_album_item(self, position: int, market: str | None) -> dict:
+        index = self.albums - 1 - position
+        album = self.album(index, market)
+        album["tracks"] = {
+            "href": f"{album['href']}/tracks",
+            # Tracks listed on an album don't repeat the album
+            "items": [
+                {
+                    key: value
+                    for key, value in self.track(index * 12 + number, market).items()
+                    if key != "album"
+                }
+                for number in range(12)
+            ],
+            "limit": 50,
+            "next": None,
+            "offset": 0,
+            "previous": None,
+            "total": 12,
+        }
+        return {"added_at": format_timestamp(index * 7200), "album": album}
+
+    def playlist_track_count(self, playlist_index: int) -> int:
+        rng = self._random("playlist-length", playlist_index)
+        base_count = rng.randrange(0, 2 * self.mean_tracks_per_playlist + 1)
+        return base_count + self.playlist_versions.get(playlist_index, 0)
+
+    def playlist(self, playlist_index: int) -> dict:
+        playlist_id = make_id("playlist", playlist_index)
+        version = self.playlist_versions.get(playlist_index, 0)
+        owner_id = self.username if playlist_index % 3 else f"user{playlist_index}"
+        return {
+            "collaborative": playlist_index % 17 == 0,
+            "description": f"Synthetic playlist number {playlist_index}",
+            "external_urls": {
+                "spotify": f"https://open.spotify.com/playlist/{playlist_id}"
+            },
+            "href": f"https://api.spotify.com/v1/playlists/{playlist_id}",
+            "id": playlist_id,
+            "images": [],
+            "name": f"Playlist {playlist_index}",
+            "owner": {
+                "display_name": owner_id,
+                "external_urls": {},
+                "href": f"https://api.spotify.com/v1/users/{owner_id}",
+                "id": owner_id,
+                "type": "user",
+                "uri": f"spotify:user:{owner_id}",
+            },
+            "primary_color": None,
+            "public": playlist_index % 2 == 0,
+            "snapshot_id": make_id("snapshot", playlist_index * 1_000_003 + version),
+            "tracks": {
+                "href": f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks",
+                "total": self.playlist_track_count(playlist_index),
+            },
+            "type": "playlist",
+            "uri": f"spotify:playlist:{playlist_id}",
+        }
+
+    def playlist_item(
+        self, playlist_index: int, position: int, market: str | None
+    ) -> dict:
+        rng = self._random("playlist-item", playlist_index, position)
+        catalogue_size = max(self.liked_songs_total, 50_000)
+        is_unavailable = (
+            self.unavailable_track_every
+            and rng.randrange(self.unavailable_track_every) == 0
+        )
+        added_by = self.username if playlist_index % 3 else f"user{position % 7}"
+        return {
+            "added_at": format_timestamp(playlist_index * 86400 + position * 60),
+            "added_by": {
+                "external_urls": {},
+                "href": f"https://api.spotify.com/v1/users/{added_by}",
+                "id": added_by,
+                "type": "user",
+                "uri": f"spotify:user:{added_by}",
+            },
+            "is_local": False,
+            "primary_color": None,
+            "track": (
+                None
+                if is_unavailable
+                else self.track(rng.randrange(catalogue_size), market)
+            ),
+        }
+
+    def get_playlist_index(self, playlist_id: str) -> int | None:
+        return self._playlist_indexes.get(playlist_id)
+
+    def mutate(self, new_liked_songs: int, changed_playlists: int) -> None:
+        """Like some songs and add a track to some playlists."""
+        with self._lock:
+            self.new_liked_songs += new_liked_songs
+            rng = self._random(
+                "mutate", self.new_liked_songs, len(self.playlist_versions)
+            )
+            for playlist_index in rng.sample(
+                range(self.playlists), min(changed_playlists, self.playlists)
+            ):
+                self.playlist_versions[playlist_index] = (
+                    self.playlist_versions.get(playlist_index, 0) + 1
+                )
+
+
+@dataclass
+class ServerOptions:
+    # Added to every API response
+    latency_ms: float = 0.0
+    # Fraction of API requests that get a 429 response instead
+    rate_limit_probability: float = 0.0
+    retry_after_sec: int = 1
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        library: SyntheticLibrary,
+        options: ServerOptions,
+        address: tuple[str, int] = ("127.0.0.1", 0),
+    ):
+        super().__init__(address, FakeSpotifyRequestHandler)
+        self.library = library
+        self.options = options
+        self.stats: Counter[str] = Counter()
+        self.stats_lock = threading.Lock()
+        self.rng = random.Random(library.seed)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_prefix(self) -> str:
+        return f"{self.base_url}/v1/"
+
+    def count(self, stat: str, amount: int = 1) -> None:
+        with self.stats_lock:
+            self.stats[stat] += amount
+
+    def should_rate_limit(self) -> bool:
+        if self.options.rate_limit_probability <= 0:
+            return False
+        with self.stats_lock:
+            return self.rng.random() < self.options.rate_limit_probability
+
+    def start_in_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class FakeSpotifyRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeSpotifyServer
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body: dict, headers: dict | None = None) -> None:
+        data = json.dumps(body, separators=(",", ":")).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count("bytes_sent", len(data))
+
+    def send_api_response(self, body: dict) -> None:
+        """Send a 200, or a 304 if the client already has this exact response."""
+        etag = (
+            f'"{hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()}"'
+        )
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_json(200, body, {"ETag": etag})
+
+    def send_error_json(self, status: int, message: str, headers=None) -> None:
+        self.send_json(
+            status, {"error": {"status": status, "message": message}}, headers
+        )
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/__mutate":
+            self.server.library.mutate(
+                new_liked_songs=int(query.get("liked_songs", 0)),
+                changed_playlists=int(query.get("playlists", 0)),
+            )
+            self.send_json(200, {"ok": True})
+        elif url.path == "/__stats/reset":
+            with self.server.stats_lock:
+                self.server.stats.clear()
+            self.send_json(200, {"ok": True})
+        else:
+            self.send_error_json(404, "Not found")
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/__stats":
+            with self.server.stats_lock:
+                stats = dict(self.server.stats)
+            self.send_json(200, stats)
+            return
+
+        self.server.count("requests")
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self.server.count("unauthorized")
+            self.send_error_json(401, "No token provided")
+            return
+        if self.server.options.latency_ms > 0:
+            time.sleep(self.server.options.latency_ms / 1000)
+        if self.server.should_rate_limit():
+            self.server.count("rate_limited")
+            self.send_error_json(
+                429,
+                "API rate limit exceeded",
+                {"Retry-After": str(self.server.options.retry_after_sec)},
+            )
+            return
+
+        path = url.path.removeprefix("/v1/").strip("/")
+        parts = path.split("/")
+        library = self.server.library
+        market = query.get("market")
+
+        if path == "me":
+            self.server.count("me")
+            self.send_api_response(
+                {
+                    "display_name": library.username,
+                    "external_urls": {},
+                    "href": f"https://api.spotify.com/v1/users/{library.username}",
+                    "id": library.username,
+                    "type": "user",
+                    "uri": f"spotify:user:{library.username}",
+                }
+            )
+        elif path == "me/tracks":
+            self.server.count("saved_tracks")
+            self.send_page(
+                path,
+                query,
+                library.liked_songs_total,
+                "tracks",
+                lambda position: library.liked_song_item(position, market),
+            )
+        elif path == "me/albums":
+            self.server.count("saved_albums")
+            self.send_page(
+                path,
+                query,
+                library.albums,
+                "albums",
+                lambda position: library.saved_album_item(position, market),
+            )
+        elif path == "me/playlists":
+            self.server.count("playlists")
+            self.send_page(
+                path, query, library.playlists, "playlists", library.playlist
+            )
+        elif (
+            len(parts) == 3
+            and parts[0] == "playlists"
+            and parts[2]
+            in (
+                "items",
+                "tracks",
+            )
+        ):
+            playlist_index = library.get_playlist_index(parts[1])
+            if playlist_index is None:
+                self.send_error_json(404, "Resource not found")
+                return
+            self.server.count("playlist_items")
+            self.send_page(
+                path,
+                query,
+                library.playlist_track_count(playlist_index),
+                "items",
+                lambda position: library.playlist_item(
+                    playlist_index, position, market
+                ),
+                fields=query.get("fields"),
+            )
+        else:
+            self.send_error_json(404, "Service not found")
+
+    def send_page(
+        self,
+        path: str,
+        query: dict[str, str],
+        total: int,
+        kind: str,
+        get_item,
+        fields: str | None = None,
+    ) -> None:
+        try:
+            limit = int(query.get("limit", 20))
+            offset = int(query.get("offset", 0))
+        except ValueError:
+            self.send_error_json(400, "Invalid limit or offset")
+            return
+        if not 1 <= limit <= MAX_PAGE_SIZE[kind] or offset < 0:
+            self.send_error_json(400, "Invalid limit or offset")
+            return
+
+        def page_url(page_offset: int) -> str:
+            page_query = {**query, "offset": page_offset, "limit": limit}
+            return f"{self.server.api_prefix}{path}?{urlencode(page_query)}"
+
+        page = {
+            "href": page_url(offset),
+            "items": [
+                get_item(position)
+                for position in range(offset, min(offset + limit, total))
+            ],
+            "limit": limit,
+            "next": page_url(offset + limit) if offset + limit < total else None,
+            "offset": offset,
+            "previous": page_url(max(0, offset - limit)) if offset > 0 else None,
+            "total": total,
+        }
+        if fields:
+            page = apply_fields(page, parse_fields(fields))
+        self.send_api_response(page)
+
+
+def add_library_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = SyntheticLibrary()
+    parser.add_argument("--liked-songs", type=int, default=defaults.liked_songs)
+    parser.add_argument("--albums", type=int, default=defaults.albums)
+    parser.add_argument("--playlists", type=int, default=defaults.playlists)
+    parser.add_argument(
+        "--tracks-per-playlist",
+        type=int,
+        default=defaults.mean_tracks_per_playlist,
+        help="Mean number of tracks per playlist",
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--rate-limit-probability",
+        type=float,
+        default=0.0,
+        help="Fraction of requests to answer with a 429",
+    )
+    parser.add_argument("--retry-after", type=int, default=1)
+
+
+def create_server_from_args(
+    args: argparse.Namespace, port: int = 0
+) -> FakeSpotifyServer:
+    library = SyntheticLibrary(
+        liked_songs=args.liked_songs,
+        albums=args.albums,
+        playlists=args.playlists,
+        mean_tracks_per_playlist=args.tracks_per_playlist,
+        seed=args.seed,
+    )
+    options = ServerOptions(
+        latency_ms=args.latency_ms,
+        rate_limit_probability=args.rate_limit_probability,
+        retry_after_sec=args.retry_after,
+    )
+    return FakeSpotifyServer(library, options, ("127.0.0.1", port))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_library_arguments(parser)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = create_server_from_args(args, args.port)
+    print(f"Serving a fake Spotify API at {server.api_prefix}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
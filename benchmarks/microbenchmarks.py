@@ -0,0 +1,559 @@
+"""
+Microbenchmarks for the hot paths of writing a backup: turning records into TSV rows,
+writing TSV files, pretty printing them, and working out what changed for the commit
+message. Fixtures are generated at several sizes, and timings are compared against a
+baseline recorded earlier so that regressions are caught before they ship.
+
+Usage:
+
+    python benchmarks/microbenchmarks.py --save-baseline   # Record the baseline
+    python benchmarks/microbenchmarks.py                   # Compare to it
+    python benchmarks/microbenchmarks.py --filter commit_message --max-rows 1000
+    python benchmarks/microbenchmarks.py --large           # Add the 100k row fixtures
+
+Timings depend on the machine, so the baseline is only kept locally (it's ignored by
+git): record it before a change and compare after it, on the same machine.
+--save-baseline only replaces the timings of the benchmarks that were run.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARKS_DIR.parent
+# Benchmark the code in this checkout, not whatever version is installed
+sys.path.insert(0, str(REPO_ROOT))
+
+import git  # noqa: E402
+from loguru import logger  # noqa: E402
+from rich.console import Console  # noqa: E402
+from rich.markup import escape  # noqa: E402
+from rich.table import Table  # noqa: E402
+
+from spotify_snapshot import (  # noqa: E402
+    git_plumbing,
+    gitutils,
+    outputfileutils,
+    spotify,
+)
+from spotify_snapshot.content_hashes import content_hashes  # noqa: E402
+from spotify_snapshot.playlist_manifest import (  # noqa: E402
+    PlaylistManifest,
+    PlaylistManifestEntry,
+)
+from spotify_snapshot.spotify_datatypes import PlaylistRecord, TrackRecord  # noqa: E402
+from spotify_snapshot.spotify_snapshot_output_manager import (  # noqa: E402
+    SpotifySnapshotOutputManager,
+)
+
+DEFAULT_BASELINE_PATH = BENCHMARKS_DIR / "microbenchmarks_baseline.json"
+ROW_COUNTS = (1_000, 10_000)
+# Too slow to run every time, so only with --large
+LARGE_ROW_COUNTS = (100_000,)
+PLAYLIST_COUNTS = (10, 100, 1_000)
+# Fraction of playlists that are changed / deleted / renamed between commits
+CHANGED_FRACTION = 0.2
+DELETED_FRACTION = 0.05
+RENAMED_FRACTION = 0.05
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Returns the function to time, and a function that cleans up after it
+    setup: Callable[[Path], tuple[Callable[[], object], Callable[[], None]]]
+
+
+#####
+# Fixtures
+#####
+
+
+def make_tracks(count: int, with_added_by: bool = False) -> list[TrackRecord]:
+    rng = random.Random(count)
+    artists = [f"Artist {i}" for i in range(max(10, count // 20))]
+    albums = [f"Album {i}" for i in range(max(10, count // 10))]
+    return [
+        TrackRecord(
+            name=f"Track {i} ({rng.choice(['Live', 'Remastered', 'Demo', ''])})",
+            artists=tuple(rng.sample(artists, rng.choice((1, 1, 1, 2, 3)))),
+            album_name=rng.choice(albums),
+            added_at=f"20{10 + i % 15:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}T12:00:00Z",
+            id=f"{i:022d}",
+            added_by=f"user{i % 7}" if with_added_by else None,
+        )
+        for i in range(count)
+    ]
+
+
+def initialize_output_manager(
+    base_dir: Path, playlists_layout: str = "flat"
+) -> SpotifySnapshotOutputManager:
+    # The output manager is a singleton, but every fixture needs its own directory
+    SpotifySnapshotOutputManager._instance = None
+    return SpotifySnapshotOutputManager.initialize(base_dir, playlists_layout)
+
+
+def make_playlists(count: int, version: int = 0) -> dict[str, PlaylistRecord]:
+    return {
+        f"{i:022d}": PlaylistRecord(
+            name=f"Playlist {i}" + (f" v{version}" if i % 20 == 0 else ""),
+            description=f"Description of playlist {i}",
+            track_count=50,
+            owner_id="owner",
+            collaborative=False,
+            id=f"{i:022d}",
+            snapshot_id=f"snapshot-{i}-{version}",
+        )
+        for i in range(count)
+    }
+
+
+def write_snapshot(
+    playlists: dict[str, PlaylistRecord],
+    tracks_per_playlist: int,
+    changed_ids: set[str],
+    liked_songs: list[TrackRecord],
+    previous_manifest: PlaylistManifest | None = None,
+) -> PlaylistManifest:
+    """
+    Write a snapshots repo's worth of files, like a backup run would. Like a backup
+    run, playlists whose snapshot in previous_manifest is still current aren't
+    written again.
+    """
+    output_manager = SpotifySnapshotOutputManager.get_instance()
+    outputfileutils.write_to_file(
+        data=playlists,
+        sort_lambda=lambda playlist: playlist.id,
+        header_row=outputfileutils.PLAYLIST_HEADER_ROW,
+        item_to_row_lambda=outputfileutils.playlist_to_row,
+        output_filename=output_manager.playlists_index_path,
+    )
+    outputfileutils.write_to_file(
+        data={track.id: track for track in liked_songs},
+        sort_lambda=lambda track: (track.added_at, track.name),
+        header_row=outputfileutils.TRACK_HEADER_ROW,
+        item_to_row_lambda=outputfileutils.track_to_row,
+        output_filename=output_manager.liked_songs_path,
+    )
+    tracks = make_tracks(tracks_per_playlist + 5, with_added_by=True)
+    manifest = PlaylistManifest()
+    for playlist in playlists.values():
+        tracks_file = spotify.get_playlist_file_name(playlist)
+        relative_tracks_file = tracks_file.relative_to(output_manager.base_dir)
+        if previous_manifest is not None and playlist.id not in changed_ids:
+            unchanged_entry = previous_manifest.get_unchanged_entry(
+                playlist_id=playlist.id,
+                snapshot_id=playlist.snapshot_id,
+                base_dir=output_manager.base_dir,
+                expected_file=relative_tracks_file.as_posix(),
+            )
+            if unchanged_entry is not None:
+                manifest.entries[playlist.id] = unchanged_entry
+                continue
+        # Changed playlists gain a few tracks
+        offset = int(playlist.id) % 5
+        track_count = tracks_per_playlist + (5 if playlist.id in changed_ids else 0)
+        end = offset + track_count
+        playlist_tracks = tracks[offset:end]
+        outputfileutils.write_to_file(
+            data={track.id: track for track in playlist_tracks},
+            sort_lambda=lambda track: (track.added_at, track.name),
+            header_row=outputfileutils.TRACK_IN_PLAYLIST_HEADER_ROW,
+            item_to_row_lambda=outputfileutils.playlist_track_to_row,
+            output_filename=tracks_file,
+        )
+        manifest.entries[playlist.id] = PlaylistManifestEntry(
+            snapshot_id=playlist.snapshot_id,
+            file=relative_tracks_file.as_posix(),
+            name=playlist.name,
+        )
+    manifest.save(output_manager.playlists_manifest_path)
+    outputfileutils.written_files.add(output_manager.playlists_manifest_path)
+    return manifest
+
+
+def make_snapshots_repo(
+    root: Path, playlist_count: int, playlists_layout: str = "flat"
+) -> git.Repo:
+    """
+    Creates a snapshots repo with one backup committed, and a second backup in the
+    working tree in which some playlists have changed, been deleted or been renamed.
+    """
+    initialize_output_manager(root, playlists_layout)
+    repo = git.Repo.init(root)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "Benchmark")
+        config.set_value("user", "email", "benchmark@example.com")
+        config.set_value("commit", "gpgsign", "false")
+
+    rng = random.Random(playlist_count)
+    playlists = make_playlists(playlist_count)
+    liked_songs = make_tracks(1_000)
+    manifest = write_snapshot(playlists, 50, set(), liked_songs)
+    repo.git.add(A=True)
+    repo.git.commit("-m", "Initial snapshot")
+    outputfileutils.written_files.clear()
+
+    ids = list(playlists)
+    deleted_ids = set(rng.sample(ids, max(1, int(playlist_count * DELETED_FRACTION))))
+    remaining_ids = [i for i in ids if i not in deleted_ids]
+    renamed_ids = set(
+        rng.sample(remaining_ids, max(1, int(playlist_count * RENAMED_FRACTION)))
+    )
+    changed_ids = set(
+        rng.sample(remaining_ids, max(1, int(playlist_count * CHANGED_FRACTION)))
+    )
+
+    for playlist_id in deleted_ids:
+        deleted_file = spotify.get_playlist_file_name(playlists.pop(playlist_id))
+        deleted_file.unlink()
+        outputfileutils.written_files.add(deleted_file)
+    for playlist_id in renamed_ids:
+        renamed_file = spotify.get_playlist_file_name(playlists[playlist_id])
+        renamed_file.unlink()
+        outputfileutils.written_files.add(renamed_file)
+        playlists[playlist_id].name += " (renamed)"
+    write_snapshot(
+        playlists,
+        50,
+        changed_ids,
+        liked_songs + make_tracks(1_050)[1_000:],
+        previous_manifest=manifest,
+    )
+    return repo
+
+
+#####
+# Benchmarks
+#####
+
+
+def bench_write_to_file(row_count: int) -> Benchmark:
+    def setup(tmp_dir: Path):
+        tracks = {track.id: track for track in make_tracks(row_count)}
+        output_filename = tmp_dir / "liked_songs.tsv"
+
+        def run() -> None:
+            outputfileutils.write_to_file(
+                data=tracks,
+                sort_lambda=lambda track: (track.added_at, track.name),
+                header_row=outputfileutils.TRACK_HEADER_ROW,
+                item_to_row_lambda=outputfileutils.track_to_row,
+                output_filename=output_filename,
+            )
+
+        return run, lambda: None
+
+    return Benchmark(f"write_to_file[rows={row_count}]", setup)
+
+
+def bench_rewrite_unchanged_file(row_count: int) -> Benchmark:
+    """write_to_file for a file that already has the same contents."""
+
+    def setup(tmp_dir: Path):
+        tracks = {track.id: track for track in make_tracks(row_count)}
+        output_filename = tmp_dir / "liked_songs.tsv"
+        content_hashes.load(tmp_dir / "content_hashes.json")
+
+        def run() -> None:
+            outputfileutils.write_to_file(
+                data=tracks,
+                sort_lambda=lambda track: (track.added_at, track.name),
+                header_row=outputfileutils.TRACK_HEADER_ROW,
+                item_to_row_lambda=outputfileutils.track_to_row,
+                output_filename=output_filename,
+            )
+
+        def cleanup() -> None:
+            # Back to writing every file, for every other benchmark
+            content_hashes.path = None
+
+        run()
+        return run, cleanup
+
+    return Benchmark(f"rewrite_unchanged_file[rows={row_count}]", setup)
+
+
+def bench_to_row(
+    row_count: int, to_row: Callable[[TrackRecord], list[str]], with_added_by: bool
+) -> Benchmark:
+    def setup(tmp_dir: Path):
+        tracks = make_tracks(row_count, with_added_by)
+
+        def run() -> None:
+            for track in tracks:
+                to_row(track)
+
+        return run, lambda: None
+
+    return Benchmark(f"{to_row.__name__}[rows={row_count}]", setup)
+
+
+def bench_pretty_print_tsv_table(row_count: int) -> Benchmark:
+    def setup(tmp_dir: Path):
+        tsv_path = tmp_dir / "liked_songs.tsv"
+        outputfileutils.write_to_file(
+            data={track.id: track for track in make_tracks(row_count)},
+            sort_lambda=lambda track: (track.added_at, track.name),
+            header_row=outputfileutils.TRACK_HEADER_ROW,
+            item_to_row_lambda=outputfileutils.track_to_row,
+            output_filename=tsv_path,
+        )
+
+        def run() -> None:
+            # Console() writes to whatever sys.stdout is when it prints
+            with contextlib.redirect_stdout(io.StringIO()):
+                outputfileutils.pretty_print_tsv_table(tsv_path)
+
+        return run, lambda: None
+
+    return Benchmark(f"pretty_print_tsv_table[rows={row_count}]", setup)
+
+
+def bench_get_playlist_changes(playlist_count: int) -> Benchmark:
+    def setup(tmp_dir: Path):
+        repo = make_snapshots_repo(tmp_dir / "repo", playlist_count)
+
+        def run() -> None:
+            gitutils.get_playlist_changes(repo)
+
+        return run, repo.close
+
+    return Benchmark(f"get_playlist_changes[playlists={playlist_count}]", setup)
+
+
+def bench_commit_message(playlist_count: int) -> Benchmark:
+    def setup(tmp_dir: Path):
+        repo = make_snapshots_repo(tmp_dir / "repo", playlist_count)
+        repo.git.add(A=True)
+
+        def run() -> None:
+            changeset = gitutils.get_staged_changeset(repo)
+            playlist_changes = gitutils.get_playlist_changes(repo)
+            gitutils.get_commit_message(changeset, playlist_changes, "benchmark-user")
+
+        return run, repo.close
+
+    return Benchmark(f"commit_message[playlists={playlist_count}]", setup)
+
+
+def bench_get_changeset(
+    playlist_count: int, git_backend: str, playlists_layout: str = "flat"
+) -> Benchmark:
+    """Everything that happens before the commit message, for either backend."""
+
+    def setup(tmp_dir: Path):
+        repo = make_snapshots_repo(tmp_dir / "repo", playlist_count, playlists_layout)
+        # Put the index back as the last commit left it before every run
+        index_path = Path(repo.git_dir) / "index"
+        index_data = index_path.read_bytes()
+        written_paths = outputfileutils.written_files.get_paths()
+
+        def run() -> None:
+            if git_backend == "plumbing":
+                tree_hexsha, _ = git_plumbing.write_tree_from_files(repo, written_paths)
+                gitutils.get_tree_changeset(repo, tree_hexsha)
+            else:
+                index_path.write_bytes(index_data)
+                git_plumbing.update_index(
+                    repo, git_plumbing.get_repo_relative_paths(repo, written_paths)
+                )
+                gitutils.get_staged_changeset(repo)
+
+        return run, repo.close
+
+    name = f"get_changeset[backend={git_backend},playlists={playlist_count}]"
+    if playlists_layout != "flat":
+        name = (
+            f"get_changeset[backend={git_backend},layout={playlists_layout},"
+            f"playlists={playlist_count}]"
+        )
+    return Benchmark(name, setup)
+
+
+def get_benchmarks(
+    row_counts: list[int], playlist_counts: list[int]
+) -> list[Benchmark]:
+    benchmarks = []
+    for row_count in row_counts:
+        benchmarks += [
+            bench_write_to_file(row_count),
+            bench_rewrite_unchanged_file(row_count),
+            bench_to_row(row_count, outputfileutils.track_to_row, False),
+            bench_to_row(row_count, outputfileutils.playlist_track_to_row, True),
+            bench_pretty_print_tsv_table(row_count),
+        ]
+    for playlist_count in playlist_counts:
+        benchmarks += [
+            bench_get_playlist_changes(playlist_count),
+            bench_commit_message(playlist_count),
+            bench_get_changeset(playlist_count, "worktree"),
+            bench_get_changeset(playlist_count, "plumbing"),
+            bench_get_changeset(playlist_count, "plumbing", "sharded"),
+        ]
+    return benchmarks
+
+
+#####
+# Running
+#####
+
+
+def time_benchmark(
+    benchmark: Benchmark, min_repeats: int, min_time_sec: float, max_time_sec: float
+) -> float:
+    """
+    Repeats a benchmark at least min_repeats times and for at least min_time_sec
+    seconds, unless that would take longer than max_time_sec (some of the biggest
+    fixtures take a while). Returns the median time of a run, in seconds.
+    """
+    tmp_dir = Path(tempfile.mkdtemp(prefix="spotify-snapshot-microbench-"))
+    try:
+        run, cleanup = benchmark.setup(tmp_dir)
+        try:
+            timings = []
+            started_at = time.perf_counter()
+            while True:
+                elapsed_sec = time.perf_counter() - started_at
+                if timings and elapsed_sec >= max_time_sec:
+                    break
+                if len(timings) >= min_repeats and elapsed_sec >= min_time_sec:
+                    break
+                start_time = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start_time)
+        finally:
+            cleanup()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Record the timings in the baseline instead of comparing with it",
+    )
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=1.5,
+        help="Fail if a benchmark is this many times slower than its baseline",
+    )
+    parser.add_argument(
+        "--filter", default="", help="Only run benchmarks whose name contains this"
+    )
+    parser.add_argument(
+        "--large",
+        action="store_true",
+        help=f"Also run the fixtures with {', '.join(map(str, LARGE_ROW_COUNTS))} rows",
+    )
+    parser.add_argument("--max-rows", type=int, default=max(LARGE_ROW_COUNTS))
+    parser.add_argument("--max-playlists", type=int, default=max(PLAYLIST_COUNTS))
+    parser.add_argument("--min-repeats", type=int, default=3)
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.5,
+        help="Keep repeating each benchmark for at least this many seconds",
+    )
+    parser.add_argument(
+        "--max-time",
+        type=float,
+        default=30.0,
+        help=(
+            "Stop repeating a benchmark after this many seconds, even if it hasn't"
+            " run --min-repeats times"
+        ),
+    )
+    args = parser.parse_args()
+
+    # The code under test logs every file it writes
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    previous_timings = {}
+    if args.baseline.exists():
+        previous_timings = json.loads(args.baseline.read_text())["timings_sec"]
+    baseline = {} if args.save_baseline else previous_timings
+    row_counts = [
+        count
+        for count in ROW_COUNTS + (LARGE_ROW_COUNTS if args.large else ())
+        if count <= args.max_rows
+    ]
+    playlist_counts = [
+        count for count in PLAYLIST_COUNTS if count <= args.max_playlists
+    ]
+
+    table = Table(show_header=True, header_style="bold magenta")
+    for column in ("BENCHMARK", "MEDIAN (ms)", "BASELINE (ms)", "CHANGE"):
+        table.add_column(column)
+
+    timings = {}
+    regressions = []
+    for benchmark in get_benchmarks(row_counts, playlist_counts):
+        if args.filter not in benchmark.name:
+            continue
+        print(f"Running {benchmark.name}...", file=sys.stderr)
+        timing = time_benchmark(
+            benchmark, args.min_repeats, args.min_time, args.max_time
+        )
+        timings[benchmark.name] = timing
+
+        baseline_timing = baseline.get(benchmark.name)
+        change = ""
+        if baseline_timing:
+            ratio = timing / baseline_timing
+            change = f"{ratio:.2f}x"
+            if ratio > args.max_slowdown:
+                regressions.append(benchmark.name)
+                change = f"[red]{change}[/red]"
+        table.add_row(
+            escape(benchmark.name),
+            f"{timing * 1000:.2f}",
+            f"{baseline_timing * 1000:.2f}" if baseline_timing else "",
+            change,
+        )
+
+    Console().print(table)
+
+    if args.save_baseline:
+        args.baseline.write_text(
+            json.dumps(
+                {
+                    "python": sys.version.split()[0],
+                    "platform": sys.platform,
+                    "timings_sec": dict(sorted((previous_timings | timings).items())),
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"Wrote baseline to {args.baseline}")
+    if regressions:
+        print(
+            f"{len(regressions)} benchmarks are over {args.max_slowdown}x slower than"
+            " the baseline:"
+        )
+        for name in regressions:
+            print(f"  • {name}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+End-to-end benchmarks for spotify-snapshot. Runs the real CLI (`python -m
+spotify_snapshot --backup-all`) against the fake Spotify API in fake_spotify_server.py,
+in a throwaway home with its own config, cache and snapshots repo, and reports the wall
+time, CPU time, peak RSS and number of API requests of each run.
+
+Each benchmark is a sequence of runs against the same library:
+
+    cold       First backup, into an empty repo with an empty cache
+    unchanged  Backup again, with nothing changed on the Spotify side
+    changed    Backup again, after liking some songs and changing some playlists
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --scale medium --json results.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import requests
+from rich.console import Console
+from rich.table import Table
+
+from fake_spotify_server import (
+    FakeSpotifyServer,
+    add_library_arguments,
+    create_server_from_args,
+)
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARKS_DIR.parent
+
+SCALES = {
+    "small": dict(liked_songs=2_000, albums=200, playlists=50, tracks_per_playlist=100),
+    "medium": dict(
+        liked_songs=20_000, albums=1_000, playlists=500, tracks_per_playlist=100
+    ),
+    "large": dict(
+        liked_songs=100_000, albums=5_000, playlists=2_000, tracks_per_playlist=150
+    ),
+}
+
+SCOPES = "user-library-read playlist-read-private playlist-read-collaborative"
+
+
+@dataclass
+class RunResult:
+    name: str
+    exit_code: int
+    wall_time_sec: float
+    cpu_time_sec: float
+    peak_rss_mb: float
+    requests: int
+    rate_limited: int
+    not_modified: int
+    bytes_received: int
+
+
+class BenchmarkHome:
+    """A throwaway config dir, cache dir and snapshots repo for the CLI to run in."""
+
+    def __init__(self, root: Path, api_prefix: str, git_backend: str = "worktree"):
+        self.root = root
+        self.api_prefix = api_prefix
+        self.git_backend = git_backend
+        self.config_home = root / "config"
+        self.cache_home = root / "cache"
+        self.snapshots_dir = root / "snapshots"
+        self.logs_dir = root / "logs"
+        for directory in (self.config_home, self.cache_home, self.logs_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self._write_config()
+        self._seed_auth_cache()
+
+    def _write_config(self) -> None:
+        # Written by hand since TOML can't express the None that most fields
+        # default to
+        (self.config_home / "spotify-snapshot.toml").write_text(
+            f'git_remote_url = ""\n'
+            f'macos_backup_dir = "{self.snapshots_dir}"\n'
+            f'linux_backup_dir = "{self.snapshots_dir}"\n'
+            f"backup_interval_hours = 8\n"
+            f'git_backend = "{self.git_backend}"\n'
+        )
+
+    def _seed_auth_cache(self) -> None:
+        """Pretend we've already logged in, so no browser window is opened."""
+        auth_cache_path = self.cache_home / "spotify-backup" / "auth_cache"
+        auth_cache_path.parent.mkdir(parents=True, exist_ok=True)
+        auth_cache_path.write_text(
+            json.dumps(
+                {
+                    "access_token": "benchmark-access-token",
+                    "token_type": "Bearer",
+                    "expires_in": 3600,
+                    "refresh_token": "benchmark-refresh-token",
+                    "scope": SCOPES,
+                    "expires_at": int(time.time()) + 7 * 24 * 3600,
+                }
+            )
+        )
+
+    def get_env(self) -> dict[str, str]:
+        env = dict(os.environ)
+        env.update(
+            {
+                "XDG_CONFIG_HOME": str(self.config_home),
+                "XDG_CACHE_HOME": str(self.cache_home),
+                "SPOTIFY_SNAPSHOT_API_PREFIX": self.api_prefix,
+                "PYTHON_KEYRING_BACKEND": "benchmark_keyring.BenchmarkKeyring",
+                "PYTHONPATH": os.pathsep.join(
+                    [str(BENCHMARKS_DIR), str(REPO_ROOT), env.get("PYTHONPATH", "")]
+                ),
+                # Keep the user's git config (and commit signing) out of it
+                "GIT_CONFIG_GLOBAL": os.devnull,
+                "GIT_CONFIG_NOSYSTEM": "1",
+                "GIT_AUTHOR_NAME": "Benchmark",
+                "GIT_AUTHOR_EMAIL": "benchmark@example.com",
+                "GIT_COMMITTER_NAME": "Benchmark",
+                "GIT_COMMITTER_EMAIL": "benchmark@example.com",
+            }
+        )
+        return env
+
+
+def get_stats(server: FakeSpotifyServer) -> dict[str, int]:
+    return requests.get(f"{server.base_url}/__stats", timeout=10).json()
+
+
+def run_backup(
+    name: str, server: FakeSpotifyServer, home: BenchmarkHome, cli_args: list[str]
+) -> RunResult:
+    requests.post(f"{server.base_url}/__stats/reset", timeout=10)
+    log_path = home.logs_dir / f"{name}.log"
+    with open(log_path, "wb") as log_file:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "spotify_snapshot", "--backup-all", *cli_args],
+            cwd=REPO_ROOT,
+            env=home.get_env(),
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+        # wait4 rather than process.wait(), to get the child's resource usage
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_time_sec = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak_rss_bytes = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    stats = get_stats(server)
+    if process.returncode != 0:
+        print(f"{name} run exited with {process.returncode}, see {log_path}")
+    return RunResult(
+        name=name,
+        exit_code=process.returncode,
+        wall_time_sec=round(wall_time_sec, 3),
+        cpu_time_sec=round(rusage.ru_utime + rusage.ru_stime, 3),
+        peak_rss_mb=round(peak_rss_bytes / (1024 * 1024), 1),
+        requests=stats.get("requests", 0),
+        rate_limited=stats.get("rate_limited", 0),
+        not_modified=stats.get("not_modified", 0),
+        bytes_received=stats.get("bytes_sent", 0),
+    )
+
+
+def print_results(results: list[RunResult]) -> None:
+    table = Table(show_header=True, header_style="bold magenta")
+    for column in (
+        "RUN",
+        "EXIT",
+        "WALL (s)",
+        "CPU (s)",
+        "PEAK RSS (MB)",
+        "REQUESTS",
+        "429s",
+        "304s",
+        "MB RECEIVED",
+    ):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            result.name,
+            str(result.exit_code),
+            f"{result.wall_time_sec:.2f}",
+            f"{result.cpu_time_sec:.2f}",
+            f"{result.peak_rss_mb:.1f}",
+            str(result.requests),
+            str(result.rate_limited),
+            str(result.not_modified),
+            f"{result.bytes_received / (1024 * 1024):.2f}",
+        )
+    Console().print(table)
+
+
+def main() -> None:
+    scale_parser = argparse.ArgumentParser(add_help=False)
+    scale_parser.add_argument("--scale", choices=SCALES, default="small")
+    scale_args, _ = scale_parser.parse_known_args()
+
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0], parents=[scale_parser]
+    )
+    add_library_arguments(parser)
+    parser.set_defaults(**SCALES[scale_args.scale])
+    parser.add_argument(
+        "--new-liked-songs",
+        type=int,
+        default=25,
+        help="Songs to like before the 'changed' run",
+    )
+    parser.add_argument(
+        "--changed-playlists",
+        type=int,
+        default=10,
+        help="Playlists to change before the 'changed' run",
+    )
+    parser.add_argument(
+        "--git-backend",
+        choices=("worktree", "plumbing"),
+        default="worktree",
+        help="How the CLI should commit each snapshot",
+    )
+    parser.add_argument(
+        "--json", type=Path, help="Also write the results to this file as JSON"
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the benchmark's config, cache, logs and snapshots repo",
+    )
+    parser.add_argument(
+        "cli_args",
+        nargs="*",
+        help="Extra arguments for spotify-snapshot (put them after --)",
+    )
+    args = parser.parse_args()
+
+    server = create_server_from_args(args)
+    server.start_in_background()
+    print(
+        f"Fake Spotify API at {server.api_prefix} with {args.liked_songs} liked songs, "
+        f"{args.albums} albums and {args.playlists} playlists"
+    )
+
+    root = Path(tempfile.mkdtemp(prefix="spotify-snapshot-bench-"))
+    home = BenchmarkHome(root, server.api_prefix, git_backend=args.git_backend)
+    results = [run_backup("cold", server, home, args.cli_args)]
+    results.append(run_backup("unchanged", server, home, args.cli_args))
+    server.library.mutate(
+        new_liked_songs=args.new_liked_songs,
+        changed_playlists=args.changed_playlists,
+    )
+    results.append(run_backup("changed", server, home, args.cli_args))
+    server.shutdown()
+
+    print_results(results)
+    if args.json:
+        args.json.write_text(
+            json.dumps(
+                {
+                    "library": {
+                        key: getattr(args, key) for key in SCALES[args.scale].keys()
+                    },
+                    "runs": [asdict(result) for result in results],
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+    if args.keep:
+        print(f"Kept everything in {root}")
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if any(result.exit_code != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,56 @@
 import os
 import subprocess
+from datetime import datetime
 from pathlib import Path
 from sys import exit
-from time import sleep
 import click
 from rich import print as rprint
+from rich.console import Console
+from rich.table import Table
 
 from spotify_snapshot.__about__ import __version__
+from spotify_snapshot.checkpoint import CheckpointStore
 from spotify_snapshot.config import SpotifySnapshotConfig
+from spotify_snapshot.content_hashes import content_hashes
 from spotify_snapshot.install import install_crontab_entry, uninstall_crontab_entry
 from spotify_snapshot.logging import configure_logging, get_colorized_logger
-from spotify_snapshot import gitutils, outputfileutils, spotify
+from spotify_snapshot.profiling import profiler
+from spotify_snapshot import (
+    fingerprints,
+    git_plumbing,
+    gitutils,
+    history_log,
+    maintenance,
+    outputfileutils,
+    parquet_export,
+    playlist_layout,
+    query_index,
+    spotify,
+)
 from spotify_snapshot.spotify import SpotifyCredentialsManager
 from spotify_snapshot.spotify_snapshot_output_manager import (
     SpotifySnapshotOutputManager,
 )
-from spotify_snapshot.lockfile import process_lock, ProcessLockError
+from spotify_snapshot.lockfile import process_lock
 
 
-@click.command(
+@click.group(
     epilog="https://github.com/alichtman/spotify-snapshot",
     context_settings={
         "help_option_names": ["-h", "-help", "--help"],
     },
+    # Running without a subcommand backs up, like it always has
+    invoke_without_command=True,
 )
 @click.option(
     "-t",
     "--test",
     is_flag=True,
     default=False,
-    help="Runs in test mode, writing to a test repo instead of the production snapshots repo.",
+    help=(
+        "Runs in test mode, writing to a test repo instead of the production"
+        " snapshots repo."
+    ),
 )
 @click.option(
     "--backup-all",
@@ -92,7 +113,18 @@ from spotify_snapshot.lockfile import process_lock, ProcessLockError
     default=False,
     help="Remove Spotify API credentials from system keyring",
 )
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    required=False,
+    help=(
+        "Write a JSON report of how long each part of the backup took (and of every"
+        " API request) to this file."
+    ),
+)
+@click.pass_context
 def main(
+    ctx: click.Context,
     test: bool,
     backup_all: bool,
     backup_liked_songs: bool,
@@ -106,13 +138,17 @@ def main(
     push: bool,
     set_creds: bool,
     clear_creds: bool,
+    profile: Path | None,
 ) -> None:
     """Fetch and snapshot Spotify library data."""
+    if ctx.invoked_subcommand is not None:
+        return
     logger = get_colorized_logger()
 
     if version:
         rprint(
-            f"[bold green]spotify-snapshot[/bold green] [bold blue]{__version__}[/bold blue]"
+            "[bold green]spotify-snapshot[/bold green]"
+            f" [bold blue]{__version__}[/bold blue]"
         )
         return
 
@@ -127,6 +163,9 @@ def main(
 
     configure_logging()
 
+    if profile:
+        profiler.enable()
+
     # This will guide the user through creating the config file if it doesn't exist
     config = SpotifySnapshotConfig.load()
 
@@ -167,20 +206,49 @@ def main(
             else:
                 logger.info("<yellow>*** RUNNING IN PROD MODE ***</yellow>")
 
-            sp_client = spotify.create_spotify_client()
+            sp_client = spotify.create_spotify_client(
+                http_cache_max_mb=config.http_cache_max_mb
+            )
 
             logger.info(
                 f"<green>Logged in as {spotify.get_username(sp_client)}</green>"
             )
 
-            gitutils.setup_git_repo_if_needed(is_test_mode)
+            with profiler.phase("setup_git_repo"):
+                gitutils.setup_git_repo_if_needed(is_test_mode)
+
+            # Only the files written are committed, so remember them even if this
+            # run crashes before it gets to commit them
+            outputfileutils.written_files.use_journal(
+                git_plumbing.get_written_files_journal_path(
+                    gitutils.get_repo(is_test_mode)
+                )
+            )
+            content_hashes.load()
 
             # Set remote URL if configured
             if config.git_remote_url:
                 gitutils.set_remote_url(config.git_remote_url, is_test_mode)
 
             snapshots_repo_name = gitutils.get_repo_filepath(is_test_mode)
-            SpotifySnapshotOutputManager.initialize(snapshots_repo_name)
+            output_manager = SpotifySnapshotOutputManager.initialize(
+                snapshots_repo_name, config.playlists_layout
+            )
+            with profiler.phase("migrate_playlists_layout"):
+                playlist_layout.migrate_playlists_layout_if_needed(output_manager)
+            if config.parquet_export:
+                if parquet_export.is_pyarrow_installed():
+                    parquet_export.parquet_exporter.enable(
+                        parquet_export.ParquetExporter.get_export_dir(
+                            snapshots_repo_name
+                        )
+                    )
+                else:
+                    logger.warning(
+                        "<yellow>Not exporting to Parquet, since PyArrow isn't"
+                        " installed. Install spotify-snapshot[parquet] to"
+                        " export</yellow>"
+                    )
 
             # If no specific backup option is selected, default to backing up everything
             if not any(
@@ -188,33 +256,57 @@ def main(
             ):
                 backup_all = True
                 logger.info(
-                    "<yellow>No specific backup option selected. Backing up all data...</yellow>"
+                    "<yellow>No specific backup option selected. Backing up all"
+                    " data...</yellow>"
                 )
 
             if backup_all or backup_liked_songs:
-                spotify.write_liked_songs_to_git_repo(sp_client)
+                with profiler.phase("backup_liked_songs"):
+                    spotify.write_liked_songs_to_git_repo(
+                        sp_client,
+                        full_sync_interval_hours=config.full_sync_interval_hours,
+                    )
 
             if backup_all or backup_saved_albums:
-                sleep_time = 10
-                logger.info(f"<yellow>Sleeping for {sleep_time} seconds...</yellow>")
-                sleep(sleep_time)
-                spotify.write_saved_albums_to_git_repo(sp_client)
+                with profiler.phase("backup_saved_albums"):
+                    spotify.write_saved_albums_to_git_repo(
+                        sp_client,
+                        full_sync_interval_hours=config.full_sync_interval_hours,
+                    )
 
             if backup_all or backup_playlists:
-                sleep_time = 30
-                logger.info(f"<yellow>Sleeping for {sleep_time} seconds...</yellow>")
-                sleep(sleep_time)
-                spotify.write_playlists_to_git_repo(sp_client)
+                with profiler.phase("backup_playlists"):
+                    spotify.write_playlists_to_git_repo(
+                        sp_client, max_workers=config.playlist_fetch_workers
+                    )
 
+            content_hashes.save()
             username = spotify.get_username(sp_client)
-            do_changes_to_push_exist = gitutils.commit_files(is_test_mode, username)
-            if do_changes_to_push_exist:
-                gitutils.maybe_git_push(
-                    is_test_mode, should_push_without_prompting_user=push
+            with profiler.phase("commit"):
+                do_changes_to_push_exist = gitutils.commit_files(is_test_mode, username)
+            # Everything has been backed up, so there's nothing left to resume
+            CheckpointStore.for_output_dir(snapshots_repo_name).clear()
+            with profiler.phase("update_query_index"):
+                query_index.update_query_index_if_enabled(
+                    gitutils.get_repo(is_test_mode), snapshots_repo_name
+                )
+            with profiler.phase("update_fingerprints"):
+                fingerprints.update_fingerprint_store_if_enabled(
+                    gitutils.get_repo(is_test_mode), snapshots_repo_name
+                )
+            with profiler.phase("maintenance"):
+                maintenance.run_maintenance_if_due(
+                    gitutils.get_repo(is_test_mode), config
                 )
+            if do_changes_to_push_exist:
+                with profiler.phase("push"):
+                    gitutils.maybe_git_push(
+                        is_test_mode, should_push_without_prompting_user=push
+                    )
             else:
                 logger.info(
-                    "<yellow>Exiting without pushing changes, since there are no changes to push</yellow>"
+                    "<yellow>Exiting without pushing changes, since there are no"
+                    " changes to push</yellow>"
                 )
 
             gitutils.cleanup_repo()
@@ -223,6 +315,318 @@ def main(
     except Exception as e:
         logger.error(f"<red>An error occurred: {e.with_traceback}</red>")
         raise e
+    finally:
+        # Written even if the backup failed, since that's often when it's most useful
+        if profile:
+            profiler.write_report(profile)
+
+
+@main.command()
+@click.option(
+    "-t",
+    "--test",
+    is_flag=True,
+    default=False,
+    help="Index the test repo instead of the production snapshots repo.",
+)
+def index(test: bool) -> None:
+    """Create or update the query index and its history.
+
+    Once it's been created, every backup keeps it up to date.
+    """
+    logger = get_colorized_logger()
+    configure_logging()
+    repo_filepath = gitutils.get_repo_filepath(test)
+    # Needed for the names of the files to index
+    SpotifySnapshotOutputManager.initialize(repo_filepath, create_output_dirs=False)
+    # A backup that's running updates the index too
+    with process_lock.acquire():
+        index = query_index.QueryIndex.open(
+            query_index.QueryIndex.get_path(repo_filepath)
+        )
+        try:
+            if index.indexed_commit is None:
+                logger.info(f"<blue>Creating the query index at</blue> {index.path}")
+            reindexed_file_count = index.update(gitutils.get_repo(test))
+            history_commit_count = index.update_history(gitutils.get_repo(test))
+        finally:
+            index.close()
+            gitutils.cleanup_repo()
+    logger.info(
+        f"<green>Query index is up to date ({reindexed_file_count} files"
+        f" reindexed, {history_commit_count} commits added to its history)</green>"
+    )
+
+
+def _open_existing_query_index(is_test_mode: bool) -> query_index.QueryIndex:
+    index_path = query_index.QueryIndex.get_path(
+        gitutils.get_repo_filepath(is_test_mode)
+    )
+    if not index_path.exists():
+        raise click.ClickException(
+            "There's no query index yet. Run `spotify-snapshot index` to create it"
+        )
+    return query_index.QueryIndex.open(index_path)
+
+
+def _format_timestamp(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+
+@main.command()
+@click.argument("term")
+@click.option(
+    "-t",
+    "--test",
+    is_flag=True,
+    default=False,
+    help="Search the test repo instead of the production snapshots repo.",
+)
+@click.option(
+    "--limit", default=50, show_default=True, help="Most results to show of each kind."
+)
+def query(term: str, test: bool, limit: int) -> None:
+    """Find tracks and saved albums by Spotify ID, name or artist.
+
+    Shows when each track was liked and which playlists it's on, as of the last
+    backup. Run `spotify-snapshot index` first to create the index.
+    """
+    index = _open_existing_query_index(test)
+    try:
+        tracks = index.search_tracks(term, limit)
+        albums = index.search_saved_albums(term, limit)
+    finally:
+        index.close()
+
+    console = Console()
+    if not tracks and not albums:
+        console.print(f"[yellow]Nothing found for[/yellow] {term}")
+        return
+    if tracks:
+        table = Table(title="Tracks", show_lines=True)
+        for column in ("Track", "Artist(s)", "Album", "Liked", "Playlists", "ID"):
+            table.add_column(column)
+        for track in tracks:
+            table.add_row(
+                track.name,
+                track.artists,
+                track.album,
+                track.liked_at or "",
+                "\n".join(
+                    f"{playlist_name} ({added_at})"
+                    for playlist_name, added_at in track.playlists
+                ),
+                track.id,
+            )
+        console.print(table)
+    if albums:
+        table = Table(title="Saved Albums")
+        for column in ("Album", "Artist(s)", "Saved", "ID"):
+            table.add_column(column)
+        for album in albums:
+            table.add_row(album.name, album.artists, album.added_at, album.id)
+        console.print(table)
+
+
+@main.command()
+@click.argument("item_id")
+@click.option(
+    "-t",
+    "--test",
+    is_flag=True,
+    default=False,
+    help="Use the test repo instead of the production snapshots repo.",
+)
+def history(item_id: str, test: bool) -> None:
+    """Show every time a track, album or playlist was added or removed.
+
+    ITEM_ID is its Spotify ID, which `spotify-snapshot query` can find.
+    """
+    index = _open_existing_query_index(test)
+    try:
+        events = index.get_item_history(item_id)
+        collection_names = {
+            event.collection: index.get_collection_name(event.collection)
+            for event in events
+        }
+    finally:
+        index.close()
+
+    console = Console()
+    if not events:
+        console.print(f"[yellow]No history found for[/yellow] {item_id}")
+        return
+    table = Table(title=f"History of {events[-1].name}")
+    for column in ("Date", "Event", "In", "Commit"):
+        table.add_column(column)
+    for event in events:
+        table.add_row(
+            _format_timestamp(event.committed_at),
+            (
+                f"[green]{event.event}[/green]"
+                if event.event == query_index.ADDED_EVENT
+                else f"[red]{event.event}[/red]"
+            ),
+            collection_names[event.collection],
+            event.commit_hexsha[:10],
+        )
+    console.print(table)
+
+
+def _get_collection(collection: str) -> str:
+    """A collection named on the command line, where playlists are named by ID."""
+    if collection in (
+        history_log.LIKED_SONGS_COLLECTION,
+        history_log.SAVED_ALBUMS_COLLECTION,
+        history_log.PLAYLISTS_COLLECTION,
+    ):
+        return collection
+    return history_log.PLAYLIST_COLLECTION_PREFIX + collection
+
+
+_COLLECTION_HELP = (
+    f"{history_log.LIKED_SONGS_COLLECTION}, {history_log.SAVED_ALBUMS_COLLECTION},"
+    f" {history_log.PLAYLISTS_COLLECTION}, or a playlist's ID for its tracks."
+)
+
+
+@main.command("as-of")
+@click.argument("date", type=click.DateTime())
+@click.option(
+    "--collection",
+    default=history_log.LIKED_SONGS_COLLECTION,
+    show_default=True,
+    help=_COLLECTION_HELP,
+)
+@click.option(
+    "-t",
+    "--test",
+    is_flag=True,
+    default=False,
+    help="Use the test repo instead of the production snapshots repo.",
+)
+def as_of(date: datetime, collection: str, test: bool) -> None:
+    """Show what was in your library or a playlist at DATE (local time)."""
+    collection = _get_collection(collection)
+    index = _open_existing_query_index(test)
+    try:
+        items = index.get_collection_as_of(collection, date.timestamp())
+        collection_name = index.get_collection_name(collection)
+    finally:
+        index.close()
+
+    table = Table(title=f"{collection_name} as of {date:%Y-%m-%d %H:%M}")
+    for column in ("Name", "Added", "ID"):
+        table.add_column(column)
+    for item in items:
+        table.add_row(item.name, _format_timestamp(item.committed_at), item.item_id)
+    console = Console()
+    console.print(table)
+    console.print(f"{len(items)} items")
+
+
+def _ensure_numpy_is_installed() -> None:
+    if not fingerprints.is_numpy_installed():
+        raise click.ClickException(
+            "The fingerprint store needs NumPy. Install it with"
+            " `pip install 'spotify-snapshot[fingerprints]'`"
+        )
+
+
+@main.command("fingerprints")
+@click.option(
+    "-t",
+    "--test",
+    is_flag=True,
+    default=False,
+    help="Use the test repo instead of the production snapshots repo.",
+)
+def fingerprints_command(test: bool) -> None:
+    """Create or update the fingerprint store of every snapshot.
+
+    Once it's been created, every backup keeps it up to date.
+    """
+    _ensure_numpy_is_installed()
+    logger = get_colorized_logger()
+    configure_logging()
+    repo_filepath = gitutils.get_repo_filepath(test)
+    # Needed for the names of the files to fingerprint
+    SpotifySnapshotOutputManager.initialize(repo_filepath, create_output_dirs=False)
+    store_path = fingerprints.FingerprintStore.get_path(repo_filepath)
+    # A backup that's running updates the store too
+    with process_lock.acquire():
+        if not store_path.exists():
+            logger.info(f"<blue>Creating the fingerprint store at</blue> {store_path}")
+        store = fingerprints.FingerprintStore.open(store_path)
+        try:
+            added_snapshot_count = store.update(gitutils.get_repo(test))
+        finally:
+            gitutils.cleanup_repo()
+    logger.info(
+        f"<green>Fingerprint store is up to date ({added_snapshot_count} snapshots"
+        f" added, {len(store.snapshots)} in total)</green>"
+    )
+
+
+@main.command()
+@click.option(
+    "--collection",
+    default=history_log.LIKED_SONGS_COLLECTION,
+    show_default=True,
+    help=_COLLECTION_HELP,
+)
+@click.option(
+    "--last",
+    default=20,
+    show_default=True,
+    help="How many of the most recent snapshots that changed it to show.",
+)
+@click.option(
+    "-t",
+    "--test",
+    is_flag=True,
+    default=False,
+    help="Use the test repo instead of the production snapshots repo.",
+)
+def churn(collection: str, last: int, test: bool) -> None:
+    """Show how many items were added to and removed from a collection over time.
+
+    Run `spotify-snapshot fingerprints` first to create the fingerprint store.
+    """
+    _ensure_numpy_is_installed()
+    collection = _get_collection(collection)
+    store_path = fingerprints.FingerprintStore.get_path(
+        gitutils.get_repo_filepath(test)
+    )
+    if not store_path.exists():
+        raise click.ClickException(
+            "There's no fingerprint store yet. Run `spotify-snapshot fingerprints`"
+            " to create it"
+        )
+    store = fingerprints.FingerprintStore.open(store_path)
+    collection_churn = store.get_churn(collection)
+    distinct_item_count = store.count_distinct_items(collection)
+
+    table = Table(title=f"Churn of {collection}")
+    for column in ("Date", "Items", "Added", "Removed", "Commit"):
+        table.add_column(column)
+    for snapshot_churn in collection_churn[-last:]:
+        table.add_row(
+            _format_timestamp(snapshot_churn.committed_at),
+            str(snapshot_churn.size),
+            f"[green]+{snapshot_churn.added}[/green]",
+            f"[red]-{snapshot_churn.removed}[/red]",
+            snapshot_churn.hexsha[:10],
+        )
+    console = Console()
+    console.print(table)
+    added_count = sum(snapshot_churn.added for snapshot_churn in collection_churn)
+    removed_count = sum(snapshot_churn.removed for snapshot_churn in collection_churn)
+    console.print(
+        f"{added_count} added and {removed_count} removed over"
+        f" {len(collection_churn)} snapshots, {distinct_item_count} different items"
+        " in all"
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Generic
+
+from spotify_snapshot.config import SpotifySnapshotConfig
+from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.playlist_manifest import PlaylistManifest, PlaylistManifestEntry
+from spotify_snapshot.spotify_datatypes import RecordPage, RecordT
+
+logger = get_colorized_logger()
+
+# Checkpoints older than this are ignored, since the library has probably changed
+# too much since then for them to be worth resuming from
+CHECKPOINT_MAX_AGE_HOURS = 24
+
+
+def _write_atomically(path: Path, data: bytes) -> None:
+    """Write to a temporary file and rename it over path, so a crash never leaves
+    a half written checkpoint behind."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+
+
+def _is_stale(path: Path) -> bool:
+    return time.time() - path.stat().st_mtime >= CHECKPOINT_MAX_AGE_HOURS * 3600
+
+
+class PageCheckpoint(Generic[RecordT]):
+    """
+    The pages of one collection that have been fetched so far, keyed by offset. Each
+    page is saved as JSON, with its records in the form dataclasses.asdict gives.
+    """
+
+    def __init__(self, checkpoint_dir: Path, record_type: type[RecordT]):
+        self.checkpoint_dir = checkpoint_dir
+        self.record_type: type[RecordT] = record_type
+
+    def _record_from_json(self, record: dict[str, Any]) -> RecordT:
+        # Interned like the records built from the API are
+        record["artists"] = tuple(sys.intern(artist) for artist in record["artists"])
+        return self.record_type(**record)
+
+    def load(self) -> dict[int, RecordPage[RecordT]]:
+        pages: dict[int, RecordPage[RecordT]] = {}
+        if not self.checkpoint_dir.exists():
+            return pages
+        for page_path in self.checkpoint_dir.glob("*.json"):
+            try:
+                if _is_stale(page_path):
+                    page_path.unlink(missing_ok=True)
+                    continue
+                with open(page_path, encoding="utf-8") as f:
+                    page = json.load(f)
+                pages[int(page_path.stem)] = RecordPage(
+                    records=[
+                        self._record_from_json(record) for record in page["records"]
+                    ],
+                    skipped_items=page["skipped_items"],
+                    next=page["next"],
+                    total=page["total"],
+                )
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                logger.warning(
+                    f"<yellow>Ignoring unreadable checkpoint {page_path}: {e}</yellow>"
+                )
+        return pages
+
+    def save(self, offset: int, page: RecordPage[RecordT]) -> None:
+        _write_atomically(
+            self.checkpoint_dir / f"{offset}.json",
+            json.dumps(asdict(page)).encode("utf-8"),
+        )
+
+
+class CheckpointStore:
+    """
+    Persists the progress of a backup run, so that if it crashes or gives up on a
+    page, the next run picks up where it left off instead of starting from scratch.
+
+    Each snapshots repo gets its own run ID, and so its own directory of
+    checkpoints. Inside it, every collection being crawled has a directory of the
+    pages fetched so far, and playlists that have been completely written are
+    recorded in a PlaylistManifest. The whole lot is deleted once a run succeeds.
+    """
+
+    def __init__(self, run_dir: Path):
+        self.run_dir = run_dir
+        self._lock = threading.Lock()
+        self._completed_playlists: PlaylistManifest | None = None
+
+    @staticmethod
+    def get_default_dir() -> Path:
+        return SpotifySnapshotConfig.get_cache_dir() / "checkpoints"
+
+    @classmethod
+    def for_output_dir(cls, base_dir: Path) -> "CheckpointStore":
+        run_id = hashlib.sha1(str(base_dir.resolve()).encode()).hexdigest()[:16]
+        return cls(cls.get_default_dir() / run_id)
+
+    @property
+    def completed_playlists_path(self) -> Path:
+        return self.run_dir / "completed_playlists.json"
+
+    def pages(
+        self, collection_key: str, record_type: type[RecordT]
+    ) -> PageCheckpoint[RecordT]:
+        """
+        Get the checkpoint for a collection of record_type records. The key should
+        change whenever the collection does (e.g. include a playlist's snapshot_id),
+        so that pages of an older version of the collection are never mixed in.
+        """
+        # Keys can contain characters that aren't safe in file names
+        key_hash = hashlib.sha1(collection_key.encode()).hexdigest()
+        return PageCheckpoint(self.run_dir / "pages" / key_hash, record_type)
+
+    def _get_completed_playlists(self) -> PlaylistManifest:
+        if self._completed_playlists is None:
+            path = self.completed_playlists_path
+            if path.exists() and not _is_stale(path):
+                self._completed_playlists = PlaylistManifest.load(path)
+            else:
+                self._completed_playlists = PlaylistManifest()
+        return self._completed_playlists
+
+    def get_completed_playlist(
+        self, playlist_id: str, snapshot_id: str, base_dir: Path, expected_file: str
+    ) -> PlaylistManifestEntry | None:
+        """
+        Returns the entry for a playlist if an earlier, unfinished run already wrote
+        this version of it, and its file is still there.
+        """
+        with self._lock:
+            return self._get_completed_playlists().get_unchanged_entry(
+                playlist_id=playlist_id,
+                snapshot_id=snapshot_id,
+                base_dir=base_dir,
+                expected_file=expected_file,
+            )
+
+    def mark_playlist_complete(
+        self, playlist_id: str, entry: PlaylistManifestEntry
+    ) -> None:
+        with self._lock:
+            completed_playlists = self._get_completed_playlists()
+            completed_playlists.entries[playlist_id] = entry
+            self.run_dir.mkdir(parents=True, exist_ok=True)
+            completed_playlists.save(self.completed_playlists_path)
+
+    def clear(self) -> None:
+        """Delete every checkpoint for this run, once it has finished successfully."""
+        with self._lock:
+            self._completed_playlists = None
+            shutil.rmtree(self.run_dir, ignore_errors=True)
@@ -12,6 +12,19 @@ from spotify_snapshot.logging import get_colorized_logger
 
 logger = get_colorized_logger()
 
+# "worktree" commits with git add and git commit, like you would by hand. "plumbing"
+# writes the files a run produced straight into the object database instead
+GIT_BACKENDS = ("worktree", "plumbing")
+# How a new host gets its copy of the snapshots repo from git_remote_url. "full"
+# clones all of history. "blobless" clones every commit and tree, but only the file
+# contents that are checked out, fetching older ones if they're ever needed.
+# "shallow" clones only the last clone_depth commits, and "single_branch" all of
+# history, but only of the default branch
+CLONE_STRATEGIES = ("full", "blobless", "shallow", "single_branch")
+# "flat" puts every playlist's tracks file straight in playlists/. "sharded" splits
+# them between subdirectories of it, so that no directory (or git tree) gets huge
+PLAYLISTS_LAYOUTS = ("flat", "sharded")
+
 
 @dataclass
 class SpotifySnapshotConfig:
@@ -20,6 +33,32 @@ class SpotifySnapshotConfig:
     macos_backup_dir: Path | None = None
     linux_backup_dir: Path | None = None
     ssh_key_name: str | None = None
+    # How many playlists to fetch from the Spotify API at once
+    playlist_fetch_workers: int = 4
+    # How often to fetch every page of liked songs / saved albums, to pick up
+    # removals. In between, only the newest pages are fetched. 0 disables this
+    full_sync_interval_hours: int = 168
+    # Size limit for the cache of Spotify API responses, which lets unchanged
+    # responses be revalidated by ETag instead of downloaded again. 0 disables it
+    http_cache_max_mb: int = 64
+    # How snapshots are committed, one of GIT_BACKENDS
+    git_backend: str = "worktree"
+    # How often to write the commit-graph and multi-pack-index and prune the
+    # snapshots repo. 0 disables all repo maintenance
+    maintenance_interval_hours: int = 24
+    # Loose objects are repacked as soon as there are this many of them, or this
+    # many packs
+    maintenance_max_loose_objects: int = 1000
+    maintenance_max_packs: int = 20
+    # One of CLONE_STRATEGIES
+    clone_strategy: str = "full"
+    # How many commits a shallow clone gets
+    clone_depth: int = 1
+    # One of PLAYLISTS_LAYOUTS. Changing it moves the existing files over
+    playlists_layout: str = "flat"
+    # Also write every snapshot as Parquet datasets next to the snapshots repo.
+    # Needs the parquet extra
+    parquet_export: bool = False
 
     @property
     def backup_dir(self) -> Path | None:
@@ -63,25 +102,55 @@ class SpotifySnapshotConfig:
                 ssh_key_name = config_data.get("ssh_key_name", "")
                 git_remote_url = config_data.get("git_remote_url", "")
 
-                if not git_remote_url.startswith("git@"):
+                # The remote is optional, but has to be an SSH URL if it's set
+                if git_remote_url and not git_remote_url.startswith("git@"):
+                    logger.error(
+                        "<red>git_remote_url must be an SSH URL (starts with"
+                        " git@)</red>"
+                    )
+                    sys.exit(1)
+
+                git_backend = config_data.get("git_backend", "worktree")
+                if git_backend not in GIT_BACKENDS:
                     logger.error(
-                        "<red>git_remote_url must be an SSH URL (starts with git@)</red>"
+                        "<red>git_backend must be one of:"
+                        f" {', '.join(GIT_BACKENDS)}</red>"
+                    )
+                    sys.exit(1)
+
+                clone_strategy = config_data.get("clone_strategy", "full")
+                if clone_strategy not in CLONE_STRATEGIES:
+                    logger.error(
+                        "<red>clone_strategy must be one of:"
+                        f" {', '.join(CLONE_STRATEGIES)}</red>"
+                    )
+                    sys.exit(1)
+                clone_depth = config_data.get("clone_depth", 1)
+                if clone_depth < 1:
+                    logger.error("<red>clone_depth must be at least 1</red>")
+                    sys.exit(1)
+
+                playlists_layout = config_data.get("playlists_layout", "flat")
+                if playlists_layout not in PLAYLISTS_LAYOUTS:
+                    logger.error(
+                        "<red>playlists_layout must be one of:"
+                        f" {', '.join(PLAYLISTS_LAYOUTS)}</red>"
                     )
                     sys.exit(1)
 
                 # if backup dir isn't set for the current platform, error out
                 if sys.platform == "darwin" and macos_backup_dir == "":
                     logger.error(
-                        "<red>Backup directory not set in config file for macOS. Please set the macos_backup_dir in the config file.</red>"
+                        "<red>Backup directory not set in config file for macOS."
+                        " Please set the macos_backup_dir in the config file.</red>"
                     )
                     sys.exit(1)
                 elif sys.platform == "linux" and linux_backup_dir == "":
                     logger.error(
-                        "<red>Backup directory not set in config file for Linux. Please set the linux_backup_dir in the config file.</red>"
+                        "<red>Backup directory not set in config file for Linux."
+                        " Please set the linux_backup_dir in the config file.</red>"
                     )
                     sys.exit(1)
-                
-
 
                 return cls(
                     git_remote_url=git_remote_url,
@@ -89,6 +158,23 @@ class SpotifySnapshotConfig:
                     linux_backup_dir=linux_backup_dir,
                     backup_interval_hours=config_data.get("backup_interval_hours", 8),
                     ssh_key_name=ssh_key_name if ssh_key_name else None,
+                    playlist_fetch_workers=config_data.get("playlist_fetch_workers", 4),
+                    full_sync_interval_hours=config_data.get(
+                        "full_sync_interval_hours", 168
+                    ),
+                    http_cache_max_mb=config_data.get("http_cache_max_mb", 64),
+                    git_backend=git_backend,
+                    maintenance_interval_hours=config_data.get(
+                        "maintenance_interval_hours", 24
+                    ),
+                    maintenance_max_loose_objects=config_data.get(
+                        "maintenance_max_loose_objects", 1000
+                    ),
+                    maintenance_max_packs=config_data.get("maintenance_max_packs", 20),
+                    clone_strategy=clone_strategy,
+                    clone_depth=clone_depth,
+                    playlists_layout=playlists_layout,
+                    parquet_export=config_data.get("parquet_export", False),
                 )
             except tomllib.TOMLDecodeError as e:
                 # Log error and return default config
@@ -105,7 +191,9 @@ class SpotifySnapshotConfig:
         # Get git remote URL and ensure it's SSH
         while True:
             git_remote_url = Prompt.ask(
-                "(optional) Enter your Git remote URL. Must be an SSH URL (starts with git@)", default=""
+                "(optional) Enter your Git remote URL. Must be an SSH URL (starts"
+                " with git@)",
+                default="",
             )
             if not git_remote_url:
                 break
@@ -123,7 +211,7 @@ class SpotifySnapshotConfig:
             for f in ssh_dir.iterdir()
             if f.is_file()
             and not f.name.endswith(".pub")
-            and not f.name in ["known_hosts", "config"]
+            and f.name not in ["known_hosts", "config"]
         ]
 
         if not ssh_keys:
@@ -145,7 +233,8 @@ class SpotifySnapshotConfig:
         default_backup_dir = str(Path.home() / ".local/share/spotify-snapshots")
 
         backup_dir = Prompt.ask(
-            f"Enter the {'macOS' if sys.platform == 'darwin' else 'Linux'} backup directory path",
+            f"Enter the {'macOS' if sys.platform == 'darwin' else 'Linux'} backup"
+            " directory path",
             default=default_backup_dir,
         )
 
@@ -180,6 +269,17 @@ class SpotifySnapshotConfig:
             "linux_backup_dir": str(config.linux_backup_dir),
             "backup_interval_hours": config.backup_interval_hours,
             "ssh_key_name": config.ssh_key_name,
+            "playlist_fetch_workers": config.playlist_fetch_workers,
+            "full_sync_interval_hours": config.full_sync_interval_hours,
+            "http_cache_max_mb": config.http_cache_max_mb,
+            "git_backend": config.git_backend,
+            "maintenance_interval_hours": config.maintenance_interval_hours,
+            "maintenance_max_loose_objects": config.maintenance_max_loose_objects,
+            "maintenance_max_packs": config.maintenance_max_packs,
+            "clone_strategy": config.clone_strategy,
+            "clone_depth": config.clone_depth,
+            "playlists_layout": config.playlists_layout,
+            "parquet_export": config.parquet_export,
         }
 
         with open(config_path, "wb") as f:
@@ -196,3 +296,9 @@ class SpotifySnapshotConfig:
             "XDG_CONFIG_HOME", str(Path.home() / ".config")
         )
         return Path(xdg_config_home) / "spotify-snapshot.toml"
+
+    @staticmethod
+    def get_cache_dir() -> Path:
+        """Get the directory for files that are safe to delete, like the auth cache."""
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME", str(Path.home() / ".cache"))
+        return Path(xdg_cache_home) / "spotify-backup"
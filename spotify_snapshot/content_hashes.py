@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from spotify_snapshot.config import SpotifySnapshotConfig
+from spotify_snapshot.logging import get_colorized_logger
+
+logger = get_colorized_logger()
+
+
+@dataclass
+class FileContentHash:
+    # SHA-256 of the file's contents, as hex
+    sha256: str
+    # What the file looked like on disk right after it was written
+    size: int
+    mtime_ns: int
+
+
+class ContentHashStore:
+    """
+    Remembers a hash of every output file written, so that a file whose contents
+    come out the same as last time isn't written again. A hash is only trusted while
+    the file's size and modification time are still what they were after it was
+    written, so a file that was changed or replaced by anything else gets rewritten.
+
+    Does nothing until loaded, so code that writes files outside of a backup run
+    (like the benchmarks) always writes them.
+    """
+
+    def __init__(self) -> None:
+        self.path: Path | None = None
+        self._hashes: dict[str, FileContentHash] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_default_path() -> Path:
+        return SpotifySnapshotConfig.get_cache_dir() / "content_hashes.json"
+
+    def load(self, path: Path | None = None) -> None:
+        path = path or self.get_default_path()
+        hashes = {}
+        if path.exists():
+            try:
+                with open(path, encoding="utf-8") as f:
+                    hashes = {
+                        key: FileContentHash(**file_hash)
+                        for key, file_hash in json.load(f).items()
+                    }
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning(
+                    f"<yellow>Could not read content hashes at {path}, every file"
+                    f" will be written: {e}</yellow>"
+                )
+        with self._lock:
+            self.path = path
+            self._hashes = hashes
+
+    def is_unchanged(self, file_path: Path, sha256: str) -> bool:
+        """Whether file_path already has contents with this hash."""
+        if self.path is None:
+            return False
+        with self._lock:
+            file_hash = self._hashes.get(str(file_path.resolve()))
+        if file_hash is None or file_hash.sha256 != sha256:
+            return False
+        try:
+            stat = file_path.stat()
+        except OSError:
+            return False
+        return stat.st_size == file_hash.size and stat.st_mtime_ns == file_hash.mtime_ns
+
+    def set(self, file_path: Path, sha256: str) -> None:
+        """Record the hash of a file that was just written."""
+        if self.path is None:
+            return
+        stat = file_path.stat()
+        with self._lock:
+            self._hashes[str(file_path.resolve())] = FileContentHash(
+                sha256=sha256, size=stat.st_size, mtime_ns=stat.st_mtime_ns
+            )
+
+    def remove(self, file_path: Path) -> None:
+        with self._lock:
+            self._hashes.pop(str(file_path.resolve()), None)
+
+    def save(self) -> None:
+        """
+        Write every hash to disk. If a run crashes before this, the files it wrote just
+        get written again next time.
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.path.with_name(f".{self.path.name}.tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {key: asdict(file_hash) for key, file_hash in self._hashes.items()},
+                    f,
+                )
+            os.replace(temp_path, self.path)
+
+
+# Shared by everything that writes output files
+content_hashes = ContentHashStore()
@@ -2,3 +2,10 @@ class InvalidSpotifyCredentialsError(Exception):
     """Raised when Spotify credentials are invalid or authentication fails."""
 
     pass
+
+
+class IncompleteFetchError(Exception):
+    """Raised when some of a collection couldn't be fetched, so backing it up would
+    write an incomplete copy of it."""
+
+    pass
@@ -0,0 +1,303 @@
+"""
+A store of what was in each collection (liked songs, saved albums, the list of
+playlists, and each playlist's tracks) in every snapshot, as sorted NumPy arrays of
+64-bit hashes of the IDs in it. Comparing snapshots is then a vectorized set
+operation on arrays that are memory-mapped from disk, rather than a diff of text
+files read out of git.
+
+An array is written for each version of a TSV file, named after its blob SHA, so a
+file that didn't change between snapshots shares its array. Which version of each
+collection every snapshot has is kept in an append-only log, with a line for each
+commit that changed any of them.
+
+NumPy is an optional dependency, installed with the `fingerprints` extra.
+"""
+
+import csv
+import hashlib
+import importlib.util
+import io
+import json
+import os
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import git
+
+from spotify_snapshot import git_plumbing, history_log
+from spotify_snapshot.logging import get_colorized_logger
+
+_IS_NUMPY_INSTALLED = importlib.util.find_spec("numpy") is not None
+if TYPE_CHECKING or _IS_NUMPY_INSTALLED:
+    import numpy as np
+    import numpy.typing as npt
+
+logger = get_colorized_logger()
+
+ARRAYS_DIRNAME = "arrays"
+SNAPSHOTS_FILENAME = "snapshots.jsonl"
+# Arrays are kept in subdirectories named after the start of their blob SHA, like
+# git's loose objects, so that no one directory gets too big
+ARRAY_SHARD_LENGTH = 2
+# Little-endian, so that arrays can be memory-mapped on any machine
+FINGERPRINT_DTYPE = "<u8"
+FINGERPRINT_SIZE = 8
+
+
+def is_numpy_installed() -> bool:
+    return _IS_NUMPY_INSTALLED
+
+
+def fingerprint_ids(ids: Iterable[str]) -> "npt.NDArray[np.uint64]":
+    """The sorted, unique 64-bit hashes of ids."""
+    digests = b"".join(
+        hashlib.blake2b(item_id.encode("utf-8"), digest_size=FINGERPRINT_SIZE).digest()
+        for item_id in ids
+    )
+    return np.unique(np.frombuffer(digests, dtype=FINGERPRINT_DTYPE))
+
+
+def _read_ids(data: bytes) -> list[str]:
+    """The ID (in the last column) of every row of a TSV file, except the header."""
+    rows = csv.reader(io.StringIO(data.decode("utf-8"), newline=""), delimiter="\t")
+    next(rows, None)
+    return [row[-1] for row in rows if row and row[-1]]
+
+
+@dataclass
+class Snapshot:
+    hexsha: str
+    # Seconds since the epoch
+    committed_at: int
+    # The blob SHA of each collection that changed in this snapshot, or None for
+    # collections that were removed
+    changed_blobs: dict[str, str | None]
+
+
+@dataclass
+class CollectionChurn:
+    hexsha: str
+    committed_at: int
+    # How many items the collection had in this snapshot
+    size: int
+    added: int
+    removed: int
+
+
+class FingerprintStore:
+    def __init__(
+        self, path: Path, snapshots: list[Snapshot], is_log_damaged: bool = False
+    ):
+        self.path = path
+        # Oldest first
+        self.snapshots = snapshots
+        # Whether the snapshots log has a partly written line at the end
+        self.is_log_damaged = is_log_damaged
+
+    @staticmethod
+    def get_path(repo_filepath: Path) -> Path:
+        """The store is kept next to the snapshots repo, rather than in it."""
+        return repo_filepath.with_name(f"{repo_filepath.name}-fingerprints")
+
+    @classmethod
+    def open(cls, path: Path) -> "FingerprintStore":
+        """Opens the store at path, creating it if it doesn't exist."""
+        (path / ARRAYS_DIRNAME).mkdir(parents=True, exist_ok=True)
+        snapshots = []
+        is_log_damaged = False
+        snapshots_path = path / SNAPSHOTS_FILENAME
+        if snapshots_path.exists():
+            with open(snapshots_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        snapshots.append(Snapshot(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        # An update was interrupted while writing this line, so it
+                        # and anything after it are read again on the next update
+                        is_log_damaged = True
+                        break
+        return cls(path, snapshots, is_log_damaged)
+
+    @property
+    def last_snapshot_commit(self) -> str | None:
+        return self.snapshots[-1].hexsha if self.snapshots else None
+
+    def _get_array_path(self, blob_hexsha: str) -> Path:
+        return (
+            self.path
+            / ARRAYS_DIRNAME
+            / blob_hexsha[:ARRAY_SHARD_LENGTH]
+            / f"{blob_hexsha}.npy"
+        )
+
+    def get_fingerprints(self, blob_hexsha: str | None) -> "npt.NDArray[np.uint64]":
+        """
+        The fingerprints of the items in a version of a collection, memory-mapped
+        from disk. A removed collection (None) has none.
+        """
+        if blob_hexsha is None:
+            return np.empty(0, dtype=FINGERPRINT_DTYPE)
+        fingerprints: npt.NDArray[np.uint64] = np.load(
+            self._get_array_path(blob_hexsha), mmap_mode="r"
+        )
+        return fingerprints
+
+    def _write_fingerprints_if_missing(self, repo: git.Repo, blob_hexsha: str) -> None:
+        array_path = self._get_array_path(blob_hexsha)
+        if array_path.exists():
+            return
+        fingerprints = fingerprint_ids(
+            _read_ids(repo.odb.stream(bytes.fromhex(blob_hexsha)).read())
+        )
+        array_path.parent.mkdir(exist_ok=True)
+        # Written to a temporary file first, so that an interrupted update never
+        # leaves a partial array behind
+        temp_path = array_path.with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            np.save(f, fingerprints)
+        os.replace(temp_path, array_path)
+
+    def update(self, repo: git.Repo) -> int:
+        """
+        Adds a snapshot for each commit since the last one in the store that
+        changed any collections.
+
+        Returns:
+            How many snapshots were added
+        """
+        head_commit = git_plumbing.get_head_commit(repo)
+        if head_commit is None or head_commit.hexsha == self.last_snapshot_commit:
+            return 0
+        snapshots_path = self.path / SNAPSHOTS_FILENAME
+        since_hexsha = self.last_snapshot_commit
+        if since_hexsha is not None and not git_plumbing.is_in_history(
+            repo, since_hexsha, head_commit.hexsha
+        ):
+            logger.warning(
+                f"<yellow>Commit {since_hexsha} isn't in the snapshots repo's history"
+                " any more, so rebuilding the fingerprint store</yellow>"
+            )
+            # Arrays are named after what's in them, so they're all still right
+            self.snapshots = []
+            since_hexsha = None
+            self.is_log_damaged = True
+        if self.is_log_damaged:
+            with open(snapshots_path, "w", encoding="utf-8") as f:
+                f.writelines(
+                    json.dumps(asdict(snapshot)) + "\n" for snapshot in self.snapshots
+                )
+            self.is_log_damaged = False
+
+        added_snapshot_count = 0
+        with open(snapshots_path, "a", encoding="utf-8") as f:
+            for changes in history_log.iter_commit_file_changes(repo, since_hexsha):
+                changed_blobs: dict[str, str | None] = {}
+                # Removals first, since a playlist whose file was renamed or moved
+                # is removed from its old path and added at its new one
+                for path, blob_hexsha in sorted(
+                    changes.blob_hexshas.items(), key=lambda item: item[1] is not None
+                ):
+                    collection = history_log.get_collection(path)
+                    if collection is None:
+                        continue
+                    if blob_hexsha is not None:
+                        self._write_fingerprints_if_missing(repo, blob_hexsha)
+                    changed_blobs[collection] = blob_hexsha
+                if not changed_blobs:
+                    continue
+                snapshot = Snapshot(
+                    hexsha=changes.hexsha,
+                    committed_at=changes.committed_at,
+                    changed_blobs=changed_blobs,
+                )
+                # Each line is only written once its arrays are, so the log never
+                # refers to an array that doesn't exist
+                f.write(json.dumps(asdict(snapshot)) + "\n")
+                f.flush()
+                self.snapshots.append(snapshot)
+                added_snapshot_count += 1
+        return added_snapshot_count
+
+    def get_collections(self) -> set[str]:
+        """Every collection that's in any snapshot."""
+        return {
+            collection
+            for snapshot in self.snapshots
+            for collection in snapshot.changed_blobs
+        }
+
+    def _get_versions(self, collection: str) -> list[tuple[Snapshot, str | None]]:
+        """The snapshots that changed a collection, and its blob SHA in each."""
+        return [
+            (snapshot, snapshot.changed_blobs[collection])
+            for snapshot in self.snapshots
+            if collection in snapshot.changed_blobs
+        ]
+
+    def get_churn(self, collection: str) -> list[CollectionChurn]:
+        """
+        How many items were added to and removed from a collection in each snapshot
+        that changed which items it has, oldest first.
+        """
+        churn = []
+        previous = self.get_fingerprints(None)
+        for snapshot, blob_hexsha in self._get_versions(collection):
+            current = self.get_fingerprints(blob_hexsha)
+            added = np.setdiff1d(current, previous, assume_unique=True).size
+            removed = np.setdiff1d(previous, current, assume_unique=True).size
+            if added or removed:
+                churn.append(
+                    CollectionChurn(
+                        hexsha=snapshot.hexsha,
+                        committed_at=snapshot.committed_at,
+                        size=current.size,
+                        added=added,
+                        removed=removed,
+                    )
+                )
+            previous = current
+        return churn
+
+    def count_distinct_items(self, collection: str) -> int:
+        """How many different items a collection has had across every snapshot."""
+        blob_hexshas = {
+            blob_hexsha
+            for _, blob_hexsha in self._get_versions(collection)
+            if blob_hexsha is not None
+        }
+        if not blob_hexshas:
+            return 0
+        return np.unique(
+            np.concatenate([self.get_fingerprints(blob) for blob in blob_hexshas])
+        ).size
+
+
+def update_fingerprint_store_if_enabled(repo: git.Repo, repo_filepath: Path) -> None:
+    """
+    Adds the new snapshot to the fingerprint store after a backup, if it's been
+    created with `spotify-snapshot fingerprints`.
+    """
+    store_path = FingerprintStore.get_path(repo_filepath)
+    if not store_path.exists():
+        return
+    if not is_numpy_installed():
+        logger.warning(
+            "<yellow>Not updating the fingerprint store, since NumPy isn't installed."
+            " Install spotify-snapshot[fingerprints] to keep it up to date</yellow>"
+        )
+        return
+    try:
+        store = FingerprintStore.open(store_path)
+        added_snapshot_count = store.update(repo)
+    # The backup's been committed by now, and the store can be updated later, so
+    # no file that can't be read or parsed (which includes UnicodeDecodeError, a
+    # ValueError) should stop it from being pushed
+    except (OSError, ValueError, IndexError, git.GitCommandError) as e:
+        logger.warning(f"<yellow>Could not update the fingerprint store: {e}</yellow>")
+        return
+    logger.info(
+        f"<green>Added {added_snapshot_count} snapshots to the fingerprint"
+        " store</green>"
+    )
@@ -0,0 +1,283 @@
+"""
+Commits snapshots by writing objects straight into the repo's object database,
+instead of staging the whole working tree with `git add -A` and running `git commit`.
+
+Only the files a run wrote are hashed, and only the trees containing them are
+rebuilt, so committing takes time proportional to what changed rather than to the
+size of the library. The commit is made with `git commit-tree` and HEAD moved with
+`git update-ref`, and afterwards only the changed paths are refreshed in the index.
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+from collections.abc import Iterable
+from pathlib import Path
+
+import git
+from gitdb import LooseObjectDB
+from gitdb.base import IStream
+
+# Modes are kept as they're written in tree objects, so trees can be read and
+# written without converting every entry
+BLOB_MODE = b"100644"
+TREE_MODE = b"40000"
+# Git knows this tree without it having to exist in the repo
+EMPTY_TREE_HEXSHA = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+NULL_HEXSHA = "0" * 40
+
+# Where paths written by a run are saved until they're committed
+WRITTEN_FILES_JOURNAL_FILENAME = "spotify-snapshot-written-files"
+
+
+def get_written_files_journal_path(repo: git.Repo) -> Path:
+    return Path(repo.git_dir) / WRITTEN_FILES_JOURNAL_FILENAME
+
+
+def hash_blob(data: bytes) -> bytes:
+    """The binary SHA git gives a blob of data, without storing it."""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).digest()
+
+
+def get_loose_object_db(repo: git.Repo) -> LooseObjectDB:
+    # repo.odb would run `git hash-object` for every object it stores, which is far
+    # slower than compressing and writing them here
+    return LooseObjectDB(os.path.join(repo.common_dir, "objects"))
+
+
+def _store_object(object_db: LooseObjectDB, object_type: bytes, data: bytes) -> bytes:
+    return bytes(
+        object_db.store(IStream(object_type, len(data), io.BytesIO(data))).binsha
+    )
+
+
+def _read_tree_entries(
+    repo: git.Repo, tree_binsha: bytes | None
+) -> dict[bytes, tuple[bytes, bytes]]:
+    """The (binary SHA, mode) of each entry in a tree, by name."""
+    if tree_binsha is None:
+        return {}
+    # Each entry is "<mode> <name>\0<20 byte SHA>"
+    data = repo.odb.stream(tree_binsha).read()
+    entries = {}
+    start = 0
+    while start < len(data):
+        space = data.index(b" ", start)
+        nul = data.index(b"\0", space)
+        name_start, binsha_start, binsha_end = space + 1, nul + 1, nul + 21
+        entries[data[name_start:nul]] = (
+            data[binsha_start:binsha_end],
+            data[start:space],
+        )
+        start = binsha_end
+    return entries
+
+
+def _serialize_tree(entries: dict[bytes, tuple[bytes, bytes]]) -> bytes:
+    # Git sorts trees as if their names ended in a slash
+    sorted_names = sorted(
+        entries, key=lambda name: name + b"/" if entries[name][1] == TREE_MODE else name
+    )
+    return b"".join(
+        entries[name][1] + b" " + name + b"\0" + entries[name][0]
+        for name in sorted_names
+    )
+
+
+def write_tree(
+    repo: git.Repo,
+    object_db: LooseObjectDB,
+    base_tree_binsha: bytes | None,
+    changes: dict[bytes, bytes | None],
+    changed_paths: list[bytes],
+    path_prefix: bytes = b"",
+) -> bytes | None:
+    """
+    Writes a copy of the tree base_tree_binsha with changes applied, and returns its
+    binary SHA, or None if nothing's left in it. Subtrees without any changes are
+    reused as they are, without being read.
+
+    Args:
+        object_db: Where to store new blobs and trees
+        changes: New contents of each file that may have changed, by its path
+            relative to the tree (as bytes, like git stores paths), or None for
+            files that have been deleted
+        changed_paths: Where to add the path of every file that actually changed
+    """
+    entries = _read_tree_entries(repo, base_tree_binsha)
+    changes_by_subtree: dict[bytes, dict[bytes, bytes | None]] = {}
+    is_changed = False
+
+    for path, data in changes.items():
+        name, is_nested, path_in_subtree = path.partition(b"/")
+        if is_nested:
+            changes_by_subtree.setdefault(name, {})[path_in_subtree] = data
+            continue
+        existing_entry = entries.get(name)
+        if data is None:
+            if existing_entry is not None:
+                del entries[name]
+                changed_paths.append(path_prefix + name)
+                is_changed = True
+            continue
+        binsha = hash_blob(data)
+        if existing_entry is not None and existing_entry[0] == binsha:
+            continue
+        _store_object(object_db, b"blob", data)
+        # Keep the mode of files that were already there, e.g. if one's executable
+        mode = (
+            existing_entry[1]
+            if existing_entry is not None and existing_entry[1] != TREE_MODE
+            else BLOB_MODE
+        )
+        entries[name] = (binsha, mode)
+        changed_paths.append(path_prefix + name)
+        is_changed = True
+
+    for name, subtree_changes in changes_by_subtree.items():
+        existing_entry = entries.get(name)
+        existing_subtree_binsha = (
+            existing_entry[0]
+            if existing_entry is not None and existing_entry[1] == TREE_MODE
+            else None
+        )
+        subtree_binsha = write_tree(
+            repo,
+            object_db,
+            existing_subtree_binsha,
+            subtree_changes,
+            changed_paths,
+            path_prefix=path_prefix + name + b"/",
+        )
+        if subtree_binsha == existing_subtree_binsha:
+            continue
+        if subtree_binsha is None:
+            # Like git, don't keep empty directories around
+            del entries[name]
+        else:
+            entries[name] = (subtree_binsha, TREE_MODE)
+        is_changed = True
+
+    if not is_changed:
+        return base_tree_binsha
+    if not entries:
+        return None
+
+    return _store_object(object_db, b"tree", _serialize_tree(entries))
+
+
+def get_head_commit(repo: git.Repo) -> git.Commit | None:
+    try:
+        return repo.head.commit
+    except ValueError:  # No commits yet
+        return None
+
+
+def is_in_history(repo: git.Repo, hexsha: str, head_hexsha: str) -> bool:
+    """Whether the commit hexsha is head_hexsha or one of its ancestors."""
+    try:
+        return repo.is_ancestor(repo.commit(hexsha), repo.commit(head_hexsha))
+    except (git.GitCommandError, ValueError):  # The commit doesn't exist any more
+        return False
+
+
+def _get_working_tree_dir(repo: git.Repo) -> Path:
+    if repo.working_tree_dir is None:
+        raise ValueError(f"{repo.git_dir} is a bare repo, with no files to commit")
+    return Path(repo.working_tree_dir).absolute()
+
+
+def get_repo_relative_paths(repo: git.Repo, paths: Iterable[Path]) -> list[str]:
+    """The paths in the repo's working tree, relative to it. Others are left out."""
+    repo_dir = _get_working_tree_dir(repo)
+    git_dir = Path(repo.git_dir).absolute()
+    return sorted(
+        path.relative_to(repo_dir).as_posix()
+        for path in paths
+        if path.is_relative_to(repo_dir) and not path.is_relative_to(git_dir)
+    )
+
+
+def write_tree_from_files(repo: git.Repo, paths: set[Path]) -> tuple[str, list[str]]:
+    """
+    Builds a copy of HEAD's tree with the current contents of paths, leaving out any
+    that don't exist any more. Paths outside the repo are ignored.
+
+    Returns:
+        The new tree's SHA, and the paths (relative to the repo) of every file whose
+        contents differ from HEAD
+    """
+    repo_dir = _get_working_tree_dir(repo)
+    head_commit = get_head_commit(repo)
+    head_tree = head_commit.tree if head_commit is not None else None
+
+    changes: dict[bytes, bytes | None] = {}
+    for relative_path in get_repo_relative_paths(repo, paths):
+        path = repo_dir / relative_path
+        if path.is_file():
+            changes[os.fsencode(relative_path)] = path.read_bytes()
+        elif not path.exists():
+            changes[os.fsencode(relative_path)] = None
+
+    changed_paths: list[bytes] = []
+    tree_binsha = write_tree(
+        repo,
+        get_loose_object_db(repo),
+        head_tree.binsha if head_tree is not None else None,
+        changes,
+        changed_paths,
+    )
+    tree_hexsha = tree_binsha.hex() if tree_binsha is not None else EMPTY_TREE_HEXSHA
+    return tree_hexsha, [os.fsdecode(path) for path in sorted(changed_paths)]
+
+
+def commit_tree(repo: git.Repo, tree_hexsha: str, message: str, sign: bool) -> str:
+    """
+    Commits tree_hexsha on top of HEAD and moves HEAD (or the branch it points to)
+    to the new commit.
+
+    Args:
+        sign: Whether to sign the commit, if commit.gpgSign is set. Unlike `git
+            commit`, `git commit-tree` doesn't check that setting itself
+
+    Returns:
+        The new commit's SHA
+    """
+    head_commit = get_head_commit(repo)
+    args = [tree_hexsha]
+    if head_commit is not None:
+        args += ["-p", head_commit.hexsha]
+    if sign and repo.config_reader().get_value("commit", "gpgsign", False):
+        args.append("-S")
+    commit_hexsha = str(repo.git.commit_tree(*args, "-m", message))
+
+    subject = message.split("\n", 1)[0]
+    reflog_message = (
+        f"commit: {subject}"
+        if head_commit is not None
+        else f"commit (initial): {subject}"
+    )
+    # Passing the old SHA makes this fail, rather than lose a commit, if something
+    # else committed in the meantime
+    repo.git.update_ref(
+        "-m",
+        reflog_message,
+        "HEAD",
+        commit_hexsha,
+        head_commit.hexsha if head_commit is not None else NULL_HEXSHA,
+    )
+    return commit_hexsha
+
+
+def update_index(repo: git.Repo, relative_paths: list[str]) -> None:
+    """
+    Brings just these paths in the index up to date with the working tree, adding
+    new files and removing deleted ones, without looking at any other file.
+    """
+    if not relative_paths:
+        return
+    with tempfile.TemporaryFile() as paths_file:
+        paths_file.write(b"".join(os.fsencode(path) + b"\0" for path in relative_paths))
+        paths_file.seek(0)
+        repo.git.update_index("--add", "--remove", "-z", "--stdin", istream=paths_file)
@@ -1,22 +1,31 @@
+import csv
+import io
 import os
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
 from sys import exit
+from typing import Any
 
 import git
-from git import Commit, NoSuchPathError
+from git import NoSuchPathError
 from rich.prompt import Prompt
 
-from spotify_snapshot import spotify
-from spotify_snapshot.spotify import DeletedPlaylist
-from spotify_snapshot.spotify_datatypes import DeletedPlaylist
+from spotify_snapshot.playlist_manifest import (
+    PlaylistChanges,
+    PlaylistManifest,
+    PlaylistManifestEntry,
+)
 from spotify_snapshot.spotify_snapshot_output_manager import (
     SpotifySnapshotOutputManager,
 )
 from .install import RUNNING_INSIDE_CRONTAB_ENV_VAR
 
+from . import git_plumbing, outputfileutils
 from .config import SpotifySnapshotConfig
 from .logging import get_colorized_logger
+from .profiling import profiler
+from .sync_state import SyncStateStore
 
 _repo_instance = None
 
@@ -59,15 +68,19 @@ def create_readme_if_missing(repo_filepath: Path) -> None:
         logger.info("Creating README.md file")
         with open(readme_path, "w", encoding="utf-8") as f:
             f.write(
-                """# Spotify Playlist Backup
-
-This repository contains automated backups of your Spotify playlists and liked songs, created using [spotify-snapshot](https://github.com/alichtman/spotify-snapshot).
-
-Each playlist is stored as a TSV (Tab Separated Values) file in the `playlists` directory, and liked songs are stored in `liked_songs.tsv`.
-
-See the [README](https://github.com/alichtman/spotify-snapshot/blob/main/README.md) for more information."""
+                "# Spotify Playlist Backup\n\n"
+                "This repository contains automated backups of your Spotify playlists"
+                " and liked songs, created using [spotify-snapshot]"
+                "(https://github.com/alichtman/spotify-snapshot).\n\n"
+                "Each playlist is stored as a TSV (Tab Separated Values) file in the"
+                " `playlists` directory, and liked songs are stored in"
+                " `liked_songs.tsv`.\n\n"
+                "See the [README]"
+                "(https://github.com/alichtman/spotify-snapshot/blob/main/README.md)"
+                " for more information."
             )
         logger.info("Created README.md file")
+        outputfileutils.written_files.add(readme_path)
 
 
 def setup_git_repo_if_needed(is_test_mode) -> Path:
@@ -80,7 +93,8 @@ def setup_git_repo_if_needed(is_test_mode) -> Path:
         if os.path.exists(repo_filepath) and os.path.exists(repo_filepath / ".git"):
             repo = git.Repo(repo_filepath)
             logger.info(
-                f"<yellow>Found existing repo at</yellow> <green><bold>{repo_filepath}</bold></green>"
+                "<yellow>Found existing repo at</yellow>"
+                f" <green><bold>{repo_filepath}</bold></green>"
             )
             create_readme_if_missing(repo_filepath)
         else:
@@ -90,28 +104,40 @@ def setup_git_repo_if_needed(is_test_mode) -> Path:
         if config.git_remote_url:
             try:
                 logger.info(
-                    f"Cloning repo from <blue>{config.git_remote_url}</blue> to <green>{str(repo_filepath).strip()}</green>"
+                    f"Cloning repo from <blue>{config.git_remote_url}</blue> to"
+                    f" <green>{str(repo_filepath).strip()}</green>"
                 )
-                repo = git.Repo.clone_from(config.git_remote_url, repo_filepath)
-                # Set up the remote properly after cloning
+                with profiler.phase("git_clone"):
+                    repo = clone_repo(config, repo_filepath)
+                # Set up the remote properly after cloning. The remote is kept
+                # rather than recreated, since its config says where a blobless
+                # clone fetches missing files from and which branch to fetch
                 if "origin" in [remote.name for remote in repo.remotes]:
-                    repo.delete_remote(repo.remote("origin"))
-                repo.create_remote("origin", config.git_remote_url)
+                    repo.remote("origin").set_url(config.git_remote_url)
+                else:
+                    repo.create_remote("origin", config.git_remote_url)
             except git.GitCommandError:
-                # If clone fails (e.g., empty remote), check if directory exists and is empty
+                # If clone fails (e.g., empty remote), check if directory exists and is
+                # empty
                 if os.path.exists(repo_filepath) and os.listdir(repo_filepath):
-                    error_msg = f"Cannot create repository: Directory {repo_filepath} already exists and is not empty. You will need to manually delete it or move it to a different location."
+                    error_msg = (
+                        f"Cannot create repository: Directory {repo_filepath} already"
+                        " exists and is not empty. You will need to manually delete it"
+                        " or move it to a different location."
+                    )
                     logger.error(f"<red>{error_msg}</red>")
                     raise ValueError(error_msg)
 
                 logger.info(
-                    f"<yellow>Remote repo is empty. Creating new local repo at</yellow> <green><bold>{repo_filepath}</bold></green>"
+                    "<yellow>Remote repo is empty. Creating new local repo at</yellow>"
+                    f" <green><bold>{repo_filepath}</bold></green>"
                 )
                 os.makedirs(repo_filepath, exist_ok=True)
                 git.Repo.init(repo_filepath)
         else:
             logger.info(
-                f"<yellow>No repo found, making a new one at</yellow> <green><bold>{repo_filepath}</bold></green>"
+                "<yellow>No repo found, making a new one at</yellow>"
+                f" <green><bold>{repo_filepath}</bold></green>"
             )
             os.makedirs(repo_filepath, exist_ok=True)
             git.Repo.init(repo_filepath)
@@ -120,6 +146,51 @@ def setup_git_repo_if_needed(is_test_mode) -> Path:
     return repo_filepath
 
 
+def get_clone_options(config: SpotifySnapshotConfig) -> dict[str, Any]:
+    """The options to pass to `git clone` for the configured clone strategy."""
+    if config.clone_strategy == "blobless":
+        return {"filter": "blob:none"}
+    if config.clone_strategy == "shallow":
+        # --depth implies --single-branch
+        return {"depth": config.clone_depth}
+    if config.clone_strategy == "single_branch":
+        return {"single_branch": True, "no_tags": True}
+    return {}
+
+
+def clone_repo(config: SpotifySnapshotConfig, repo_filepath: Path) -> git.Repo:
+    """
+    Clones config.git_remote_url using the configured clone strategy, so that a new
+    host doesn't have to download years of snapshots before it can back anything up.
+
+    Nothing else needs to know how the repo was cloned. A blobless clone fetches the
+    contents of old files from the remote the first time they're read, and pulling
+    into a shallow or single branch clone just fetches the new commits on top.
+    """
+    if config.git_remote_url is None:
+        raise ValueError("No git_remote_url is configured to clone from")
+    clone_options = get_clone_options(config)
+    if clone_options:
+        logger.info(
+            f"<blue>Making a {config.clone_strategy.replace('_', ' ')} clone</blue>"
+        )
+    ssh_key_path = config.ssh_key_path
+    env = (
+        {"GIT_SSH_COMMAND": f"ssh -i {ssh_key_path.expanduser()}"}
+        if ssh_key_path is not None and ssh_key_path.expanduser().exists()
+        else None
+    )
+    repo = git.Repo.clone_from(
+        config.git_remote_url, repo_filepath, env=env, **clone_options
+    )
+    if config.clone_strategy == "blobless" and env is not None:
+        # Missing files can be fetched by any git command, not just the ones run
+        # with GIT_SSH_COMMAND set, so they need to know which key to use too
+        with repo.config_writer() as repo_config:
+            repo_config.set_value("core", "sshCommand", env["GIT_SSH_COMMAND"])
+    return repo
+
+
 def cleanup_repo() -> None:
     """Clean up the git repository instance."""
     if _repo_instance is not None:
@@ -135,58 +206,70 @@ def commit_files(is_test_mode: bool, username: str) -> bool:
     logger = get_colorized_logger()
     logger.info("Committing files...")
     repo = get_repo(is_test_mode)
-
-    is_first_commit = False
-    try:
-        repo.head.commit
-    except ValueError:
-        is_first_commit = True
-
-    deleted_playlists = []
-    if not is_first_commit:
-        deleted_playlists = remove_deleted_playlists(repo)
-
-    # Add all changes to the index first
-    repo.git.add(A=True)
-
-    # Add debug logging
-    logger.debug(f"Untracked files: {repo.untracked_files}")
-    if not is_first_commit:
-        logger.debug(f"Index diff with HEAD: {list(repo.index.diff(repo.head.commit))}")
-    logger.debug(f"Index diff with None: {list(repo.index.diff(None))}")
-
-    # Check if there are any changes to commit
-    if is_first_commit:
-        has_changes = bool(repo.untracked_files) or bool(repo.index.diff(None))
+    config = SpotifySnapshotConfig.load()
+    use_plumbing = config.git_backend == "plumbing"
+
+    if use_plumbing:
+        # Only the files this run wrote can have changed, so there's no need to
+        # look at the rest of the working tree
+        with profiler.phase("git_write_tree"):
+            tree_hexsha, changed_paths = git_plumbing.write_tree_from_files(
+                repo, outputfileutils.written_files.get_paths()
+            )
+        with profiler.phase("get_changeset"):
+            changeset = get_tree_changeset(repo, tree_hexsha)
     else:
-        has_changes = bool(repo.index.diff(repo.head.commit)) or bool(
-            repo.untracked_files
-        )
+        # Stage just the files this run wrote, rather than `git add -A`, which has to
+        # look at every file in the repo
+        with profiler.phase("git_add"):
+            git_plumbing.update_index(
+                repo,
+                git_plumbing.get_repo_relative_paths(
+                    repo, outputfileutils.written_files.get_paths()
+                ),
+            )
+        with profiler.phase("get_changeset"):
+            changeset = get_staged_changeset(repo)
+    logger.debug(f"Changes to commit: {changeset.files}")
 
-    if not has_changes:
+    if not changeset.files:
         logger.info("<yellow>No changes to commit</yellow>")
+        outputfileutils.written_files.clear()
         return False
 
-    # A temp commit is needed to get stats etc - the library doesn't support it
-    # otherwise
-    commit = repo.index.commit("temp")
-    commit_message = get_commit_message_for_amending(
-        commit, deleted_playlists, username
-    )
+    with profiler.phase("commit_message"):
+        playlist_changes = get_playlist_changes(repo)
+        commit_message = get_commit_message(changeset, playlist_changes, username)
     logger.info(
         f"<green>Commit info:</green>\n\n<yellow><bold>{commit_message}</bold></yellow>"
     )
     try:
-        # If executing inside of crontab, don't sign commits (since we can't access GPG keys)
-        if os.getenv(RUNNING_INSIDE_CRONTAB_ENV_VAR, "0") == "1":
+        # If executing inside of crontab, don't sign commits (since we can't access
+        # GPG keys)
+        should_sign = os.getenv(RUNNING_INSIDE_CRONTAB_ENV_VAR, "0") != "1"
+        if not should_sign:
             logger.info("Running inside of crontab. Not signing commits.")
-            repo.git.commit("--amend", "-m", commit_message, "--no-gpg-sign")
         else:
             logger.info(
-                "Running outside of crontab. Signing commits (if that is configured in your gitconfig)!"
+                "Running outside of crontab. Signing commits (if that is configured"
+                " in your gitconfig)!"
             )
-            repo.git.commit("--amend", "-m", commit_message)
 
+        if use_plumbing:
+            with profiler.phase("git_commit"):
+                git_plumbing.commit_tree(
+                    repo, tree_hexsha, commit_message, sign=should_sign
+                )
+            with profiler.phase("git_update_index"):
+                git_plumbing.update_index(repo, changed_paths)
+        else:
+            with profiler.phase("git_commit"):
+                if should_sign:
+                    repo.git.commit("-m", commit_message)
+                else:
+                    repo.git.commit("-m", commit_message, "--no-gpg-sign")
+
+        outputfileutils.written_files.clear()
         logger.info("<green>Changes committed. All done!</green>")
         return True
     except git.GitCommandError as e:
@@ -196,231 +279,247 @@ def commit_files(is_test_mode: bool, username: str) -> bool:
         exit(1)
 
 
-def get_deleted_playlists(
-    repo: git.Repo,
-) -> list[DeletedPlaylist]:
+@dataclass
+class FileChange:
+    # Path of the file, or where it was renamed to
+    path: str
+    # First letter of git's status for the file: A, M, D, R, etc
+    change_type: str
+    insertions: int
+    deletions: int
+    # Where the file was renamed from, for renames
+    old_path: str | None = None
+
+
+@dataclass
+class Changeset:
+    """Everything that's staged to be committed, compared to HEAD."""
+
+    is_first_commit: bool
+    files: list[FileChange]
+
+
+# --raw says how each file changed, --numstat how many lines. -z leaves paths
+# unquoted, however odd the playlist names in them are
+DIFF_ARGS = ("--raw", "--numstat", "-z", "-M")
+
+
+def get_staged_changeset(repo: git.Repo) -> Changeset:
     """
-    Returns a list of playlists that were deleted in the working directory changes
+    Works out what's changed between HEAD and the index, with line counts and renames,
+    using a single `git diff`. Without a HEAD (before the first commit), everything in
+    the index counts as added.
     """
-    logger = get_colorized_logger()
-    output_manager = SpotifySnapshotOutputManager.get_instance()
+    is_first_commit = git_plumbing.get_head_commit(repo) is None
+    output = repo.git.diff("--cached", *DIFF_ARGS)
+    return Changeset(is_first_commit=is_first_commit, files=_parse_diff(output))
+
+
+def get_tree_changeset(repo: git.Repo, tree_hexsha: str) -> Changeset:
+    """Like get_staged_changeset, but for what's changed between HEAD and a tree."""
+    head_commit = git_plumbing.get_head_commit(repo)
+    head_tree_hexsha = (
+        head_commit.tree.hexsha
+        if head_commit is not None
+        else git_plumbing.EMPTY_TREE_HEXSHA
+    )
+    output = repo.git.diff_tree("-r", *DIFF_ARGS, head_tree_hexsha, tree_hexsha)
+    return Changeset(is_first_commit=head_commit is None, files=_parse_diff(output))
+
+
+def _parse_diff(output: str) -> list[FileChange]:
+    fields = output.split("\0")
+    changes: dict[str, FileChange] = {}
+    i = 0
+    while i < len(fields) and fields[i]:
+        field = fields[i]
+        if field.startswith(":"):
+            change_type = field.split()[-1][0]
+            if change_type in "RC":
+                old_path, path = fields[i + 1], fields[i + 2]
+                i += 3
+            else:
+                old_path, path = None, fields[i + 1]
+                i += 2
+            changes[path] = FileChange(
+                path=path,
+                change_type=change_type,
+                insertions=0,
+                deletions=0,
+                old_path=old_path,
+            )
+            continue
 
-    # Get the working directory changes for the playlists file
-    deleted_lines = []
-    diff = repo.head.commit.diff(None)
-    for diff_item in diff:
-        # Convert both paths to strings for comparison
-        if (
-            diff_item.a_path is not None
-            and output_manager.playlists_index_filename in diff_item.a_path
-        ):
-            # Read the old version of the file from the last commit
-            if diff_item.a_blob is not None:
-                old_content = (
-                    diff_item.a_blob.data_stream.read().decode("utf-8").splitlines()
-                )
-            # Read the current version from the working directory
-            with open(output_manager.playlists_index_path, encoding="utf-8") as f:
-                new_content = f.read().splitlines()
+        insertions, deletions, path = field.split("\t", 2)
+        if not path:
+            # Renames have their old and new paths after the counts
+            path = fields[i + 2]
+            i += 3
+        else:
+            i += 1
+        # Binary files have their counts as "-"
+        if path in changes and insertions != "-":
+            changes[path].insertions = int(insertions)
+            changes[path].deletions = int(deletions)
 
-            # Extract playlist IDs from both old and new content
-            old_playlist_ids = {
-                line.split("\t")[-1] for line in old_content if line.strip()
-            }
-            new_playlist_ids = {
-                line.split("\t")[-1] for line in new_content if line.strip()
-            }
+    return list(changes.values())
 
-            # Find playlists that were actually deleted (present in old but not in new)
-            deleted_playlist_ids = old_playlist_ids - new_playlist_ids
-
-            # Get the full playlist info for deleted playlists
-            deleted_lines = [
-                line
-                for line in old_content
-                if line.strip() and line.split("\t")[-1] in deleted_playlist_ids
-            ]
-            logger.info(f"\n<red>Found {len(deleted_lines)} deleted playlists</red>")
-
-    # Get the playlists that were deleted
-    deleted_playlists = []
-    for deleted_playlist in deleted_lines:
-        if not deleted_playlist.strip():  # Skip empty lines
-            continue
-        # Get the playlist name from the first column
-        playlist_name = deleted_playlist.split("\t")[0]
-        # Get the playlist ID from the last column
-        playlist_id = deleted_playlist.split("\t")[-1]
-        deleted_playlists.append(
-            spotify.DeletedPlaylist(name=playlist_name, id=playlist_id)
-        )
-    return deleted_playlists
 
+def get_tsv_row_count(tsv_path: Path) -> int:
+    """Number of rows in a TSV file we wrote, not counting the header."""
+    # Saved collections remember how many rows they wrote, which saves reading
+    # the file back in
+    sync_state = SyncStateStore.load().get(tsv_path)
+    if sync_state is not None:
+        return sync_state.row_count
+    with open(tsv_path, "rb") as f:
+        return sum(1 for _ in f) - 1
 
-def remove_deleted_playlists(
-    repo: git.Repo,
-) -> list[DeletedPlaylist]:
+
+def get_committed_playlist_manifest(repo: git.Repo) -> PlaylistManifest:
     """
-    Removes the playlists that were deleted in the staged changes
-    Returns: List of deleted playlists
+    Returns the playlist manifest as of HEAD. Snapshots from before there was a
+    manifest only have the playlists index, so the names and IDs in that are used.
     """
-    logger = get_colorized_logger()
+    output_manager = SpotifySnapshotOutputManager.get_instance()
     try:
-        _ = repo.head.commit  # Check if there are any commits
+        tree = repo.head.commit.tree
     except ValueError:  # No commits yet
-        logger.info("<yellow>First commit detected. No playlists to delete.</yellow>")
-        return []
+        return PlaylistManifest()
 
-    deleted_playlists = get_deleted_playlists(repo)
-    for playlist in deleted_playlists:
-        file_path_to_remove = spotify.get_playlist_file_name(playlist)
-        logger.info(f"<red>Deleting <bold>{file_path_to_remove}</bold></red>")
-        os.remove(file_path_to_remove)
-    return deleted_playlists
+    try:
+        manifest_blob = tree[output_manager.playlists_manifest_filename]
+    except KeyError:
+        pass
+    else:
+        try:
+            return PlaylistManifest.from_json(manifest_blob.data_stream.read())
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(
+                "<yellow>Could not read the committed playlist manifest, falling back"
+                f" to the playlists index: {e}</yellow>"
+            )
+
+    manifest = PlaylistManifest()
+    try:
+        index_blob = tree[output_manager.playlists_index_filename]
+    except KeyError:
+        return manifest
+    index_rows = csv.reader(
+        io.StringIO(index_blob.data_stream.read().decode("utf-8"), newline=""),
+        delimiter="\t",
+    )
+    next(index_rows, None)
+    for row in index_rows:
+        if row:
+            # Playlist name is the first column, and ID the last
+            manifest.entries[row[-1]] = PlaylistManifestEntry(
+                snapshot_id="", file=None, name=row[0]
+            )
+    return manifest
+
+
+def get_playlist_changes(repo: git.Repo) -> PlaylistChanges:
+    """
+    Works out which playlists were created, deleted and renamed since the last commit,
+    by comparing the IDs in the playlist manifest with the ones in the manifest in HEAD.
+    """
+    output_manager = SpotifySnapshotOutputManager.get_instance()
+    manifest = PlaylistManifest.load(output_manager.playlists_manifest_path)
+    playlist_changes = manifest.get_changes_since(get_committed_playlist_manifest(repo))
+    logger.info(
+        "<green>Playlists since the last snapshot:</green>"
+        f" {len(playlist_changes.created)} created,"
+        f" {len(playlist_changes.deleted)} deleted,"
+        f" {len(playlist_changes.renamed)} renamed"
+    )
+    return playlist_changes
 
 
-# TODO: This method desperately needs some refactoring
-def get_commit_message_for_amending(
-    commit: Commit, deleted_playlists: list[DeletedPlaylist], username: str
+def get_commit_message(
+    changeset: Changeset, playlist_changes: PlaylistChanges, username: str
 ) -> str:
     """
-    Generate a contextually appropriate commit message (depending on whether this is the first commit or not)
-    If it is the first commit, the git commit is a status report on how many playlists were backed up, how many tracks per playlist, and how many liked songs were backed up
-    For all commits after, the git commit is a status report on how many playlists were added, removed, and how many tracks were added, removed
+    Generate a contextually appropriate commit message (depending on whether this is
+    the first commit or not)
+    If it is the first commit, the git commit is a status report on how many playlists
+    were backed up, how many tracks per playlist, and how many liked songs were backed
+    up
+    For all commits after, the git commit is a status report on how many playlists
+    were added, removed, and how many tracks were added, removed
     """
     output_manager = SpotifySnapshotOutputManager.get_instance()
-    is_first_commit = len(commit.parents) == 0
+    is_first_commit = changeset.is_first_commit
     current_time = datetime.now(tz=timezone.utc).strftime("%m/%d/%Y, %H:%M:%S %Z")
     if is_first_commit:
         commit_title = f"Initial Spotify Snapshot - {username} - {current_time}"
     else:
         commit_title = f"Spotify Snapshot - {username} - {current_time}"
-    stats = commit.stats
-    playlist_stats: dict[str, int | dict[str, int]] = {}
-    liked_songs_add_remove_stats: int | dict[str, int] | None = None
+    # Rows added to and removed from each file. On the first commit, every row but
+    # the header is an addition
+    playlist_stats: dict[str, dict[str, int]] = {}
+    liked_songs_add_remove_stats: dict[str, int] | None = None
 
     # Process playlist files and liked songs
-    for changed_file in stats.files:
-        file_stats = stats.files[changed_file]
-
+    for change in changeset.files:
         # Handle liked songs file
-        if str(output_manager.liked_songs_filename) == str(changed_file):
-            if is_first_commit:
-                liked_songs_add_remove_stats = (
-                    file_stats["insertions"] - 1
-                )  # Subtract header
-            else:
-                liked_songs_add_remove_stats = {
-                    "added": file_stats["insertions"],
-                    "removed": file_stats["deletions"],
-                }
+        if change.path == output_manager.liked_songs_filename:
+            liked_songs_add_remove_stats = {
+                "added": change.insertions,
+                "removed": change.deletions,
+            }
             continue
 
-        # Handle playlist files
-        if changed_file.startswith("playlists/"):
-            playlist_name = changed_file.split("/")[-1].replace(".tsv", "")
-            if is_first_commit:
-                playlist_stats[playlist_name] = (
-                    file_stats["insertions"] - 1
-                )  # Subtract header
-            else:
-                playlist_stats[playlist_name] = {
-                    "added": file_stats["insertions"],
-                    "removed": file_stats["deletions"],
-                }
-
-    # If liked songs file is present, grab the count of tracks
-    liked_songs_count = None
-    liked_songs_file = output_manager.liked_songs_path
-    if os.path.exists(liked_songs_file):
-        with open(liked_songs_file, encoding="utf-8") as f:
-            liked_songs_count = len(f.readlines()) - 1
+        # Handle playlist files, which may be in a shard directory inside playlists/
+        if change.path.startswith("playlists/"):
+            playlist_name = change.path.split("/")[-1].replace(".tsv", "")
+            playlist_stats[playlist_name] = {
+                "added": change.insertions,
+                "removed": change.deletions,
+            }
 
     commit_details = []
     # Always add Liked Songs section first if there is a liked songs file in the backup
     if liked_songs_add_remove_stats is not None:
+        liked_songs_count = get_tsv_row_count(output_manager.liked_songs_path)
         commit_details.append(f"Liked Songs        : {liked_songs_count} tracks")
 
         if not is_first_commit:
             commit_details.append(
-                f"Liked Songs Changes: +{liked_songs_add_remove_stats['added']}, -{liked_songs_add_remove_stats['removed']}"
+                f"Liked Songs Changes: +{liked_songs_add_remove_stats['added']},"
+                f" -{liked_songs_add_remove_stats['removed']}"
             )
 
     commit_details.append(f"Number of Playlists Changed: {len(playlist_stats)}")
 
     if is_first_commit:
         commit_details.append("\nPlaylist Details:")
-        for playlist, track_count in sorted(playlist_stats.items()):
-            commit_details.append(f"- {playlist}: {track_count} tracks")
+        for playlist_name, changes in sorted(playlist_stats.items()):
+            track_count = changes["added"] - 1  # Subtract header
+            commit_details.append(f"- {playlist_name}: {track_count} tracks")
     else:
-        # Add detection of renamed playlists
-        renamed_playlists = []
-        renamed_playlist_ids = set()  # Track IDs of renamed playlists
-
-        # Compare with parent commit to get changes
-        for diff_item in commit.diff(commit.parents[0] if commit.parents else None):
-            if (
-                diff_item.renamed_file
-                and diff_item.a_path is not None
-                and diff_item.b_path is not None
-                and diff_item.a_path.startswith("playlists/")
-            ):
-                # Extract everything before the last parenthetical for both old and new names
-                old_name = str(diff_item.a_path).split("/")[-1].rsplit(" (", 1)[0]
-                new_name = str(diff_item.b_path).split("/")[-1].rsplit(" (", 1)[0]
-                # Extract playlist ID from the filename
-                playlist_id = str(diff_item.a_path).rsplit("(", 1)[-1].rstrip(").tsv")
-                renamed_playlists.append((old_name, new_name))
-                renamed_playlist_ids.add(playlist_id)
-
-        # Filter out renamed playlists from deleted_playlists
-        filtered_deleted_playlists = [
-            playlist
-            for playlist in deleted_playlists
-            if playlist.id not in renamed_playlist_ids
-        ]
-
-        # Compare with parent commit to get changes
-        # TODO: This method is kind of a mess. Good enough though
-        created_playlists = []
-        for diff_item in commit.diff(commit.parents[0] if commit.parents else None):
-            if (
-                diff_item.b_path is not None
-                and diff_item.b_path.startswith("playlists/")
-                and diff_item.new_file  # This is crucial - file must be new
-                and not diff_item.renamed_file  # Not a rename
-                and
-                # Don't count a playlist as created if it's in the deleted_playlists list
-                not any(
-                    playlist.name in diff_item.b_path for playlist in deleted_playlists
-                )
-            ):
-                # Extract playlist name without the ID
-                playlist_name = diff_item.b_path.split("/")[-1].rsplit(" (", 1)[0]
-                created_playlists.append(playlist_name)
-
-        if created_playlists:
+        if playlist_changes.created:
             commit_details.append("\nCreated Playlists:")
-            for playlist in created_playlists:
-                commit_details.append(f"- {playlist}")
+            for entry in playlist_changes.created:
+                commit_details.append(f"- {entry.name}")
 
-        if filtered_deleted_playlists:
+        if playlist_changes.deleted:
             commit_details.append("\nDeleted Playlists:")
-            for playlist in filtered_deleted_playlists:
-                commit_details.append(f"- {playlist.name}")
+            for entry in playlist_changes.deleted:
+                commit_details.append(f"- {entry.name}")
 
-        if renamed_playlists:
+        if playlist_changes.renamed:
             commit_details.append("\nRenamed Playlists:")
-            for old_name, new_name in renamed_playlists:
-                commit_details.append(f"- {old_name} → {new_name}")
+            for before, after in playlist_changes.renamed:
+                commit_details.append(f"- {before.name} → {after.name}")
 
         commit_details.append("\nChanged Playlists:")
         has_changes = False
-        for playlist, changes in sorted(playlist_stats.items()):
+        for playlist_name, changes in sorted(playlist_stats.items()):
             if changes["added"] > 0 or changes["removed"] > 0:
                 has_changes = True
                 commit_details.append(
-                    f"- {playlist}: +{changes['added']} -{changes['removed']}"
+                    f"- {playlist_name}: +{changes['added']} -{changes['removed']}"
                 )
         if not has_changes:
             commit_details.pop()
@@ -491,7 +590,8 @@ def maybe_git_push(
     logger.info(f"Using SSH key at: {ssh_key_path}")
     if not ssh_key_path.exists():
         logger.error(
-            f"SSH key does not exist where the config file says it should: {ssh_key_path}"
+            "SSH key does not exist where the config file says it should:"
+            f" {ssh_key_path}"
         )
         cleanup_repo()
         exit(1)
@@ -503,7 +603,8 @@ def maybe_git_push(
         logger.info("Pulling changes from remote...")
         with repo.git.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
             try:
-                repo.remotes.origin.pull()
+                with profiler.phase("git_pull"):
+                    repo.remotes.origin.pull()
             except git.GitCommandError as e:
                 logger.error(f"Failed to pull changes: {e!s}")
                 logger.error(f"Git command failed with exit code {e.status}")
@@ -513,7 +614,8 @@ def maybe_git_push(
 
         with repo.git.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
             try:
-                repo.remotes.origin.push()
+                with profiler.phase("git_push"):
+                    repo.remotes.origin.push()
             except git.GitCommandError as e:
                 logger.error(f"Failed to push changes: {e!s}")
                 logger.error(f"Git command failed with exit code {e.status}")
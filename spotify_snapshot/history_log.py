@@ -0,0 +1,213 @@
+"""
+Reads the history of the snapshots repo as changes to the items (tracks, albums and
+playlists) in each collection, from a single `git log -p` rather than by checking
+out or reading every file of every commit.
+"""
+
+import codecs
+import csv
+import io
+from collections import Counter
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+
+import git
+
+from spotify_snapshot.playlist_layout import PLAYLIST_FILE_ID_PATTERN
+from spotify_snapshot.spotify_snapshot_output_manager import (
+    SpotifySnapshotOutputManager,
+)
+
+# Collections other than playlists' tracks, by the file they're in
+LIKED_SONGS_COLLECTION = "liked_songs"
+SAVED_ALBUMS_COLLECTION = "saved_albums"
+PLAYLISTS_COLLECTION = "playlists"
+# Followed by the playlist's ID
+PLAYLIST_COLLECTION_PREFIX = "playlist:"
+
+# The last column of every TSV file is an ID, apart from in the header row
+HEADER_ID_COLUMNS = {"TRACK ID", "ALBUM ID", "PLAYLIST ID"}
+
+# Each commit starts with a line like "\0<SHA> <commit timestamp>"
+LOG_FORMAT = "%x00%H %ct"
+
+
+@dataclass
+class CommitChanges:
+    hexsha: str
+    # Seconds since the epoch
+    committed_at: int
+    # How many more rows each (collection, item ID) has than in the commit before,
+    # or fewer if it's negative
+    row_count_changes: Counter[tuple[str, str]] = field(default_factory=Counter)
+    # The name in the last row seen for each (collection, item ID)
+    names: dict[tuple[str, str], str] = field(default_factory=dict)
+
+
+@dataclass
+class CommitFileChanges:
+    hexsha: str
+    # Seconds since the epoch
+    committed_at: int
+    # The SHA of the new contents of each TSV file that changed, by its path, or
+    # None for files that were deleted
+    blob_hexshas: dict[str, str | None] = field(default_factory=dict)
+
+
+def get_collection(path: str) -> str | None:
+    """The collection whose items are in the file at path, if any."""
+    output_manager = SpotifySnapshotOutputManager.get_instance()
+    if path == output_manager.liked_songs_filename:
+        return LIKED_SONGS_COLLECTION
+    if path == output_manager.albums_filename:
+        return SAVED_ALBUMS_COLLECTION
+    if path == output_manager.playlists_index_filename:
+        return PLAYLISTS_COLLECTION
+    if path.startswith("playlists/"):
+        match = PLAYLIST_FILE_ID_PATTERN.search(path)
+        if match is not None:
+            return PLAYLIST_COLLECTION_PREFIX + match.group(1)
+    return None
+
+
+def _unquote_path(path: str) -> str:
+    if path.startswith('"'):
+        # Paths with quotes, backslashes or control characters are C-quoted
+        return codecs.escape_decode(path[1:-1].encode("utf-8"))[0].decode("utf-8")
+    return path
+
+
+def _parse_diff_path(line: str) -> str | None:
+    """The path in a "--- a/<path>" or "+++ b/<path>" line, or None for /dev/null."""
+    # Git adds a tab after paths with spaces in them
+    path = line[4:].rstrip("\n").rstrip("\t")
+    if path == "/dev/null":
+        return None
+    return _unquote_path(path)[2:]
+
+
+def _run_log(repo: git.Repo, since_hexsha: str | None, *args: str) -> Iterator[str]:
+    """
+    Runs `git log` over the commits after since_hexsha (or every commit) up to HEAD,
+    oldest first, and yields each line of its output for TSV files. Merges are
+    compared with their first parent, so that this follows what HEAD looked like
+    over time.
+    """
+    process = repo.git.execute(
+        [
+            "git",
+            "-c",
+            "core.quotePath=false",
+            "log",
+            "--reverse",
+            "--first-parent",
+            "--diff-merges=first-parent",
+            "--root",
+            "--no-renames",
+            f"--format={LOG_FORMAT}",
+            *args,
+            since_hexsha + "..HEAD" if since_hexsha is not None else "HEAD",
+            "--",
+            "*.tsv",
+        ],
+        as_process=True,
+    )
+    try:
+        for raw_line in process.stdout:
+            yield raw_line.decode("utf-8", errors="replace")
+    finally:
+        # GitPython drops proc once it has terminated the process itself, in which
+        # case there's nothing left to clean up
+        proc = process.proc
+        if proc is not None:
+            if proc.stdout is not None:
+                proc.stdout.close()
+            proc.wait()
+
+
+def _count_rows(
+    changes: CommitChanges, collection: str, lines: list[str], sign: int
+) -> None:
+    # Parsed together, so that quoted fields with newlines in them stay in one row
+    for row in csv.reader(io.StringIO("\n".join(lines), newline=""), delimiter="\t"):
+        if not row or row[-1] in HEADER_ID_COLUMNS:
+            continue
+        key = (collection, row[-1])
+        changes.row_count_changes[key] += sign
+        changes.names[key] = row[0]
+
+
+def iter_commit_changes(
+    repo: git.Repo, since_hexsha: str | None = None
+) -> Iterator[CommitChanges]:
+    """
+    Yields the rows each commit after since_hexsha (or every commit) up to HEAD added
+    and removed, oldest first.
+    """
+    changes: CommitChanges | None = None
+    collection: str | None = None
+    added_lines: list[str] = []
+    removed_lines: list[str] = []
+    is_in_file_header = False
+
+    def count_file_rows() -> None:
+        if changes is not None and collection is not None:
+            _count_rows(changes, collection, added_lines, 1)
+            _count_rows(changes, collection, removed_lines, -1)
+        added_lines.clear()
+        removed_lines.clear()
+
+    for line in _run_log(repo, since_hexsha, "--unified=0", "--patch"):
+        if line.startswith("\0"):
+            count_file_rows()
+            if changes is not None:
+                yield changes
+            hexsha, committed_at = line[1:].split()
+            changes = CommitChanges(hexsha=hexsha, committed_at=int(committed_at))
+            collection = None
+            continue
+        if line.startswith("diff --git "):
+            count_file_rows()
+            collection = None
+            is_in_file_header = True
+            continue
+        if is_in_file_header:
+            if line.startswith("--- ") or line.startswith("+++ "):
+                path = _parse_diff_path(line)
+                if path is not None:
+                    collection = get_collection(path)
+            elif line.startswith("@@"):
+                is_in_file_header = False
+            continue
+        if line.startswith("+"):
+            added_lines.append(line[1:].rstrip("\n"))
+        elif line.startswith("-"):
+            removed_lines.append(line[1:].rstrip("\n"))
+    count_file_rows()
+    if changes is not None:
+        yield changes
+
+
+def iter_commit_file_changes(
+    repo: git.Repo, since_hexsha: str | None = None
+) -> Iterator[CommitFileChanges]:
+    """
+    Yields which TSV files each commit after since_hexsha (or every commit) up to
+    HEAD changed, oldest first, without reading what's in them.
+    """
+    changes: CommitFileChanges | None = None
+    for line in _run_log(repo, since_hexsha, "--raw", "--no-abbrev"):
+        if line.startswith("\0"):
+            if changes is not None:
+                yield changes
+            hexsha, committed_at = line[1:].split()
+            changes = CommitFileChanges(hexsha=hexsha, committed_at=int(committed_at))
+        elif line.startswith(":") and changes is not None:
+            # ":<old mode> <new mode> <old SHA> <new SHA> <status>\t<path>"
+            file_info, path = line.rstrip("\n").split("\t", 1)
+            _, _, _, new_blob_hexsha, status = file_info.split()
+            changes.blob_hexshas[_unquote_path(path)] = (
+                None if status == "D" else new_blob_hexsha
+            )
+    if changes is not None:
+        yield changes
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections.abc import Mapping
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from spotify_snapshot.config import SpotifySnapshotConfig
+from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.profiling import CACHE_HIT_HEADER, profiler
+
+logger = get_colorized_logger()
+
+# Only these headers are kept with a cached response. The body is stored already
+# decoded, so e.g. Content-Encoding and Content-Length no longer apply to it
+CACHED_HEADERS = ("Content-Type", "ETag")
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    etag: str
+    headers: dict[str, str]
+    content: bytes
+
+
+class ResponseCache:
+    """
+    An on-disk cache of GET responses that came with an ETag, keyed by their full URL
+    (query parameters included). Each response is a single file, holding a line of
+    JSON metadata followed by the body.
+
+    Once the cache is bigger than max_size_bytes, the least recently used responses
+    are evicted. A file's mtime is bumped whenever it is used, so that's what
+    recency is judged by.
+    """
+
+    def __init__(self, cache_dir: Path, max_size_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self._lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True, mode=0o700)
+        self._size_bytes = sum(
+            path.stat().st_size for path in self.cache_dir.glob("*.response")
+        )
+
+    @staticmethod
+    def get_default_dir() -> Path:
+        return SpotifySnapshotConfig.get_cache_dir() / "http"
+
+    def _get_path(self, url: str) -> Path:
+        return self.cache_dir / f"{hashlib.sha256(url.encode()).hexdigest()}.response"
+
+    def get(self, url: str) -> CachedResponse | None:
+        path = self._get_path(url)
+        try:
+            with open(path, "rb") as f:
+                metadata = json.loads(f.readline())
+                content = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"<yellow>Ignoring unreadable cached response: {e}</yellow>")
+            return None
+        # Guard against hash collisions, however unlikely
+        if metadata.get("url") != url:
+            return None
+        return CachedResponse(
+            url=url,
+            etag=metadata["etag"],
+            headers=metadata["headers"],
+            content=content,
+        )
+
+    def put(self, response: CachedResponse) -> None:
+        metadata = {
+            "url": response.url,
+            "etag": response.etag,
+            "headers": response.headers,
+        }
+        data = json.dumps(metadata).encode() + b"\n" + response.content
+        if len(data) > self.max_size_bytes:
+            return
+
+        path = self._get_path(response.url)
+        with self._lock:
+            old_size = path.stat().st_size if path.exists() else 0
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except BaseException:
+                Path(temp_path).unlink(missing_ok=True)
+                raise
+            self._size_bytes += len(data) - old_size
+            if self._size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Delete the least recently used responses until the cache fits again."""
+        entries = []
+        for path in self.cache_dir.glob("*.response"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        self._size_bytes = sum(size for _, size, _ in entries)
+        evicted_count = 0
+        for _, size, path in entries:
+            if self._size_bytes <= self.max_size_bytes:
+                break
+            path.unlink(missing_ok=True)
+            self._size_bytes -= size
+            evicted_count += 1
+        logger.debug(f"Evicted {evicted_count} responses from the HTTP cache")
+
+
+class CachingHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that makes GET requests conditional on the ETag of the cached copy
+    of their response, if there is one. When the server says nothing has changed
+    (304 Not Modified), the cached copy is handed back as if it had been sent again.
+    """
+
+    def __init__(self, cache: ResponseCache, **kwargs: Any):
+        self.cache = cache
+        super().__init__(**kwargs)
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: None | float | tuple[float, float] | tuple[float, None] = None,
+        verify: bool | str = True,
+        cert: None | bytes | str | tuple[bytes | str, bytes | str] = None,
+        proxies: Mapping[str, str] | None = None,
+    ) -> requests.Response:
+        url = request.url
+        if request.method != "GET" or stream or url is None:
+            return super().send(request, stream, timeout, verify, cert, proxies)
+
+        cached_response = self.cache.get(url)
+        if cached_response is not None:
+            request.headers["If-None-Match"] = cached_response.etag
+
+        response = super().send(request, stream, timeout, verify, cert, proxies)
+
+        if response.status_code == 304 and cached_response is not None:
+            return self._build_cached_response(request, response, cached_response)
+        etag = response.headers.get("ETag")
+        if response.status_code == 200 and etag:
+            self.cache.put(
+                CachedResponse(
+                    url=url,
+                    etag=etag,
+                    headers={
+                        header: response.headers[header]
+                        for header in CACHED_HEADERS
+                        if header in response.headers
+                    },
+                    content=response.content,
+                )
+            )
+        return response
+
+    @staticmethod
+    def _build_cached_response(
+        request: requests.PreparedRequest,
+        not_modified_response: requests.Response,
+        cached_response: CachedResponse,
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(cached_response.headers)
+        response.headers[CACHE_HIT_HEADER] = "HIT"
+        response._content = cached_response.content
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = not_modified_response.url
+        response.request = request
+        response.connection = not_modified_response.connection
+        response.elapsed = not_modified_response.elapsed
+        # Kept for the retry history on it, since the body has already been read
+        response.raw = not_modified_response.raw
+        return response
+
+
+def create_session(
+    cache: ResponseCache | None, max_retries: int | Retry
+) -> requests.Session:
+    """Create a session for talking to the API, which caches responses in cache
+    (unless it's None) and records every response with profiler."""
+    session = requests.Session()
+    if cache is None:
+        adapter = HTTPAdapter(max_retries=max_retries)
+    else:
+        adapter = CachingHTTPAdapter(cache, max_retries=max_retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.hooks["response"].append(profiler.record_response)
+    return session
@@ -0,0 +1,204 @@
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import git
+
+from spotify_snapshot.config import SpotifySnapshotConfig
+from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.profiling import profiler
+
+logger = get_colorized_logger()
+
+# Kept in the repo's .git directory, since it's about that copy of the repo
+MAINTENANCE_LOG_FILENAME = "spotify-snapshot-maintenance.json"
+# How many maintenance runs are kept in the log
+MAX_RUNS_TO_LOG = 50
+# Unreachable objects younger than this are left alone by prune, in case a git
+# command that's still running (or a failed commit) is about to use them
+PRUNE_EXPIRE = "2.weeks.ago"
+
+# In the order they're run
+MAINTENANCE_STEPS = ("prune", "repack", "multi_pack_index", "commit_graph")
+MAINTENANCE_COMMANDS = {
+    "prune": ["prune", f"--expire={PRUNE_EXPIRE}"],
+    # Rolls loose objects and small packs into bigger ones, so that each run only
+    # rewrites a small part of the repo rather than the whole thing
+    "repack": ["repack", "-d", "-l", "-q", "--geometric=2", "--write-midx"],
+    "multi_pack_index": ["multi-pack-index", "write"],
+    # The changed paths filters make `git log -- <file>` much faster
+    "commit_graph": [
+        "commit-graph",
+        "write",
+        "--reachable",
+        "--split",
+        "--changed-paths",
+    ],
+}
+# Geometric repacking can't cope with the promisor packs of a partial (blobless)
+# clone, so those just have their loose objects packed
+PARTIAL_CLONE_REPACK_COMMAND = ["repack", "-d", "-l", "-q", "--write-midx"]
+
+
+@dataclass
+class ObjectCounts:
+    loose_objects: int
+    packs: int
+
+    @classmethod
+    def for_repo(cls, repo: git.Repo) -> "ObjectCounts":
+        stats = dict(
+            line.split(": ", 1) for line in repo.git.count_objects("-v").splitlines()
+        )
+        return cls(loose_objects=int(stats["count"]), packs=int(stats["packs"]))
+
+
+@dataclass
+class MaintenanceRun:
+    started_at: float
+    # How long each step took, in the order they ran
+    step_durations_sec: dict[str, float]
+    before: ObjectCounts
+    after: ObjectCounts
+
+
+@dataclass
+class MaintenanceLog:
+    """How long maintenance took each time it ran on this repo, newest last."""
+
+    runs: list[MaintenanceRun] = field(default_factory=list)
+
+    @property
+    def last_full_run_at(self) -> float:
+        """When every step last ran, rather than just a repack."""
+        for run in reversed(self.runs):
+            if "prune" in run.step_durations_sec:
+                return run.started_at
+        return 0.0
+
+    @staticmethod
+    def get_path(repo: git.Repo) -> Path:
+        return Path(repo.git_dir) / MAINTENANCE_LOG_FILENAME
+
+    @classmethod
+    def load(cls, path: Path) -> "MaintenanceLog":
+        if not path.exists():
+            return cls()
+        try:
+            with open(path, encoding="utf-8") as f:
+                runs = [
+                    MaintenanceRun(
+                        started_at=run["started_at"],
+                        step_durations_sec=run["step_durations_sec"],
+                        before=ObjectCounts(**run["before"]),
+                        after=ObjectCounts(**run["after"]),
+                    )
+                    for run in json.load(f)["runs"]
+                ]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(
+                f"<yellow>Could not read the maintenance log at {path}, starting a new"
+                f" one: {e}</yellow>"
+            )
+            return cls()
+        return cls(runs=runs)
+
+    def save(self, path: Path) -> None:
+        del self.runs[:-MAX_RUNS_TO_LOG]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"runs": [asdict(run) for run in self.runs]}, f, indent=2)
+
+
+def is_partial_clone(repo: git.Repo) -> bool:
+    """Whether the repo was cloned without some objects, to be fetched when needed."""
+    with repo.config_reader() as repo_config:
+        return any(
+            repo_config.get_value(section, "promisor", False)
+            for section in repo_config.sections()
+            if section.startswith("remote ")
+        )
+
+
+def get_due_steps(
+    counts: ObjectCounts, last_full_run_at: float, config: SpotifySnapshotConfig
+) -> list[str]:
+    """
+    Works out which maintenance steps need running. Objects are repacked whenever
+    there are too many loose objects or packs, and everything else at most once per
+    maintenance interval.
+    """
+    if config.maintenance_interval_hours <= 0:
+        return []
+    steps = set()
+    if (
+        counts.loose_objects >= config.maintenance_max_loose_objects
+        or counts.packs >= config.maintenance_max_packs
+    ):
+        # Repacking writes a new multi-pack-index itself
+        steps |= {"repack", "commit_graph"}
+    if time.time() - last_full_run_at >= config.maintenance_interval_hours * 3600:
+        steps |= {"prune", "commit_graph"}
+        # There has to be a pack for there to be anything to index
+        if "repack" not in steps and counts.packs > 0:
+            steps.add("multi_pack_index")
+    return [step for step in MAINTENANCE_STEPS if step in steps]
+
+
+def run_maintenance_if_due(repo: git.Repo, config: SpotifySnapshotConfig) -> None:
+    """
+    Keeps a long-lived snapshots repo quick to work with, by packing loose objects,
+    writing the commit-graph and multi-pack-index, and pruning unreachable objects,
+    but only when that's due. Failures are logged rather than raised, since the
+    backup itself has already been committed by now.
+    """
+    try:
+        _run_due_maintenance(repo, config)
+    # Neither git failing (or printing object counts that can't be parsed) nor the
+    # log being unwritable should stop the backup from being pushed
+    except (git.GitCommandError, OSError, ValueError, KeyError) as e:
+        logger.warning(f"<yellow>Could not maintain the snapshots repo: {e}</yellow>")
+
+
+def _run_due_maintenance(repo: git.Repo, config: SpotifySnapshotConfig) -> None:
+    log_path = MaintenanceLog.get_path(repo)
+    maintenance_log = MaintenanceLog.load(log_path)
+    counts = ObjectCounts.for_repo(repo)
+    steps = get_due_steps(counts, maintenance_log.last_full_run_at, config)
+    if not steps:
+        return
+
+    logger.info(
+        f"<blue>Maintaining the snapshots repo ({counts.loose_objects} loose objects,"
+        f" {counts.packs} packs):</blue> {', '.join(steps)}"
+    )
+    commands = dict(MAINTENANCE_COMMANDS)
+    if is_partial_clone(repo):
+        commands["repack"] = PARTIAL_CLONE_REPACK_COMMAND
+    started_at = time.time()
+    step_durations_sec = {}
+    for step in steps:
+        step_start_time = time.perf_counter()
+        try:
+            with profiler.phase(f"maintenance_{step}"):
+                repo.git.execute(["git", *commands[step]])
+        except git.GitCommandError as e:
+            logger.warning(
+                f"<yellow>Repo maintenance step {step} failed: {e.stderr}</yellow>"
+            )
+        finally:
+            step_durations_sec[step] = round(time.perf_counter() - step_start_time, 3)
+
+    maintenance_log.runs.append(
+        MaintenanceRun(
+            started_at=started_at,
+            step_durations_sec=step_durations_sec,
+            before=counts,
+            after=ObjectCounts.for_repo(repo),
+        )
+    )
+    maintenance_log.save(log_path)
+    logger.info(
+        "<green>Repo maintenance done in"
+        f" {sum(step_durations_sec.values()):.1f}s</green>"
+    )
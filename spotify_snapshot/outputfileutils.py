@@ -1,16 +1,29 @@
 import csv
-from collections.abc import Callable
+import hashlib
+import heapq
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from operator import itemgetter
 from pathlib import Path
 from typing import Any, TypeVar
 
 from rich.console import Console
 from rich.table import Table
 
+from spotify_snapshot.content_hashes import content_hashes
 from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.profiling import profiler
 from spotify_snapshot.spotify_datatypes import (
-    SpotifyAlbum,
-    SpotifyPlaylist,
-    SpotifyPlaylistTrackItem,
+    ARTISTS_SEPARATOR,
+    AlbumRecord,
+    PlaylistRecord,
+    TrackRecord,
 )
 
 TRACK_HEADER_ROW = ["TRACK NAME", "TRACK ARTIST(S)", "ALBUM", "DATE ADDED", "TRACK ID"]
@@ -29,11 +42,75 @@ TRACK_IN_PLAYLIST_HEADER_ROW = [
     *TRACK_HEADER_ROW[-1:],
 ]
 
+# Written as who added a track to a playlist when the API doesn't say
+UNKNOWN_ADDED_BY = "<unknown>"
+
 T = TypeVar("T")
 
+# Above this size, files are rendered to a temporary file instead of in memory
+MAX_RENDERED_BYTES_IN_MEMORY = 16 * 1024 * 1024
+# Above this many items, write_items_to_file sorts on disk instead of in memory
+MAX_ITEMS_TO_SORT_IN_MEMORY = 50_000
+
+
+class WrittenFiles:
+    """
+    Keeps track of every file written (or deleted) during a run, so the ones in the
+    snapshots repo can be committed without searching the whole repo for changes.
+
+    With a journal, every path is also saved to disk as it's added, so that if a run
+    crashes before committing, the next one still knows to commit those files.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._paths: set[Path] = set()
+        self._journal_path: Path | None = None
+
+    def use_journal(self, journal_path: Path) -> None:
+        """Save paths to journal_path from now on, picking up any already in it."""
+        with self._lock:
+            self._journal_path = journal_path
+            if journal_path.exists():
+                for path in journal_path.read_bytes().split(b"\0"):
+                    if path:
+                        self._paths.add(Path(os.fsdecode(path)))
+            journal_path.write_bytes(_encode_paths(self._paths))
+
+    def add(self, path: Path) -> None:
+        path = path.absolute()
+        with self._lock:
+            if path in self._paths:
+                return
+            self._paths.add(path)
+            if self._journal_path is not None:
+                with open(self._journal_path, "ab") as journal:
+                    journal.write(_encode_paths([path]))
+
+    def get_paths(self) -> set[Path]:
+        with self._lock:
+            return set(self._paths)
+
+    def clear(self) -> None:
+        """Forget every path, once they've all been committed."""
+        with self._lock:
+            self._paths.clear()
+            if self._journal_path is not None:
+                self._journal_path.unlink(missing_ok=True)
+
+
+def _encode_paths(paths: Iterable[Path]) -> bytes:
+    # NUL separated, since playlist names can contain newlines
+    return b"".join(os.fsencode(path) + b"\0" for path in paths)
+
+
+# Shared by everything that writes to the snapshots repo
+written_files = WrittenFiles()
+
 
 def write_to_file(
-    data: dict[str, T],
+    # Keyed by ID, which is None for tracks that are local files
+    data: Mapping[Any, T],
     sort_lambda: Callable[[T], Any],
     item_to_row_lambda: Callable[[T], list[str]],
     header_row: list[str],
@@ -44,65 +121,251 @@ def write_to_file(
     dict, and then outputs each item to the file specified. Overwrites any such
     existing file. Will create directories if needed.
     """
+    write_items_to_file(
+        items=data.values(),
+        sort_lambda=sort_lambda,
+        item_to_row_lambda=item_to_row_lambda,
+        header_row=header_row,
+        output_filename=output_filename,
+    )
+
+
+def write_items_to_file(
+    items: Iterable[T],
+    sort_lambda: Callable[[T], Any],
+    item_to_row_lambda: Callable[[T], list[str]],
+    header_row: list[str],
+    output_filename: Path,
+    id_lambda: Callable[[T], Any] | None = None,
+    on_item_written: Callable[[T], None] | None = None,
+    max_items_in_memory: int = MAX_ITEMS_TO_SORT_IN_MEMORY,
+) -> int:
+    """
+    Streaming version of write_to_file, which takes any iterable of items, so that
+    they can be written as they're fetched rather than collected up front.
+
+    Up to max_items_in_memory items are sorted in memory. Past that, they're sorted
+    in chunks which are spilled to temporary files and then merged, so only one
+    chunk is ever held in memory. Either way the rows come out in the order sorted()
+    would put them in.
+
+    With id_lambda, only the last item with each ID is written, in the place of the
+    first, just like the values of a dict the items were added to by ID. Only the
+    IDs are kept in memory for that, rather than the items.
+
+    If content_hashes says the file already has exactly the contents that were
+    rendered, it isn't written again.
+
+    Args:
+        on_item_written: Called with each item that's written, in the same order
+
+    Returns:
+        The number of rows written, not counting the header
+    """
     logger = get_colorized_logger()
     logger.info(
         f"<blue>Writing to</blue> <green><bold>{output_filename}</bold></green>"
     )
 
-    sorted_list = sorted(data.values(), key=sort_lambda)
-    output_rows = [header_row]
-    output_rows.extend([item_to_row_lambda(item) for item in sorted_list])
+    # The profiled time includes waiting for items that are still being fetched
+    with profiler.phase("write_to_file", file=output_filename.name) as details:
+        # Rendered in memory (or a temporary file, if it gets big) first, so the
+        # file is left alone if it would come out exactly the same, or if items
+        # stop coming because fetching them failed
+        row_count = 0
+        with _sort_items(
+            items, sort_lambda, id_lambda, max_items_in_memory
+        ) as sorted_items:
+            with tempfile.SpooledTemporaryFile(
+                max_size=MAX_RENDERED_BYTES_IN_MEMORY
+            ) as rendered_file:
+                # Written the same way read_tsv_rows reads it back, whatever the
+                # locale
+                rendered_text = io.TextIOWrapper(
+                    rendered_file, encoding="utf-8", newline=""
+                )
+                tsv_writer = csv.writer(rendered_text, delimiter="\t")
+                tsv_writer.writerow(header_row)
+                for item in sorted_items:
+                    tsv_writer.writerow(item_to_row_lambda(item))
+                    row_count += 1
+                    if on_item_written is not None:
+                        on_item_written(item)
+                rendered_text.flush()
+                rendered_text.detach()
+
+                rendered_file.seek(0)
+                sha256 = hashlib.file_digest(rendered_file, "sha256").hexdigest()
+                is_unchanged = content_hashes.is_unchanged(output_filename, sha256)
+                if not is_unchanged:
+                    rendered_file.seek(0)
+                    # e.g. the shard directory of a playlist's tracks file
+                    output_filename.parent.mkdir(parents=True, exist_ok=True)
+                    with open(output_filename, "wb") as out_file:
+                        shutil.copyfileobj(rendered_file, out_file)
+                    content_hashes.set(output_filename, sha256)
+                    written_files.add(output_filename)
+
+        if is_unchanged:
+            logger.info(
+                "<blue>Unchanged, so not rewriting</blue>"
+                f" <green><bold>{output_filename}</bold></green>"
+            )
+        details["rows"] = row_count
+        details["unchanged"] = is_unchanged
+
+    return row_count
+
+
+# What items are sorted by: their sort key, then where the first item with the same
+# ID came, then where they came, followed by the item itself
+_SortEntry = tuple[Any, int, int, T]
+_sort_entry_key = itemgetter(0, 1)
+
 
-    with open(output_filename, "w") as out_file:
-        tsv_writer = csv.writer(out_file, delimiter="\t")
-        tsv_writer.writerows(output_rows)
+@contextmanager
+def _sort_items(
+    items: Iterable[T],
+    sort_lambda: Callable[[T], Any],
+    id_lambda: Callable[[T], Any] | None,
+    max_items_in_memory: int,
+) -> Iterator[Iterator[T]]:
+    """Yields items in order, as write_items_to_file describes."""
+    logger = get_colorized_logger()
+    first_indexes: dict[Any, int] = {}
+    last_indexes: dict[Any, int] = {}
+    # Only created once there's too much to sort in memory
+    spill_dir = None
+    try:
+        chunk_paths: list[Path] = []
+        chunk: list[_SortEntry[T]] = []
+        for index, item in enumerate(items):
+            first_index = index
+            if id_lambda is not None:
+                item_id = id_lambda(item)
+                first_index = first_indexes.setdefault(item_id, index)
+                last_indexes[item_id] = index
+            chunk.append((sort_lambda(item), first_index, index, item))
+            if len(chunk) >= max_items_in_memory:
+                if spill_dir is None:
+                    spill_dir = tempfile.TemporaryDirectory(
+                        prefix="spotify-snapshot-sort-"
+                    )
+                chunk_paths.append(
+                    _spill_sorted_chunk(chunk, Path(spill_dir.name), len(chunk_paths))
+                )
+                chunk = []
+        first_indexes.clear()
+
+        entries: Iterable[_SortEntry[T]]
+        if spill_dir is None:
+            chunk.sort(key=_sort_entry_key)
+            entries = chunk
+        else:
+            if chunk:
+                chunk_paths.append(
+                    _spill_sorted_chunk(chunk, Path(spill_dir.name), len(chunk_paths))
+                )
+                chunk = []
+            logger.info(
+                f"<blue>Merging</blue> {len(chunk_paths)} <blue>sorted chunks</blue>"
+            )
+            # The indexes break every tie, so this comes out exactly as a stable
+            # sort of everything at once would
+            entries = heapq.merge(
+                *(_read_spilled_chunk(path) for path in chunk_paths),
+                key=_sort_entry_key,
+            )
+
+        yield (
+            item
+            for _, _, index, item in entries
+            if id_lambda is None or last_indexes[id_lambda(item)] == index
+        )
+    finally:
+        if spill_dir is not None:
+            spill_dir.cleanup()
+
+
+def _spill_sorted_chunk(
+    chunk: list[_SortEntry[T]], spill_dir: Path, chunk_index: int
+) -> Path:
+    chunk.sort(key=_sort_entry_key)
+    chunk_path = spill_dir / f"chunk-{chunk_index}.pickle"
+    with open(chunk_path, "wb") as chunk_file:
+        for entry in chunk:
+            pickle.dump(entry, chunk_file, protocol=pickle.HIGHEST_PROTOCOL)
+    return chunk_path
 
 
-def track_to_row(item: SpotifyPlaylistTrackItem) -> list[str]:
-    track_obj = item["track"]
+def _read_spilled_chunk(chunk_path: Path) -> Iterator[_SortEntry[Any]]:
+    with open(chunk_path, "rb") as chunk_file:
+        while True:
+            try:
+                yield pickle.load(chunk_file)
+            except EOFError:
+                return
+
+
+def track_to_row(track: TrackRecord) -> list[str]:
     return [
-        track_obj["name"],
-        ", ".join(artist["name"] for artist in track_obj["artists"]),
-        track_obj["album"]["name"],
-        item["added_at"],
-        track_obj["id"],
+        track.name,
+        ARTISTS_SEPARATOR.join(track.artists),
+        track.album_name,
+        track.added_at,
+        # Local files don't have an ID
+        track.id or "",
     ]
 
 
-def playlist_track_to_row(item: SpotifyPlaylistTrackItem) -> list[str]:
-    track_row = track_to_row(item)
-    added_by_id = item["added_by"]["id"]
-    if added_by_id == "":
+def playlist_track_to_row(track: TrackRecord) -> list[str]:
+    track_row = track_to_row(track)
+    added_by_id = track.added_by
+    if not added_by_id:
         # This has come up in debugging with Spotify owned ("official") playlists,
         # presumably because they're built different than "regular" playlists
-        added_by_id = "<unknown>"
+        added_by_id = UNKNOWN_ADDED_BY
     return [*track_row[:-1], added_by_id, *track_row[-1:]]
 
 
-def album_to_row(item: dict[str, str | SpotifyAlbum]) -> list[str]:
-    album_obj = item["album"]
+def album_to_row(album: AlbumRecord) -> list[str]:
     return [
-        album_obj["name"],
-        ", ".join(map(lambda artist: artist["name"], album_obj["artists"])),
-        item["added_at"],
-        album_obj["id"],
+        album.name,
+        ARTISTS_SEPARATOR.join(album.artists),
+        album.added_at,
+        album.id,
     ]
 
 
-def playlist_to_row(item: SpotifyPlaylist) -> list[str]:
+def playlist_to_row(playlist: PlaylistRecord) -> list[str]:
     return [
-        item["name"],
-        item["description"],
-        item["tracks"]["total"],
-        item["owner"]["id"],
-        item["collaborative"],
-        item["id"],
+        playlist.name,
+        playlist.description,
+        str(playlist.track_count),
+        playlist.owner_id,
+        str(playlist.collaborative),
+        playlist.id,
     ]
 
 
+def read_tsv_rows(tsv_path: Path) -> Iterator[list[str]]:
+    """
+    Reads back a file written by write_to_file, yielding every row except the header.
+    Yields nothing if the file doesn't exist.
+    """
+    if not tsv_path.exists():
+        return
+    with open(tsv_path, newline="", encoding="utf-8") as tsv_file:
+        tsv_reader = csv.reader(tsv_file, delimiter="\t")
+        next(tsv_reader, None)
+        yield from tsv_reader
+
+
 def pretty_print_tsv_table(tsv_data_path: Path) -> None:
-    with open(tsv_data_path) as tsv_file:
-        tsv_data = [line.strip().split("\t") for line in tsv_file.readlines()]
+    # Parsed the same way it was written, so quoted fields with tabs or newlines in
+    # them stay in one cell
+    with open(tsv_data_path, newline="", encoding="utf-8") as tsv_file:
+        tsv_data = [row for row in csv.reader(tsv_file, delimiter="\t") if row]
     table = Table(show_header=True, header_style="bold magenta")
     for header in tsv_data[0]:
         table.add_column(header)
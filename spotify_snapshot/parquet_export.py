@@ -0,0 +1,337 @@
+"""
+An optional export of the snapshots as Parquet datasets, with typed columns
+(timestamps, IDs and lists of artists), so that analytics tools can load them with
+column scans instead of parsing TSV files. They're written from the same records as
+the TSV files, as each one is written:
+
+    <repo>-parquet/
+        liked_songs/part-0.parquet
+        saved_albums/part-0.parquet
+        playlists/part-0.parquet
+        playlist_tracks/playlist_id=<playlist ID>/part-0.parquet
+
+Playlists' tracks are partitioned by playlist (Hive-style, so readers get a
+playlist_id column), and only the partitions of playlists that changed are
+rewritten. Nothing is exported from the TSV files, where artists' names are joined
+together, so records always have the list of artists the API gave.
+
+PyArrow is an optional dependency, installed with the `parquet` extra.
+"""
+
+import os
+import shutil
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import AbstractContextManager, contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Generic, TypeVar
+
+from spotify_snapshot import outputfileutils
+from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.playlist_manifest import PlaylistManifest
+from spotify_snapshot.profiling import profiler
+from spotify_snapshot.spotify_datatypes import AlbumRecord, PlaylistRecord, TrackRecord
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = get_colorized_logger()
+
+LIKED_SONGS_DATASET = "liked_songs"
+SAVED_ALBUMS_DATASET = "saved_albums"
+PLAYLISTS_DATASET = "playlists"
+PLAYLIST_TRACKS_DATASET = "playlist_tracks"
+PLAYLIST_PARTITION_PREFIX = "playlist_id="
+PART_FILENAME = "part-0.parquet"
+# How the Spotify API formats when items were added
+ADDED_AT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Parquet can't store timestamps in seconds, so they'd be converted to this anyway
+TIMESTAMP_UNIT = "ms"
+PARQUET_COMPRESSION = "zstd"
+# How many records are written to a Parquet file at a time, each as a row group
+EXPORT_BATCH_SIZE = 10_000
+
+T = TypeVar("T")
+
+
+def is_pyarrow_installed() -> bool:
+    return pa is not None
+
+
+def _to_timestamps(values: list[str]) -> "pa.Array":
+    # Missing or malformed dates become nulls, rather than failing the export
+    return pc.strptime(
+        pa.array(values, pa.string()),
+        format=ADDED_AT_FORMAT,
+        unit="s",
+        error_is_null=True,
+    ).cast(pa.timestamp(TIMESTAMP_UNIT, tz="UTC"))
+
+
+def _get_added_by(added_by: str | None) -> str | None:
+    # Empty when the API doesn't say who added a track, which TSV files have a
+    # placeholder for instead
+    if not added_by or added_by == outputfileutils.UNKNOWN_ADDED_BY:
+        return None
+    return added_by
+
+
+def _tracks_to_table(tracks: Iterable[TrackRecord], is_in_playlist: bool) -> "pa.Table":
+    tracks = list(tracks)
+    columns = {
+        "name": pa.array([track.name for track in tracks], pa.string()),
+        "artists": pa.array(
+            [list(track.artists) for track in tracks], pa.list_(pa.string())
+        ),
+        "album": pa.array([track.album_name for track in tracks], pa.string()),
+        "added_at": _to_timestamps([track.added_at for track in tracks]),
+    }
+    if is_in_playlist:
+        columns["added_by"] = pa.array(
+            [_get_added_by(track.added_by) for track in tracks], pa.string()
+        )
+    # Null for local files, which don't have a Spotify ID (and are written to TSV
+    # files with an empty one)
+    columns["track_id"] = pa.array([track.id or None for track in tracks], pa.string())
+    return pa.table(columns)
+
+
+def _albums_to_table(albums: Iterable[AlbumRecord]) -> "pa.Table":
+    albums = list(albums)
+    return pa.table(
+        {
+            "name": pa.array([album.name for album in albums], pa.string()),
+            "artists": pa.array(
+                [list(album.artists) for album in albums], pa.list_(pa.string())
+            ),
+            "added_at": _to_timestamps([album.added_at for album in albums]),
+            "album_id": pa.array([album.id for album in albums], pa.string()),
+        }
+    )
+
+
+def _playlists_to_table(playlists: Iterable[PlaylistRecord]) -> "pa.Table":
+    playlists = list(playlists)
+    return pa.table(
+        {
+            "name": pa.array([playlist.name for playlist in playlists], pa.string()),
+            "description": pa.array(
+                [playlist.description for playlist in playlists], pa.string()
+            ),
+            "track_count": pa.array(
+                [playlist.track_count for playlist in playlists], pa.int64()
+            ),
+            "owner": pa.array(
+                [playlist.owner_id for playlist in playlists], pa.string()
+            ),
+            "collaborative": pa.array(
+                [playlist.collaborative for playlist in playlists], pa.bool_()
+            ),
+            "playlist_id": pa.array(
+                [playlist.id for playlist in playlists], pa.string()
+            ),
+            "snapshot_id": pa.array(
+                [playlist.snapshot_id for playlist in playlists], pa.string()
+            ),
+        }
+    )
+
+
+def _ignore_record(record: object) -> None:
+    pass
+
+
+class _ParquetFileExport(Generic[T]):
+    """
+    Writes records to a Parquet file in batches as they're added, so that they're
+    never all held at once.
+
+    Failures are logged rather than raised, since the TSV files are what's backed up.
+    A file that couldn't be written is deleted, so that it's written again on the
+    next run (which fetches playlists with no partition again), rather than being
+    left out of date.
+    """
+
+    def __init__(self, path: Path, to_table: Callable[[list[T]], "pa.Table"]):
+        self.path = path
+        self._to_table = to_table
+        # Written to a hidden file first, which readers of the dataset skip, so that
+        # they never see a partly written file
+        self._temp_path = path.with_name(f".{path.name}.tmp")
+        self._batch: list[T] = []
+        self._writer: "pq.ParquetWriter | None" = None
+        self._failed = False
+
+    def add(self, record: T) -> None:
+        if self._failed:
+            return
+        self._batch.append(record)
+        if len(self._batch) >= EXPORT_BATCH_SIZE:
+            self._write_batch()
+
+    def _write_batch(self) -> None:
+        try:
+            with profiler.phase("export_parquet", file=self.path.parent.name):
+                table = self._to_table(self._batch)
+                if self._writer is None:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    self._writer = pq.ParquetWriter(
+                        self._temp_path, table.schema, compression=PARQUET_COMPRESSION
+                    )
+                self._writer.write_table(table)
+        except (pa.ArrowException, OSError, ValueError) as e:
+            self._fail(e)
+        self._batch.clear()
+
+    def _fail(self, e: Exception) -> None:
+        logger.warning(f"<yellow>Could not export {self.path} to Parquet: {e}</yellow>")
+        self._failed = True
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+    def finish(self) -> None:
+        """Replaces the file with the records that were added."""
+        if self._failed:
+            return
+        # Even with no records, so there's still a file, with just the schema
+        if self._batch or self._writer is None:
+            self._write_batch()
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+        try:
+            writer.close()
+            os.replace(self._temp_path, self.path)
+        except (pa.ArrowException, OSError) as e:
+            self._fail(e)
+
+    def close(self) -> None:
+        """Stops writing, leaving the file alone if finish wasn't called."""
+        writer, self._writer = self._writer, None
+        try:
+            if writer is not None:
+                writer.close()
+        except (pa.ArrowException, OSError):
+            # Only the temporary file was being written, which is deleted anyway
+            pass
+        finally:
+            self._temp_path.unlink(missing_ok=True)
+
+
+class ParquetExporter:
+    """
+    Does nothing until it's enabled, so that the writers can always call it. Safe to
+    use from several threads at once, as long as they export different playlists.
+    """
+
+    def __init__(self) -> None:
+        self.export_dir: Path | None = None
+
+    @staticmethod
+    def get_export_dir(repo_filepath: Path) -> Path:
+        """The export is kept next to the snapshots repo, rather than in it."""
+        return repo_filepath.with_name(f"{repo_filepath.name}-parquet")
+
+    def enable(self, export_dir: Path) -> None:
+        self.export_dir = export_dir
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.export_dir is not None
+
+    def _get_export_dir(self) -> Path:
+        if self.export_dir is None:
+            raise RuntimeError("ParquetExporter not enabled. Call enable() first")
+        return self.export_dir
+
+    def _get_path(self, dataset: str) -> Path:
+        return self._get_export_dir() / dataset / PART_FILENAME
+
+    def _get_playlist_path(self, playlist_id: str) -> Path:
+        return (
+            self._get_export_dir()
+            / PLAYLIST_TRACKS_DATASET
+            / f"{PLAYLIST_PARTITION_PREFIX}{playlist_id}"
+            / PART_FILENAME
+        )
+
+    @contextmanager
+    def _exporting(
+        self, get_path: Callable[[], Path], to_table: Callable[[list[T]], "pa.Table"]
+    ) -> Iterator[Callable[[T], None]]:
+        """
+        Yields a function that exports a record to the file at get_path(), which is
+        replaced once the with block finishes. If the with block raises, like when
+        fetching the records failed, the file is left as it was.
+        """
+        if not self.is_enabled:
+            yield _ignore_record
+            return
+        export = _ParquetFileExport(get_path(), to_table)
+        try:
+            yield export.add
+            export.finish()
+        finally:
+            export.close()
+
+    def exporting_liked_songs(
+        self,
+    ) -> AbstractContextManager[Callable[[TrackRecord], None]]:
+        return self._exporting(
+            lambda: self._get_path(LIKED_SONGS_DATASET),
+            partial(_tracks_to_table, is_in_playlist=False),
+        )
+
+    def exporting_saved_albums(
+        self,
+    ) -> AbstractContextManager[Callable[[AlbumRecord], None]]:
+        return self._exporting(
+            lambda: self._get_path(SAVED_ALBUMS_DATASET), _albums_to_table
+        )
+
+    def export_playlists(self, playlists: Iterable[PlaylistRecord]) -> None:
+        with self._exporting(
+            lambda: self._get_path(PLAYLISTS_DATASET), _playlists_to_table
+        ) as export_playlist:
+            for playlist in playlists:
+                export_playlist(playlist)
+
+    def exporting_playlist_tracks(
+        self, playlist_id: str
+    ) -> AbstractContextManager[Callable[[TrackRecord], None]]:
+        return self._exporting(
+            lambda: self._get_playlist_path(playlist_id),
+            partial(_tracks_to_table, is_in_playlist=True),
+        )
+
+    def is_playlist_missing(self, playlist_id: str) -> bool:
+        """
+        Whether the export is enabled but has no partition for the playlist yet,
+        like when it's just been enabled.
+        """
+        return self.is_enabled and not self._get_playlist_path(playlist_id).exists()
+
+    def remove_stale_playlist_partitions(self, manifest: PlaylistManifest) -> None:
+        """Deletes the partitions of playlists that aren't in manifest or are empty."""
+        if not self.is_enabled:
+            return
+        playlist_ids = {
+            playlist_id
+            for playlist_id, entry in manifest.entries.items()
+            if entry.file is not None
+        }
+        dataset_dir = self._get_export_dir() / PLAYLIST_TRACKS_DATASET
+        if not dataset_dir.exists():
+            return
+        for partition_dir in dataset_dir.iterdir():
+            playlist_id = partition_dir.name.removeprefix(PLAYLIST_PARTITION_PREFIX)
+            if partition_dir.is_dir() and playlist_id not in playlist_ids:
+                shutil.rmtree(partition_dir)
+
+
+# Shared by everything that writes to the snapshots repo
+parquet_exporter = ParquetExporter()
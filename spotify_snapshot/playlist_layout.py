@@ -0,0 +1,100 @@
+import os
+import re
+from dataclasses import replace
+
+from spotify_snapshot import outputfileutils
+from spotify_snapshot.content_hashes import content_hashes
+from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.playlist_manifest import PlaylistManifest
+from spotify_snapshot.spotify_snapshot_output_manager import (
+    SpotifySnapshotOutputManager,
+)
+
+logger = get_colorized_logger()
+
+# Tracks files are named "<playlist name> (<playlist ID>).tsv"
+PLAYLIST_FILE_ID_PATTERN = re.compile(r"\(([^()]+)\)\.tsv$")
+
+
+def is_migration_needed(output_manager: SpotifySnapshotOutputManager) -> bool:
+    """
+    Whether any tracks files are laid out differently from the configured layout.
+    Only the top of the playlists directory is looked at, which is small in both
+    layouts once they've been migrated to.
+    """
+    if not output_manager.playlists_dir_path.exists():
+        return False
+    is_sharded = output_manager.playlists_layout == "sharded"
+    with os.scandir(output_manager.playlists_dir_path) as entries:
+        for entry in entries:
+            if is_sharded and entry.is_file() and entry.name.endswith(".tsv"):
+                return True
+            if not is_sharded and entry.is_dir():
+                return True
+    return False
+
+
+def migrate_playlists_layout(output_manager: SpotifySnapshotOutputManager) -> int:
+    """
+    Moves every tracks file to where it goes in the configured layout, and updates
+    the playlist manifest to match, so that moving doesn't make every playlist get
+    fetched again. Every move is recorded as a written file, so the next commit
+    stages it as a rename and `git log --follow` still finds each file's history.
+
+    Returns:
+        How many files were moved
+    """
+    playlists_dir_path = output_manager.playlists_dir_path
+    moved_files: dict[str, str] = {}
+    for tracks_file in sorted(playlists_dir_path.rglob("*.tsv")):
+        match = PLAYLIST_FILE_ID_PATTERN.search(tracks_file.name)
+        if match is None:
+            logger.warning(
+                f"<yellow>Not moving {tracks_file}, since there's no playlist ID in"
+                " its name</yellow>"
+            )
+            continue
+        new_tracks_file = (
+            output_manager.get_playlist_dir_path(match.group(1)) / tracks_file.name
+        )
+        if new_tracks_file == tracks_file:
+            continue
+        new_tracks_file.parent.mkdir(parents=True, exist_ok=True)
+        tracks_file.rename(new_tracks_file)
+        outputfileutils.written_files.add(tracks_file)
+        outputfileutils.written_files.add(new_tracks_file)
+        content_hashes.remove(tracks_file)
+        moved_files[tracks_file.relative_to(output_manager.base_dir).as_posix()] = (
+            new_tracks_file.relative_to(output_manager.base_dir).as_posix()
+        )
+
+    # Shard directories that were moved out of are empty now
+    for directory in sorted(playlists_dir_path.iterdir()):
+        if directory.is_dir() and not any(directory.iterdir()):
+            directory.rmdir()
+
+    manifest_path = output_manager.playlists_manifest_path
+    if moved_files and manifest_path.exists():
+        manifest = PlaylistManifest.load(manifest_path)
+        for playlist_id, entry in manifest.entries.items():
+            if entry.file in moved_files:
+                manifest.entries[playlist_id] = replace(
+                    entry, file=moved_files[entry.file]
+                )
+        manifest.save(manifest_path)
+        outputfileutils.written_files.add(manifest_path)
+
+    return len(moved_files)
+
+
+def migrate_playlists_layout_if_needed(
+    output_manager: SpotifySnapshotOutputManager,
+) -> None:
+    if not is_migration_needed(output_manager):
+        return
+    logger.info(
+        f"<blue>Moving tracks files to the {output_manager.playlists_layout}"
+        " playlists layout...</blue>"
+    )
+    moved_file_count = migrate_playlists_layout(output_manager)
+    logger.info(f"<green>Moved {moved_file_count} tracks files</green>")
@@ -0,0 +1,132 @@
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from spotify_snapshot.logging import get_colorized_logger
+
+logger = get_colorized_logger()
+
+MANIFEST_VERSION = 2
+
+
+@dataclass
+class PlaylistManifestEntry:
+    snapshot_id: str
+    # Path to the playlist's tracks file, relative to the snapshots repo. None if
+    # the playlist was empty when it was backed up, since no file gets written
+    file: str | None
+    name: str = ""
+
+
+def get_name_from_file(file: str | None) -> str:
+    """Best guess at a playlist's name from its tracks file, for manifests written
+    before names were recorded."""
+    if file is None:
+        return ""
+    return Path(file).stem.rsplit(" (", 1)[0].replace("\u2215", "/")
+
+
+@dataclass
+class PlaylistChanges:
+    """Playlists created, deleted and renamed between two manifests, by ID."""
+
+    created: list[PlaylistManifestEntry] = field(default_factory=list)
+    deleted: list[PlaylistManifestEntry] = field(default_factory=list)
+    # (before, after) for each renamed playlist
+    renamed: list[tuple[PlaylistManifestEntry, PlaylistManifestEntry]] = field(
+        default_factory=list
+    )
+
+
+@dataclass
+class PlaylistManifest:
+    """
+    Records the snapshot_id and name of every playlist as of the last time it was
+    backed up, along with the file its tracks were written to. This lives in the
+    snapshots repo so that playlists which haven't changed since the last run can be
+    skipped, and so that what was created, deleted or renamed can be worked out by ID.
+    """
+
+    entries: dict[str, PlaylistManifestEntry] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, manifest_path: Path) -> "PlaylistManifest":
+        """Load the manifest, or return an empty one if it is missing or unreadable."""
+        if not manifest_path.exists():
+            return cls()
+
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                return cls.from_json(f.read())
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(
+                f"<yellow>Could not read playlist manifest at {manifest_path}, all"
+                f" playlists will be backed up: {e}</yellow>"
+            )
+            return cls()
+
+    @classmethod
+    def from_json(cls, manifest_json: str | bytes) -> "PlaylistManifest":
+        """
+        Parse a manifest, e.g. one read out of a commit in the snapshots repo.
+
+        Raises:
+            ValueError, KeyError, TypeError: If the manifest is malformed
+        """
+        manifest_data = json.loads(manifest_json)
+        entries = {}
+        for playlist_id, entry in manifest_data["playlists"].items():
+            entries[playlist_id] = PlaylistManifestEntry(
+                snapshot_id=entry["snapshot_id"],
+                file=entry.get("file"),
+                name=entry.get("name") or get_name_from_file(entry.get("file")),
+            )
+        return cls(entries=entries)
+
+    def save(self, manifest_path: Path) -> None:
+        manifest_data = {
+            "version": MANIFEST_VERSION,
+            "playlists": {
+                playlist_id: asdict(entry)
+                for playlist_id, entry in sorted(self.entries.items())
+            },
+        }
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest_data, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+    def get_unchanged_entry(
+        self, playlist_id: str, snapshot_id: str, base_dir: Path, expected_file: str
+    ) -> PlaylistManifestEntry | None:
+        """
+        Returns the manifest entry for a playlist if it has the same snapshot_id as
+        last time and its backup is still on disk where we expect it to be. Returns
+        None if the playlist needs to be fetched again.
+        """
+        entry = self.entries.get(playlist_id)
+        if entry is None or entry.snapshot_id != snapshot_id:
+            return None
+        if entry.file is None:
+            # The playlist was empty last time, and it hasn't changed since
+            return entry
+        if entry.file != expected_file or not (base_dir / entry.file).exists():
+            return None
+        return entry
+
+    def get_changes_since(self, previous: "PlaylistManifest") -> PlaylistChanges:
+        """Work out which playlists were created, deleted or renamed since previous."""
+        changes = PlaylistChanges()
+        for playlist_id in self.entries.keys() - previous.entries.keys():
+            changes.created.append(self.entries[playlist_id])
+        for playlist_id in previous.entries.keys() - self.entries.keys():
+            changes.deleted.append(previous.entries[playlist_id])
+        for playlist_id in self.entries.keys() & previous.entries.keys():
+            before = previous.entries[playlist_id]
+            after = self.entries[playlist_id]
+            if before.name and after.name and before.name != after.name:
+                changes.renamed.append((before, after))
+
+        changes.created.sort(key=lambda entry: entry.name)
+        changes.deleted.sort(key=lambda entry: entry.name)
+        changes.renamed.sort(key=lambda renamed: renamed[0].name)
+        return changes
@@ -0,0 +1,243 @@
+import json
+import re
+import resource
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlsplit
+
+import requests
+
+from spotify_snapshot.__about__ import __version__
+from spotify_snapshot.logging import get_colorized_logger
+
+logger = get_colorized_logger()
+
+# Upper bounds of the buckets in each endpoint's latency histogram. Anything slower
+# than the last one goes in an overflow bucket
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# How many of the slowest runs of each phase are kept in the report, with details
+SLOWEST_PHASES_TO_REPORT = 10
+# Set on responses that were served from the HTTP cache, rather than sent again
+CACHE_HIT_HEADER = "X-Cache"
+# Spotify IDs are 22 base62 characters. They're replaced in request paths so that
+# e.g. every playlist's tracks endpoint is reported as one endpoint
+SPOTIFY_ID_PATTERN = re.compile(r"/[0-9A-Za-z]{22}(?=/|$)")
+
+
+def get_endpoint_name(method: str | None, url: str | None) -> str:
+    """Turn a request into the name its endpoint is reported under, like
+    'GET /v1/playlists/{id}/tracks'."""
+    path = urlsplit(url or "").path
+    return f"{method or 'GET'} {SPOTIFY_ID_PATTERN.sub('/{id}', path)}"
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (
+        1 if sys.platform == "darwin" else 1024
+    )
+    return round(peak_rss_bytes / (1024 * 1024), 1)
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+@dataclass
+class PhaseStats:
+    count: int = 0
+    total_sec: float = 0.0
+    max_sec: float = 0.0
+    # (duration, details) of the slowest runs, slowest first
+    slowest: list[tuple[float, dict[str, Any]]] = field(default_factory=list)
+
+    def add(self, duration_sec: float, details: dict[str, Any]) -> None:
+        self.count += 1
+        self.total_sec += duration_sec
+        self.max_sec = max(self.max_sec, duration_sec)
+        if (
+            len(self.slowest) < SLOWEST_PHASES_TO_REPORT
+            or duration_sec > self.slowest[-1][0]
+        ):
+            self.slowest.append((duration_sec, details))
+            self.slowest.sort(key=lambda run: run[0], reverse=True)
+            del self.slowest[SLOWEST_PHASES_TO_REPORT:]
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_sec": round(self.total_sec, 4),
+            "mean_sec": round(self.total_sec / self.count, 4),
+            "max_sec": round(self.max_sec, 4),
+            "slowest": [
+                {"duration_sec": round(duration_sec, 4), **details}
+                for duration_sec, details in self.slowest
+            ],
+        }
+
+
+@dataclass
+class EndpointStats:
+    count: int = 0
+    bytes_received: int = 0
+    cache_hits: int = 0
+    statuses: Counter[int] = field(default_factory=Counter)
+    latencies_ms: list[float] = field(default_factory=list)
+
+    def to_json(self) -> dict[str, Any]:
+        latencies_ms = sorted(self.latencies_ms)
+        histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        for latency_ms in latencies_ms:
+            histogram[bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+        bucket_names = [f"<={bound}" for bound in LATENCY_BUCKETS_MS]
+        bucket_names.append(f">{LATENCY_BUCKETS_MS[-1]}")
+        return {
+            "count": self.count,
+            "bytes_received": self.bytes_received,
+            "cache_hits": self.cache_hits,
+            "statuses": {str(status): n for status, n in sorted(self.statuses.items())},
+            "latency_ms": {
+                "min": round(latencies_ms[0], 1),
+                "mean": round(sum(latencies_ms) / len(latencies_ms), 1),
+                "p50": round(_percentile(latencies_ms, 0.5), 1),
+                "p90": round(_percentile(latencies_ms, 0.9), 1),
+                "p99": round(_percentile(latencies_ms, 0.99), 1),
+                "max": round(latencies_ms[-1], 1),
+            },
+            "latency_histogram_ms": dict(zip(bucket_names, histogram)),
+        }
+
+
+class Profiler:
+    """
+    Records how long each phase of a run takes, and how every request to the API
+    went (latency, size, status, whether it came from the HTTP cache), so that a
+    report of where the time went can be written at the end of the run.
+
+    Does nothing until enabled, so the instrumentation throughout the code costs
+    next to nothing on normal runs.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._start_time = time.perf_counter()
+        self._start_cpu_time = time.process_time()
+        self._started_at = datetime.now(tz=timezone.utc)
+        self._phases: defaultdict[str, PhaseStats] = defaultdict(PhaseStats)
+        self._endpoints: defaultdict[str, EndpointStats] = defaultdict(EndpointStats)
+        # Always reported, even when nothing had to be retried
+        self._counters: Counter[str] = Counter(
+            {"http_retries": 0, "rate_limited_retries": 0, "read_timeout_retries": 0}
+        )
+
+    def enable(self) -> None:
+        with self._lock:
+            self.enabled = True
+            self._reset()
+
+    @contextmanager
+    def phase(self, name: str, **details: Any) -> Iterator[dict[str, Any]]:
+        """
+        Time everything in the with block (or decorated function) as a run of the
+        phase called name. Yields the phase's details, so more can be added to them
+        once they're known, e.g. how many rows were written.
+        """
+        if not self.enabled:
+            yield details
+            return
+        start_time = time.perf_counter()
+        try:
+            yield details
+        finally:
+            duration_sec = time.perf_counter() - start_time
+            with self._lock:
+                self._phases[name].add(duration_sec, details)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Add n to one of the report's counters, e.g. of requests that were retried."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] += n
+
+    def record_response(
+        self, response: requests.Response, *args: Any, **kwargs: Any
+    ) -> None:
+        """A requests response hook, which records every response to the API."""
+        if not self.enabled:
+            return
+        request = response.request
+        endpoint = get_endpoint_name(request.method if request else None, response.url)
+        is_cache_hit = response.headers.get(CACHE_HIT_HEADER) == "HIT"
+        # Fine to read here, since spotipy never streams responses
+        bytes_received = 0 if is_cache_hit else len(response.content)
+        # Retries done by urllib3 (for 5xx responses) happen inside a single send
+        retries = getattr(response.raw, "retries", None)
+        retry_count = len(retries.history) if retries is not None else 0
+
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats.count += 1
+            stats.bytes_received += bytes_received
+            stats.cache_hits += is_cache_hit
+            stats.statuses[response.status_code] += 1
+            stats.latencies_ms.append(response.elapsed.total_seconds() * 1000)
+            self._counters["http_retries"] += retry_count
+
+    def get_report(self) -> dict[str, Any]:
+        with self._lock:
+            endpoints = {
+                endpoint: stats.to_json()
+                for endpoint, stats in sorted(self._endpoints.items())
+            }
+            statuses: Counter[int] = Counter()
+            for stats in self._endpoints.values():
+                statuses.update(stats.statuses)
+            return {
+                "version": __version__,
+                "started_at": self._started_at.isoformat(),
+                "wall_time_sec": round(time.perf_counter() - self._start_time, 3),
+                "cpu_time_sec": round(time.process_time() - self._start_cpu_time, 3),
+                "peak_rss_mb": get_peak_rss_mb(),
+                "phases": {
+                    name: stats.to_json() for name, stats in self._phases.items()
+                },
+                "requests": {
+                    "count": sum(stats.count for stats in self._endpoints.values()),
+                    "bytes_received": sum(
+                        stats.bytes_received for stats in self._endpoints.values()
+                    ),
+                    "cache_hits": sum(
+                        stats.cache_hits for stats in self._endpoints.values()
+                    ),
+                    "statuses": {
+                        str(status): n for status, n in sorted(statuses.items())
+                    },
+                    "endpoints": endpoints,
+                },
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def write_report(self, path: Path) -> None:
+        report = self.get_report()
+        path.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+        logger.info(f"<green>Wrote profile to</green> {path}")
+
+
+# Shared by everything, so that any part of the code can time itself without the
+# profiler being passed around
+profiler = Profiler()
@@ -0,0 +1,573 @@
+"""
+A SQLite database of what's in the snapshots repo (tracks, saved albums, playlists
+and which tracks are on which playlists), for answering questions like "which
+playlists is this track on?" without reading every TSV file.
+
+The database records which commit it was last brought up to date with, and is
+updated by reindexing just the files that changed between that commit and HEAD.
+
+It also holds the history of every collection (liked songs, saved albums, the list
+of playlists, and each playlist's tracks), as an event for each time an item was
+added to or removed from one. Commits are only read once, and the last one read is
+kept, so each update only reads the commits made since.
+"""
+
+import csv
+import io
+import sqlite3
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+import git
+
+from spotify_snapshot import git_plumbing, history_log
+from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.playlist_layout import PLAYLIST_FILE_ID_PATTERN
+from spotify_snapshot.spotify_snapshot_output_manager import (
+    SpotifySnapshotOutputManager,
+)
+
+logger = get_colorized_logger()
+
+# Bump this when the schema changes, and existing databases are rebuilt
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS index_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    artists TEXT NOT NULL,
+    album TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS liked_songs (
+    track_id TEXT PRIMARY KEY,
+    added_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS saved_albums (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    artists TEXT NOT NULL,
+    added_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    track_count TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    collaborative TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    added_at TEXT NOT NULL,
+    added_by TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS playlist_tracks_by_playlist
+    ON playlist_tracks (playlist_id);
+CREATE INDEX IF NOT EXISTS playlist_tracks_by_track ON playlist_tracks (track_id);
+CREATE TABLE IF NOT EXISTS history_events (
+    -- Events are numbered in the order they happened
+    seq INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    event TEXT NOT NULL,
+    commit_hexsha TEXT NOT NULL,
+    committed_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_events_by_item ON history_events (item_id, seq);
+CREATE INDEX IF NOT EXISTS history_events_by_collection
+    ON history_events (collection, committed_at);
+-- How many rows each item had in each collection as of the last commit read
+CREATE TABLE IF NOT EXISTS history_row_counts (
+    collection TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    PRIMARY KEY (collection, item_id)
+) WITHOUT ROWID;
+"""
+# What's in the snapshots repo as of the indexed commit
+CURRENT_TABLES = (
+    "tracks",
+    "liked_songs",
+    "saved_albums",
+    "playlists",
+    "playlist_tracks",
+)
+HISTORY_TABLES = ("history_events", "history_row_counts")
+TABLES = ("index_state", *CURRENT_TABLES, *HISTORY_TABLES)
+
+# Tracks that aren't liked or on any playlist any more
+DELETE_UNREFERENCED_TRACKS = """
+DELETE FROM tracks
+WHERE NOT EXISTS (
+    SELECT 1 FROM playlist_tracks WHERE track_id = tracks.id
+) AND NOT EXISTS (
+    SELECT 1 FROM liked_songs WHERE track_id = tracks.id
+)
+"""
+
+ADDED_EVENT = "added"
+REMOVED_EVENT = "removed"
+# How many commits are read before their events are saved, so that an interrupted
+# update of a long history doesn't have to start over
+HISTORY_COMMITS_PER_TRANSACTION = 500
+
+
+@dataclass
+class TrackSearchResult:
+    id: str
+    name: str
+    artists: str
+    album: str
+    # When the track was liked, if it's a liked song
+    liked_at: str | None
+    # (playlist name, when the track was added to it) for each playlist it's on
+    playlists: list[tuple[str, str]] = field(default_factory=list)
+
+
+@dataclass
+class HistoryEvent:
+    collection: str
+    item_id: str
+    name: str
+    # ADDED_EVENT or REMOVED_EVENT
+    event: str
+    commit_hexsha: str
+    # Seconds since the epoch
+    committed_at: int
+
+
+@dataclass
+class AlbumSearchResult:
+    id: str
+    name: str
+    artists: str
+    added_at: str
+
+
+def _read_tsv_blob(tree: git.Tree, path: str) -> list[list[str]]:
+    """Every row of a TSV file in a commit, except the header."""
+    rows = csv.reader(
+        io.StringIO(tree[path].data_stream.read().decode("utf-8"), newline=""),
+        delimiter="\t",
+    )
+    next(rows, None)
+    return [row for row in rows if row]
+
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class QueryIndex:
+    def __init__(self, path: Path, connection: sqlite3.Connection):
+        self.path = path
+        self.connection = connection
+
+    @staticmethod
+    def get_path(repo_filepath: Path) -> Path:
+        """The database is kept next to the snapshots repo, rather than in it."""
+        return repo_filepath.with_name(f"{repo_filepath.name}-index.sqlite3")
+
+    @classmethod
+    def open(cls, path: Path) -> "QueryIndex":
+        """Opens the database at path, creating it (or rebuilding an outdated one)."""
+        connection = sqlite3.connect(path)
+        index = cls(path, connection)
+        if index._get_state("schema_version") != str(SCHEMA_VERSION):
+            with connection:
+                for table in TABLES:
+                    connection.execute(f"DROP TABLE IF EXISTS {table}")
+                connection.executescript(SCHEMA)
+                index._set_state("schema_version", str(SCHEMA_VERSION))
+        return index
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _get_state(self, key: str) -> str | None:
+        try:
+            row = self.connection.execute(
+                "SELECT value FROM index_state WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.OperationalError:  # No index_state table yet
+            return None
+        return row[0] if row is not None else None
+
+    def _set_state(self, key: str, value: str) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO index_state (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+
+    @property
+    def indexed_commit(self) -> str | None:
+        """The commit the index is up to date with."""
+        return self._get_state("indexed_commit")
+
+    def update(self, repo: git.Repo) -> int:
+        """
+        Brings the index up to date with HEAD, by reindexing the files that changed
+        since the commit it was last updated to. If that commit is missing (e.g.
+        history was rewritten), everything is reindexed.
+
+        Returns:
+            How many files were reindexed
+        """
+        head_commit = git_plumbing.get_head_commit(repo)
+        if head_commit is None or head_commit.hexsha == self.indexed_commit:
+            return 0
+
+        base_tree_hexsha = git_plumbing.EMPTY_TREE_HEXSHA
+        is_rebuild = True
+        if self.indexed_commit is not None:
+            try:
+                base_tree_hexsha = repo.commit(self.indexed_commit).tree.hexsha
+                is_rebuild = False
+            except (ValueError, git.BadName):
+                logger.warning(
+                    f"<yellow>Indexed commit {self.indexed_commit} isn't in the repo"
+                    " any more, so rebuilding the index</yellow>"
+                )
+
+        # Renames are left as a deletion and an addition, so that the old file is
+        # always removed before the new one is added
+        fields = repo.git.diff_tree(
+            "-r",
+            "-z",
+            "--no-renames",
+            "--name-status",
+            base_tree_hexsha,
+            head_commit.tree.hexsha,
+        ).split("\0")
+        changes = list(zip(fields[0::2], fields[1::2]))
+        deleted_paths = [path for status, path in changes if status == "D"]
+        updated_paths = [path for status, path in changes if status != "D"]
+
+        with self.connection:
+            if is_rebuild:
+                for table in CURRENT_TABLES:
+                    self.connection.execute(f"DELETE FROM {table}")
+            for path in deleted_paths:
+                self._remove_file(path)
+            for path in updated_paths:
+                self._remove_file(path)
+                self._add_file(head_commit.tree, path)
+            self.connection.execute(DELETE_UNREFERENCED_TRACKS)
+            self._set_state("indexed_commit", head_commit.hexsha)
+        return len(changes)
+
+    def _get_playlist_id(self, path: str) -> str | None:
+        if not path.startswith("playlists/"):
+            return None
+        match = PLAYLIST_FILE_ID_PATTERN.search(path)
+        return match.group(1) if match is not None else None
+
+    def _remove_file(self, path: str) -> None:
+        output_manager = SpotifySnapshotOutputManager.get_instance()
+        if path == output_manager.liked_songs_filename:
+            self.connection.execute("DELETE FROM liked_songs")
+        elif path == output_manager.albums_filename:
+            self.connection.execute("DELETE FROM saved_albums")
+        elif path == output_manager.playlists_index_filename:
+            self.connection.execute("DELETE FROM playlists")
+        elif (playlist_id := self._get_playlist_id(path)) is not None:
+            self.connection.execute(
+                "DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,)
+            )
+
+    def _add_tracks(self, rows: list[list[str]]) -> None:
+        # Track rows start with name, artists and album, and end with the ID
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO tracks (id, name, artists, album)"
+            " VALUES (?, ?, ?, ?)",
+            ((row[-1], row[0], row[1], row[2]) for row in rows),
+        )
+
+    def _add_file(self, tree: git.Tree, path: str) -> None:
+        output_manager = SpotifySnapshotOutputManager.get_instance()
+        if path == output_manager.liked_songs_filename:
+            rows = _read_tsv_blob(tree, path)
+            self._add_tracks(rows)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO liked_songs (track_id, added_at) VALUES (?, ?)",
+                ((row[4], row[3]) for row in rows),
+            )
+        elif path == output_manager.albums_filename:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO saved_albums (id, name, artists, added_at)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    (row[3], row[0], row[1], row[2])
+                    for row in _read_tsv_blob(tree, path)
+                ),
+            )
+        elif path == output_manager.playlists_index_filename:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO playlists"
+                " (id, name, description, track_count, owner, collaborative)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (row[5], row[0], row[1], row[2], row[3], row[4])
+                    for row in _read_tsv_blob(tree, path)
+                ),
+            )
+        elif (playlist_id := self._get_playlist_id(path)) is not None:
+            rows = _read_tsv_blob(tree, path)
+            self._add_tracks(rows)
+            self.connection.executemany(
+                "INSERT INTO playlist_tracks"
+                " (playlist_id, track_id, added_at, added_by) VALUES (?, ?, ?, ?)",
+                ((playlist_id, row[5], row[3], row[4]) for row in rows),
+            )
+
+    def search_tracks(self, term: str, limit: int) -> list[TrackSearchResult]:
+        """Tracks with this ID, or with term in their name or artists."""
+        pattern = f"%{_escape_like(term)}%"
+        results = [
+            TrackSearchResult(
+                id=track_id, name=name, artists=artists, album=album, liked_at=liked_at
+            )
+            for track_id, name, artists, album, liked_at in self.connection.execute(
+                """
+                SELECT tracks.id, tracks.name, tracks.artists, tracks.album,
+                    liked_songs.added_at
+                FROM tracks
+                LEFT JOIN liked_songs ON liked_songs.track_id = tracks.id
+                WHERE tracks.id = ?
+                    OR tracks.name LIKE ? ESCAPE '\\'
+                    OR tracks.artists LIKE ? ESCAPE '\\'
+                ORDER BY tracks.name, tracks.artists
+                LIMIT ?
+                """,
+                (term, pattern, pattern, limit),
+            )
+        ]
+        for result in results:
+            result.playlists = self.connection.execute(
+                """
+                SELECT COALESCE(playlists.name, playlist_tracks.playlist_id),
+                    playlist_tracks.added_at
+                FROM playlist_tracks
+                LEFT JOIN playlists ON playlists.id = playlist_tracks.playlist_id
+                WHERE playlist_tracks.track_id = ?
+                ORDER BY 1
+                """,
+                (result.id,),
+            ).fetchall()
+        return results
+
+    def search_saved_albums(self, term: str, limit: int) -> list[AlbumSearchResult]:
+        """Saved albums with this ID, or with term in their name or artists."""
+        pattern = f"%{_escape_like(term)}%"
+        return [
+            AlbumSearchResult(*row)
+            for row in self.connection.execute(
+                """
+                SELECT id, name, artists, added_at FROM saved_albums
+                WHERE id = ? OR name LIKE ? ESCAPE '\\' OR artists LIKE ? ESCAPE '\\'
+                ORDER BY name, artists
+                LIMIT ?
+                """,
+                (term, pattern, pattern, limit),
+            )
+        ]
+
+    @property
+    def history_cursor(self) -> str | None:
+        """The last commit whose changes are in the history."""
+        return self._get_state("history_cursor")
+
+    def update_history(self, repo: git.Repo) -> int:
+        """
+        Reads the changes made by every commit since the history cursor, and records
+        an event each time an item was added to a collection it wasn't in, or removed
+        from one so that it isn't in it any more. If the cursor isn't in HEAD's
+        history any more (e.g. history was rewritten), the history is rebuilt.
+
+        Returns:
+            How many commits were read
+        """
+        head_commit = git_plumbing.get_head_commit(repo)
+        cursor = self.history_cursor
+        if head_commit is None or head_commit.hexsha == cursor:
+            return 0
+        if cursor is not None and not git_plumbing.is_in_history(
+            repo, cursor, head_commit.hexsha
+        ):
+            logger.warning(
+                f"<yellow>Commit {cursor} isn't in the snapshots repo's history any"
+                " more, so rebuilding the history</yellow>"
+            )
+            cursor = None
+        if cursor is None:
+            with self.connection:
+                for table in HISTORY_TABLES:
+                    self.connection.execute(f"DELETE FROM {table}")
+
+        row_counts: dict[tuple[str, str], int] = {
+            (collection, item_id): row_count
+            for collection, item_id, row_count in self.connection.execute(
+                "SELECT collection, item_id, row_count FROM history_row_counts"
+            )
+        }
+        changed_keys: set[tuple[str, str]] = set()
+        events: list[tuple[str, str, str, str, str, int]] = []
+        commit_count = 0
+        for changes in history_log.iter_commit_changes(repo, cursor):
+            for key, row_count_change in changes.row_count_changes.items():
+                if row_count_change == 0:
+                    continue
+                old_row_count = row_counts.get(key, 0)
+                # Can only go below 0 if rows were misread, e.g. half of a row with
+                # a newline in it
+                new_row_count = max(0, old_row_count + row_count_change)
+                if (old_row_count == 0) != (new_row_count == 0):
+                    events.append(
+                        (
+                            *key,
+                            changes.names[key],
+                            ADDED_EVENT if new_row_count else REMOVED_EVENT,
+                            changes.hexsha,
+                            changes.committed_at,
+                        )
+                    )
+                row_counts[key] = new_row_count
+                changed_keys.add(key)
+            commit_count += 1
+            if commit_count % HISTORY_COMMITS_PER_TRANSACTION == 0:
+                self._save_history(events, row_counts, changed_keys, changes.hexsha)
+        self._save_history(events, row_counts, changed_keys, head_commit.hexsha)
+        return commit_count
+
+    def _save_history(
+        self,
+        events: list[tuple[str, str, str, str, str, int]],
+        row_counts: dict[tuple[str, str], int],
+        changed_keys: set[tuple[str, str]],
+        cursor: str,
+    ) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO history_events"
+                " (collection, item_id, name, event, commit_hexsha, committed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                events,
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO history_row_counts"
+                " (collection, item_id, row_count) VALUES (?, ?, ?)",
+                (
+                    (*key, row_counts[key])
+                    for key in changed_keys
+                    if row_counts[key] > 0
+                ),
+            )
+            self.connection.executemany(
+                "DELETE FROM history_row_counts WHERE collection = ? AND item_id = ?",
+                (key for key in changed_keys if row_counts[key] == 0),
+            )
+            self._set_state("history_cursor", cursor)
+        events.clear()
+        changed_keys.clear()
+
+    def _to_history_events(self, rows: Iterable[tuple[Any, ...]]) -> list[HistoryEvent]:
+        return [HistoryEvent(*row) for row in rows]
+
+    def get_item_history(self, item_id: str) -> list[HistoryEvent]:
+        """Every time the item with this ID was added to or removed from anything."""
+        return self._to_history_events(
+            self.connection.execute(
+                """
+                SELECT collection, item_id, name, event, commit_hexsha, committed_at
+                FROM history_events WHERE item_id = ? ORDER BY seq
+                """,
+                (item_id,),
+            )
+        )
+
+    def get_collection_as_of(
+        self, collection: str, timestamp: float
+    ) -> list[HistoryEvent]:
+        """
+        What was in a collection at a point in time, as the event that last added
+        each item to it.
+        """
+        return self._to_history_events(
+            self.connection.execute(
+                """
+                SELECT collection, item_id, name, event, commit_hexsha, committed_at
+                FROM (
+                    SELECT *, ROW_NUMBER() OVER (
+                        PARTITION BY item_id ORDER BY seq DESC
+                    ) AS recency
+                    FROM history_events
+                    WHERE collection = ? AND committed_at <= ?
+                )
+                WHERE recency = 1 AND event = ?
+                ORDER BY name, item_id
+                """,
+                (collection, timestamp, ADDED_EVENT),
+            )
+        )
+
+    def get_collection_name(self, collection: str) -> str:
+        """A name for a collection that's fit to show, e.g. the playlist's name."""
+        if not collection.startswith(history_log.PLAYLIST_COLLECTION_PREFIX):
+            return collection.replace("_", " ").capitalize()
+        playlist_id = collection.removeprefix(history_log.PLAYLIST_COLLECTION_PREFIX)
+        # Playlists that have been deleted are only in the history
+        (name,) = self.connection.execute(
+            """
+            SELECT COALESCE(
+                (SELECT name FROM playlists WHERE id = ?),
+                (
+                    SELECT name FROM history_events
+                    WHERE item_id = ? AND collection = ?
+                    ORDER BY seq DESC LIMIT 1
+                )
+            )
+            """,
+            (playlist_id, playlist_id, history_log.PLAYLISTS_COLLECTION),
+        ).fetchone()
+        return f"Playlist {name or playlist_id}"
+
+
+def update_query_index_if_enabled(repo: git.Repo, repo_filepath: Path) -> None:
+    """
+    Updates the query index after a backup, if it's been created with
+    `spotify-snapshot index`.
+    """
+    index_path = QueryIndex.get_path(repo_filepath)
+    if not index_path.exists():
+        return
+    try:
+        index = QueryIndex.open(index_path)
+        try:
+            reindexed_file_count = index.update(repo)
+            history_commit_count = index.update_history(repo)
+        finally:
+            index.close()
+    # The backup's been committed by now, and the index can be rebuilt later, so
+    # neither a broken database nor a file that can't be read or parsed (which
+    # includes UnicodeDecodeError, a ValueError) should stop it from being pushed
+    except (
+        sqlite3.Error,
+        git.GitCommandError,
+        OSError,
+        ValueError,
+        IndexError,
+    ) as e:
+        logger.warning(f"<yellow>Could not update the query index: {e}</yellow>")
+        return
+    logger.info(
+        f"<green>Updated the query index from {reindexed_file_count} changed files,"
+        f" and its history from {history_commit_count} commits</green>"
+    )
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections.abc import Callable, Mapping
+from typing import TypeVar
+
+from spotipy.exceptions import SpotifyException
+
+from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.profiling import profiler
+
+logger = get_colorized_logger()
+
+T = TypeVar("T")
+
+# How long to back off for when Spotify rate limits us without saying how long for
+DEFAULT_RETRY_AFTER_SEC = 5.0
+
+
+class RateLimiter:
+    """
+    An adaptive token bucket shared by everything that talks to the Spotify API, so
+    that the total request rate stays within Spotify's limits no matter how many
+    threads are making requests.
+
+    Requests are sent as fast as the bucket allows. When Spotify responds with a 429,
+    every caller pauses for as long as the Retry-After header asks and the rate is
+    halved. After that, each successful request nudges the rate back up a little, so
+    we slowly probe our way back towards the limit.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 10.0,
+        min_requests_per_second: float = 0.5,
+        max_requests_per_second: float = 20.0,
+        burst: int = 10,
+        increase_per_success: float = 0.05,
+        max_rate_limited_retries: int = 5,
+    ):
+        self.requests_per_second = requests_per_second
+        self.min_requests_per_second = min_requests_per_second
+        self.max_requests_per_second = max_requests_per_second
+        self.burst = burst
+        self.increase_per_success = increase_per_success
+        self.max_rate_limited_retries = max_rate_limited_retries
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last_refill_time = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(0.0, now - self._last_refill_time)
+        self._tokens = min(
+            float(self.burst), self._tokens + elapsed * self.requests_per_second
+        )
+        self._last_refill_time = now
+
+    def wait(self) -> None:
+        """Block until the caller is allowed to send its next request."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait_time = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait_time = (1 - self._tokens) / self.requests_per_second
+            time.sleep(wait_time)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.requests_per_second = min(
+                self.max_requests_per_second,
+                self.requests_per_second + self.increase_per_success,
+            )
+
+    def record_rate_limited(self, retry_after_sec: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            # Other threads will probably have been rate limited at around the same
+            # time, so only slow down for the first 429 of each pause
+            if now >= self._paused_until:
+                self.requests_per_second = max(
+                    self.min_requests_per_second, self.requests_per_second / 2
+                )
+            self._paused_until = max(self._paused_until, now + retry_after_sec)
+            # Start refilling from empty once the pause is over, rather than
+            # letting a whole burst through the moment it ends
+            self._tokens = 0.0
+            self._last_refill_time = self._paused_until
+
+    def call(self, request: Callable[[], T]) -> T:
+        """
+        Sends a request once the bucket allows it, backing off and trying again if
+        Spotify says we're being rate limited.
+
+        Raises:
+            SpotifyException: If the request fails for any other reason, or is still
+                rate limited after max_rate_limited_retries retries
+        """
+        for attempt in range(1, self.max_rate_limited_retries + 1):
+            self.wait()
+            try:
+                result = request()
+            except SpotifyException as e:
+                if e.http_status != 429:
+                    raise
+                retry_after_sec = get_retry_after_sec(e.headers)
+                profiler.count("rate_limited_retries")
+                logger.warning(
+                    "<yellow>Rate limited by Spotify. Retrying in"
+                    f" {retry_after_sec} seconds... (Attempt"
+                    f" {attempt}/{self.max_rate_limited_retries})</yellow>"
+                )
+                self.record_rate_limited(retry_after_sec)
+                continue
+            self.record_success()
+            return result
+
+        # Out of retries, so if this one is rate limited too it's left to the caller
+        self.wait()
+        result = request()
+        self.record_success()
+        return result
+
+
+def get_retry_after_sec(headers: Mapping[str, str] | None) -> float:
+    """Parse the Retry-After header of a 429 response, which Spotify sets in seconds."""
+    if not headers:
+        return DEFAULT_RETRY_AFTER_SEC
+    try:
+        return max(0.0, float(headers.get("Retry-After", DEFAULT_RETRY_AFTER_SEC)))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER_SEC
@@ -1,37 +1,82 @@
+import hashlib
+import itertools
+import os
 import time
-from os import chmod, getenv
+from collections.abc import Callable, Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import AbstractContextManager
+from functools import partial
 from pathlib import Path
 
 import requests
 import spotipy
+from urllib3.util.retry import Retry
 
 from spotify_snapshot import outputfileutils
+from spotify_snapshot.checkpoint import CheckpointStore, PageCheckpoint
+from spotify_snapshot.config import SpotifySnapshotConfig
+from spotify_snapshot.content_hashes import content_hashes
+from spotify_snapshot.http_cache import ResponseCache, create_session
 from spotify_snapshot.logging import get_colorized_logger
+from spotify_snapshot.parquet_export import parquet_exporter
+from spotify_snapshot.playlist_manifest import PlaylistManifest, PlaylistManifestEntry
+from spotify_snapshot.profiling import profiler
+from spotify_snapshot.ratelimit import RateLimiter
+from spotify_snapshot.sync_state import CollectionSyncState, SyncStateStore
 from spotify_snapshot.spotify_datatypes import (
-    DeletedPlaylist,
-    SpotifyPlaylist,
-    SpotifyPlaylistsResponse,
-    SpotifyPlaylistTrackItem,
-    SpotifyPlaylistTracksResponse,
+    AlbumRecord,
+    PlaylistRecord,
+    RecordPage,
+    RecordT,
+    TrackRecord,
+    get_unsplittable_artists,
 )
 from spotify_snapshot.spotify_snapshot_output_manager import (
     SpotifySnapshotOutputManager,
 )
-from spotify_snapshot.exceptions import InvalidSpotifyCredentialsError
-from dataclasses import dataclass
+from spotify_snapshot.exceptions import (
+    IncompleteFetchError,
+    InvalidSpotifyCredentialsError,
+)
+from dataclasses import dataclass, replace
+from typing import Any, TypeVar
 import keyring
 from rich.prompt import Prompt
 
 logger = get_colorized_logger()
 
+T = TypeVar("T")
+
 #####
 # Spotify Operations
 #####
 
-API_REQUEST_SLEEP_TIME_SEC = 0.5
+# Every request to the API goes through this, so that fetching concurrently
+# doesn't push the total request volume over Spotify's rate limits
+rate_limiter = RateLimiter()
+# How many playlists to fetch at once, unless configured otherwise
+DEFAULT_PLAYLIST_FETCH_WORKERS = 4
+# How many pages of a single collection to fetch at once
+DEFAULT_PAGE_FETCH_WORKERS = 4
+# How often to fetch every page of a collection that is otherwise fetched
+# incrementally, unless configured otherwise
+DEFAULT_FULL_SYNC_INTERVAL_HOURS = 168
+DEFAULT_HTTP_CACHE_MAX_MB = 64
+API_PREFIX_ENV_VAR = "SPOTIFY_SNAPSHOT_API_PREFIX"
 # For albums, playlists, etc - the Spotify API has a (current) max of 50 things
 # it can fetch at a time
 API_REQUEST_LIMIT = 50
+# The max page size varies by endpoint, and bigger pages mean fewer requests
+SAVED_TRACKS_REQUEST_LIMIT = 50
+SAVED_ALBUMS_REQUEST_LIMIT = 50
+PLAYLIST_ITEMS_REQUEST_LIMIT = 100
+PLAYLIST_ITEMS_FIELDS = (
+    "items(added_at,added_by(id),"
+    "track(name,id,linked_from(id),artists(name),album(name,id))),next,total"
+)
+# Asking for results in the user's own market means the API leaves out the list of
+# markets each track and album is available in, which is most of the payload
+MARKET = "from_token"
 
 
 @dataclass
@@ -138,128 +183,405 @@ class SpotifyCredentialsManager:
             exit(1)
 
 
+#####
+# Ingest
+#
+# Raw API items carry a lot that never makes it into the TSV files (images, URLs,
+# and so on), so each page is turned into compact records as soon as it arrives,
+# and the raw JSON is dropped.
+#####
+
+
+def _to_record_page(
+    results: dict[str, Any], from_api_item: Callable[[dict[str, Any]], RecordT | None]
+) -> RecordPage[RecordT]:
+    records: list[RecordT] = []
+    skipped_items = []
+    for item in results["items"]:
+        record = from_api_item(item)
+        if record is None:
+            skipped_items.append(item)
+        else:
+            records.append(record)
+    return RecordPage(
+        records=records,
+        skipped_items=skipped_items,
+        next=results["next"],
+        total=results["total"],
+    )
+
+
+def _call_with_retries(
+    request: Callable[[], T],
+    max_retries: int = 3,
+    retry_delay: float = 2.0,
+) -> T:
+    """
+    Sends a request to the API through rate_limiter, retrying if it times out.
+
+    Raises:
+        requests.exceptions.ReadTimeout: If the request timed out on every attempt
+    """
+    logger = get_colorized_logger()
+    for attempt in range(1, max_retries):
+        try:
+            return rate_limiter.call(request)
+        except requests.exceptions.ReadTimeout:
+            profiler.count("read_timeout_retries")
+            wait_time = retry_delay * attempt
+            logger.info(
+                f"<yellow>Request timed out. Retrying in {wait_time} seconds..."
+                f" (Attempt {attempt}/{max_retries})</yellow>"
+            )
+            time.sleep(wait_time)
+
+    # This is the last attempt, so a timeout is left for the caller to handle
+    return rate_limiter.call(request)
+
+
 def _fetch_paginated_tracks(
-    sp_client: spotipy.Spotify,
-    initial_results: SpotifyPlaylistTracksResponse,
+    initial_results: RecordPage[RecordT],
+    fetch_page: Callable[[int], RecordPage[RecordT]],
     max_retries: int = 3,
     retry_delay: float = 2.0,
-) -> dict:
+    page_size: int = API_REQUEST_LIMIT,
+    max_workers: int = DEFAULT_PAGE_FETCH_WORKERS,
+    item_kind: str = "tracks",
+    checkpoint: PageCheckpoint[RecordT] | None = None,
+) -> Iterator[RecordT]:
     """Helper function to handle paginated track fetching from Spotify API.
 
+    The first page's total is used to work out the offset of every remaining page up
+    front, and they are fetched concurrently rather than following `next` links.
+    Each page is saved to checkpoint as soon as it arrives, and pages already in
+    checkpoint aren't fetched again.
+
+    Records are yielded as their pages arrive, so that they can be written while the
+    rest are still being fetched. A track that's on a playlist more than once is
+    yielded each time, for write_items_to_file's id_lambda to pick one.
+
     Args:
-        sp_client: Authenticated Spotify client
         initial_results: First page of results from API
+        fetch_page: Fetches the page of results starting at an offset
         max_retries: Maximum number of retry attempts for failed requests
         retry_delay: Delay in seconds between retries
+        page_size: Number of items requested per page by fetch_page
+        max_workers: Maximum number of pages to fetch at once
+        item_kind: What's being fetched, for logging
+        checkpoint: Where to save pages, so that a later run can resume from them
 
-    Returns:
-        Dictionary of track_id -> track_item
+    Yields:
+        Every TrackRecord (or AlbumRecord), in the order the API has them
+
+    Raises:
+        IncompleteFetchError: If any page timed out on every attempt, once the rest
+            have been yielded
     """
     logger = get_colorized_logger()
-    tracks_dict = {}
     total_tracks_fetched = 0
-    results = initial_results
     skipped_tracks = []
 
-    while True:
-        result_items: list[SpotifyPlaylistTrackItem] = results["items"]
-        total_tracks_fetched += len(result_items)
+    def add_page(results: RecordPage[RecordT]) -> list[RecordT]:
+        nonlocal total_tracks_fetched
+        total_tracks_fetched += len(results.records) + len(results.skipped_items)
         logger.info(
-            f"<green>Fetched</green> {total_tracks_fetched} / {results['total']} <green>tracks</green>"
+            f"<green>Fetched</green> {total_tracks_fetched} / {results.total}"
+            f" <green>{item_kind}</green>"
         )
+        skipped_tracks.extend(results.skipped_items)
+        return results.records
 
-        for item in result_items:
-            track = item["track"]
-            if track is None:
-                skipped_tracks.append(item)
-                continue
-            tracks_dict[track["id"]] = item
+    def fetch_and_checkpoint_page(offset: int) -> RecordPage[RecordT]:
+        results = _call_with_retries(
+            partial(fetch_page, offset), max_retries, retry_delay
+        )
+        if checkpoint is not None:
+            checkpoint.save(offset, results)
+        return results
 
-        if results["next"]:
-            time.sleep(API_REQUEST_SLEEP_TIME_SEC)
+    yield from add_page(initial_results)
 
-            # Add retry logic for the next() call
-            for attempt in range(max_retries):
+    checkpointed_pages = checkpoint.load() if checkpoint is not None else {}
+    if checkpointed_pages:
+        logger.info(
+            f"<green>Resuming from</green> {len(checkpointed_pages)}"
+            f" <green>checkpointed pages of {item_kind}</green>"
+        )
+
+    remaining_offsets = range(page_size, initial_results.total, page_size)
+    failed_offsets = []
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="page-fetch"
+    ) as executor:
+        futures = {
+            offset: executor.submit(fetch_and_checkpoint_page, offset)
+            for offset in remaining_offsets
+            if offset not in checkpointed_pages
+        }
+        try:
+            # Pages are yielded in offset order, so that if a track is on a
+            # playlist more than once, the same occurrence is kept as a serial
+            # crawl would keep
+            for offset in remaining_offsets:
+                if offset in checkpointed_pages:
+                    yield from add_page(checkpointed_pages.pop(offset))
+                    continue
                 try:
-                    results = sp_client.next(results)
-                    break
+                    results = futures[offset].result()
                 except requests.exceptions.ReadTimeout:
-                    if attempt == max_retries - 1:
-                        logger.exception(
-                            f"<red>Failed to fetch tracks after {max_retries} attempts due to timeout</red>"
-                        )
-                        logger.warning(
-                            f"<yellow>Successfully fetched {total_tracks_fetched} tracks before error. Continuing...</yellow>"
-                        )
-                        return tracks_dict
-
-                    wait_time = retry_delay * (attempt + 1)
-                    logger.info(
-                        f"<yellow>Request timed out. Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{max_retries})</yellow>"
+                    logger.exception(
+                        f"<red>Failed to fetch {item_kind} at offset {offset} after"
+                        f" {max_retries} attempts due to timeout</red>"
                     )
-                    time.sleep(wait_time)
-        else:
-            break
+                    failed_offsets.append(offset)
+                    continue
+                yield from add_page(results)
+        finally:
+            # If the records stop being read, e.g. because writing them failed,
+            # don't carry on fetching pages nobody will read
+            for future in futures.values():
+                future.cancel()
+
+    # Writing out what we have would look like a lot of tracks had been removed, so
+    # give up instead. Every other page is checkpointed, so a rerun only has to
+    # fetch the ones that failed
+    if failed_offsets:
+        raise IncompleteFetchError(
+            f"Failed to fetch {len(failed_offsets)} pages of {item_kind}. Run the"
+            " backup again to resume"
+        )
 
     if skipped_tracks:
-        logger.info(f"<red>Skipped</red> {len(skipped_tracks)} tracks")
+        logger.info(f"<red>Skipped</red> {len(skipped_tracks)} {item_kind}")
         for track in skipped_tracks:
             logger.info(f"<red>  • {track}</red>")
-    return tracks_dict
 
 
-def get_liked_songs(sp_client: spotipy.Spotify) -> dict:
+def _fetch_new_items_incrementally(
+    collection_name: str,
+    initial_results: RecordPage[RecordT],
+    fetch_page: Callable[[int], RecordPage[RecordT]],
+    page_size: int,
+    tsv_path: Path,
+    record_from_row: Callable[[list[str], Mapping[str, list[str]]], RecordT],
+    sync_state: CollectionSyncState | None,
+    full_sync_interval_hours: float,
+) -> Iterator[RecordT] | None:
+    """
+    For collections the API returns newest first, fetches pages only until a full page
+    has nothing on it that isn't already in the collection's TSV file, and returns the
+    records read back from that file followed by the new ones. Only the IDs in the file
+    are held in memory, since its records are read back again as they're iterated
+    over. A record that's in both comes twice, so it needs writing with an id_lambda,
+    which keeps the new one.
+
+    Removals can't be seen this way, so this returns None (meaning every page needs to
+    be fetched) if a full sync is due, or if the API's total doesn't match what it was
+    last time plus the number of new records.
+    """
     logger = get_colorized_logger()
-    logger.info("<blue>Getting liked songs</blue>...")
-    initial_results = sp_client.current_user_saved_tracks(API_REQUEST_LIMIT)
-    liked_songs = _fetch_paginated_tracks(sp_client, initial_results)
-    return liked_songs
+    if sync_state is None or full_sync_interval_hours <= 0:
+        return None
+    if sync_state.is_full_sync_due(full_sync_interval_hours):
+        logger.info(
+            f"<yellow>Over {full_sync_interval_hours} hours since all {collection_name}"
+            " were fetched, fetching them all again</yellow>"
+        )
+        return None
+    # Without them, names like "Earth, Wind & Fire" would be read back as two
+    # artists, so the collection has to be fetched to find out
+    known_artists = sync_state.artists
+    if known_artists is None:
+        return None
+
+    # The ID is the last column of every collection's file, and empty for local files
+    previous_ids = {row[-1] or None for row in outputfileutils.read_tsv_rows(tsv_path)}
+    if len(previous_ids) != sync_state.row_count:
+        logger.info(
+            f"<yellow>{tsv_path} has changed since it was last written, fetching all"
+            f" {collection_name}</yellow>"
+        )
+        return None
 
+    new_records: dict[str | None, RecordT] = {}
+    results = initial_results
+    offset = 0
+    while True:
+        has_new_records = False
+        for record in results.records:
+            if record.id not in previous_ids:
+                has_new_records = True
+            new_records[record.id] = record
+
+        is_full_page = len(results.records) + len(results.skipped_items) == page_size
+        if not results.next or (is_full_page and not has_new_records):
+            break
+        offset += page_size
+        results = _call_with_retries(partial(fetch_page, offset))
+
+    new_record_count = len(new_records.keys() - previous_ids)
+    if results.total != sync_state.total + new_record_count:
+        logger.info(
+            f"<yellow>Some {collection_name} have been removed since the last backup,"
+            " fetching them all</yellow>"
+        )
+        return None
 
-def get_tracks_from_playlist(
-    sp_client: spotipy.Spotify,
-    playlist: SpotifyPlaylist,
-) -> dict:
-    logger = get_colorized_logger()
     logger.info(
-        f"<blue>Backing up playlist:</blue> <yellow><bold>{playlist['name']}</bold></yellow>"
+        f"<green>Found</green> {new_record_count} <green>new {collection_name}"
+        f" in</green> {offset // page_size + 1} <green>pages</green>"
     )
-    initial_results = sp_client.playlist_tracks(
-        playlist_id=playlist["id"],
-        fields="items(added_at,added_by(id),track(name,id,artists(name),album(name,id))),next,total",
-        limit=API_REQUEST_LIMIT,
+    previous_records = (
+        record_from_row(row, known_artists)
+        for row in outputfileutils.read_tsv_rows(tsv_path)
     )
-    return _fetch_paginated_tracks(sp_client, initial_results)
+    return itertools.chain(previous_records, new_records.values())
 
 
-def get_saved_albums(sp_client: spotipy.Spotify) -> dict:
-    logger = get_colorized_logger()
-    logger.info("<green>Fetching saved albums</green>...")
-    saved_albums = {}
-    results = sp_client.current_user_saved_albums(API_REQUEST_LIMIT)
+def get_saved_collection_checkpoint_key(
+    name: str, first_page: RecordPage[TrackRecord] | RecordPage[AlbumRecord]
+) -> str:
+    """
+    A version of a collection the API returns newest first, for checkpointing its
+    pages. The total alone isn't one: liking a song and unliking another leaves it
+    the same, but moves every offset. Anything newly saved goes on the first page
+    though, so between them the total and the first page change with any change to
+    the collection.
+    """
+    first_page_hash = hashlib.sha1()
+    for record in first_page.records:
+        first_page_hash.update(f"{record.id}\t{record.added_at}\n".encode())
+    return f"{name}:{first_page.total}:{first_page_hash.hexdigest()}"
+
+
+def _backup_saved_collection(
+    collection_name: str,
+    fetch_page: Callable[[int], RecordPage[RecordT]],
+    page_size: int,
+    tsv_path: Path,
+    record_type: type[RecordT],
+    header_row: list[str],
+    record_to_row: Callable[[RecordT], list[str]],
+    exporting: AbstractContextManager[Callable[[RecordT], None]],
+    full_sync_interval_hours: float,
+) -> int:
+    """
+    Fetches a collection from the user's library (which the API returns newest first),
+    incrementally if possible and in full otherwise, and writes its records to
+    tsv_path and the Parquet export as they arrive. Then records its sync state.
 
-    while True:
-        result_items = results["items"]
-        logger.info(f"<green>Fetched</green> {len(result_items)} <green>albums</green>")
+    Returns:
+        The number of records written
+    """
+    sync_states = SyncStateStore.load()
+    sync_state = sync_states.get(tsv_path)
+
+    initial_results = _call_with_retries(partial(fetch_page, 0))
+    records = _fetch_new_items_incrementally(
+        collection_name=collection_name,
+        initial_results=initial_results,
+        fetch_page=fetch_page,
+        page_size=page_size,
+        tsv_path=tsv_path,
+        record_from_row=record_type.from_tsv_row,
+        sync_state=sync_state,
+        full_sync_interval_hours=full_sync_interval_hours,
+    )
+    is_full_sync = records is None
+    if records is None:
+        checkpoints = CheckpointStore.for_output_dir(
+            SpotifySnapshotOutputManager.get_instance().base_dir
+        )
+        records = _fetch_paginated_tracks(
+            initial_results,
+            fetch_page=fetch_page,
+            page_size=page_size,
+            item_kind=collection_name,
+            checkpoint=checkpoints.pages(
+                get_saved_collection_checkpoint_key(tsv_path.name, initial_results),
+                record_type,
+            ),
+        )
 
-        for item in result_items:
-            saved_albums[item["album"]["id"]] = item
+    unsplittable_artists: dict[str, list[str]] = {}
+    with exporting as export_record:
+
+        def on_record_written(record: RecordT) -> None:
+            export_record(record)
+            unsplittable_artists.update(get_unsplittable_artists([record]))
+
+        row_count = outputfileutils.write_items_to_file(
+            items=records,
+            sort_lambda=lambda record: (record.added_at, record.name),
+            item_to_row_lambda=record_to_row,
+            header_row=header_row,
+            output_filename=tsv_path,
+            # Tracks can come twice when they're fetched incrementally
+            id_lambda=lambda record: record.id,
+            on_item_written=on_record_written,
+        )
 
-        if results["next"]:
-            time.sleep(API_REQUEST_SLEEP_TIME_SEC)
-            results = sp_client.next(results)
-        else:
-            break
+    sync_states.set(
+        tsv_path,
+        CollectionSyncState(
+            total=initial_results.total,
+            row_count=row_count,
+            last_full_sync=(
+                time.time()
+                if is_full_sync or sync_state is None
+                else sync_state.last_full_sync
+            ),
+            artists=unsplittable_artists,
+        ),
+    )
+    return row_count
+
+
+def get_tracks_from_playlist(
+    sp_client: spotipy.Spotify,
+    playlist: PlaylistRecord,
+    checkpoints: CheckpointStore | None = None,
+) -> Iterator[TrackRecord]:
+    """Yields the tracks on a playlist as they're fetched."""
+    logger = get_colorized_logger()
+    logger.info(
+        "<blue>Backing up playlist:</blue>"
+        f" <yellow><bold>{playlist.name}</bold></yellow>"
+    )
 
-    return saved_albums
+    def fetch_page(offset: int) -> RecordPage[TrackRecord]:
+        results = sp_client.playlist_tracks(
+            playlist_id=playlist.id,
+            fields=PLAYLIST_ITEMS_FIELDS,
+            limit=PLAYLIST_ITEMS_REQUEST_LIMIT,
+            offset=offset,
+            market=MARKET,
+        )
+        return _to_record_page(results, TrackRecord.from_api_item)
+
+    initial_results = _call_with_retries(partial(fetch_page, 0))
+    return _fetch_paginated_tracks(
+        initial_results,
+        fetch_page=fetch_page,
+        page_size=PLAYLIST_ITEMS_REQUEST_LIMIT,
+        checkpoint=(
+            checkpoints.pages(
+                f"playlist:{playlist.id}:{playlist.snapshot_id}", TrackRecord
+            )
+            if checkpoints is not None
+            else None
+        ),
+    )
 
 
-def get_playlists(sp_client: spotipy.Spotify) -> dict[str, SpotifyPlaylist]:
+@profiler.phase("fetch_playlists")
+def get_playlists(sp_client: spotipy.Spotify) -> dict[str, PlaylistRecord]:
     logger = get_colorized_logger()
-    saved_playlists = {}
-    logger.info(f"<green>Fetching playlists</green>...")
-    results: SpotifyPlaylistsResponse = sp_client.current_user_playlists(
-        API_REQUEST_LIMIT
+    saved_playlists: dict[str, PlaylistRecord] = {}
+    logger.info("<green>Fetching playlists</green>...")
+    # The API's JSON, laid out like SpotifyPlaylistsResponse
+    results: dict[str, Any] = _call_with_retries(
+        partial(sp_client.current_user_playlists, API_REQUEST_LIMIT)
     )
 
     logger.info(
@@ -267,15 +589,14 @@ def get_playlists(sp_client: spotipy.Spotify) -> dict[str, SpotifyPlaylist]:
     )
 
     while True:
-        playlists: list[SpotifyPlaylist] = results["items"]
+        playlists: list[dict[str, Any]] = results["items"]
         logger.info(f"<green>Fetched</green> {len(playlists)} playlists")
 
         for playlist in playlists:
-            saved_playlists[playlist["id"]] = playlist
+            saved_playlists[playlist["id"]] = PlaylistRecord.from_api_item(playlist)
 
         if results["next"]:
-            time.sleep(API_REQUEST_SLEEP_TIME_SEC)
-            results = sp_client.next(results)
+            results = _call_with_retries(partial(sp_client.next, results))
         else:
             break
 
@@ -283,13 +604,13 @@ def get_playlists(sp_client: spotipy.Spotify) -> dict[str, SpotifyPlaylist]:
 
 
 def get_username(sp_client: spotipy.Spotify) -> str:
-    return sp_client.current_user()["display_name"]
+    user: dict[str, Any] = _call_with_retries(sp_client.current_user)
+    return str(user["display_name"])
 
 
 def get_spotify_auth_cache_path() -> Path:
     """Get the path to the Spotify authentication cache file."""
-    base_cache_path = Path(getenv("XDG_CACHE_HOME", Path.home() / ".cache"))
-    cache_path = base_cache_path / "spotify-backup" / "auth_cache"
+    cache_path = SpotifySnapshotConfig.get_cache_dir() / "auth_cache"
     if not cache_path.exists():
         logger.info(f"<green>Creating auth cache file at {cache_path}</green>")
         cache_path.parent.mkdir(parents=True, exist_ok=True)
@@ -298,9 +619,52 @@ def get_spotify_auth_cache_path() -> Path:
     return cache_path
 
 
-def create_spotify_client() -> spotipy.Spotify:
+# Leave 429s to rate_limiter instead of having spotipy retry them itself, so that
+# it knows to slow every request down
+API_RETRY_STATUS_FORCELIST = (500, 502, 503, 504)
+API_RETRY_BACKOFF_FACTOR = 0.8
+
+
+def create_api_session(
+    http_cache_max_mb: int = DEFAULT_HTTP_CACHE_MAX_MB,
+) -> requests.Session:
+    """
+    The same session spotipy would build for itself, but with response caching
+    (unless http_cache_max_mb is 0) and profiling.
+    """
+    return create_session(
+        (
+            ResponseCache(
+                ResponseCache.get_default_dir(),
+                max_size_bytes=http_cache_max_mb * 1024 * 1024,
+            )
+            if http_cache_max_mb > 0
+            else None
+        ),
+        max_retries=Retry(
+            total=spotipy.Spotify.max_retries,
+            connect=None,
+            read=False,
+            allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+            status=spotipy.Spotify.max_retries,
+            backoff_factor=API_RETRY_BACKOFF_FACTOR,
+            status_forcelist=API_RETRY_STATUS_FORCELIST,
+            # Otherwise urllib3 retries any 429 with a Retry-After header itself,
+            # before rate_limiter ever sees it
+            respect_retry_after_header=False,
+        ),
+    )
+
+
+@profiler.phase("create_client")
+def create_spotify_client(
+    http_cache_max_mb: int = DEFAULT_HTTP_CACHE_MAX_MB,
+) -> spotipy.Spotify:
     """Create and return an authenticated Spotify client.
 
+    Unless http_cache_max_mb is 0, API responses are cached on disk and revalidated
+    with their ETag, so responses that haven't changed aren't downloaded again.
+
     Raises:
         InvalidSpotifyCredentialsError: If the provided credentials are invalid
     """
@@ -312,6 +676,8 @@ def create_spotify_client() -> spotipy.Spotify:
 
     cache_handler = spotipy.cache_handler.CacheFileHandler(cache_path=str(cache_path))
 
+    requests_session = create_api_session(http_cache_max_mb)
+
     try:
         client = spotipy.Spotify(
             auth_manager=spotipy.oauth2.SpotifyOAuth(
@@ -325,14 +691,23 @@ def create_spotify_client() -> spotipy.Spotify:
                     "playlist-read-collaborative",
                 ],
             ),
-            backoff_factor=0.8,
+            requests_session=requests_session,
+            backoff_factor=API_RETRY_BACKOFF_FACTOR,
+            status_forcelist=API_RETRY_STATUS_FORCELIST,
         )
     except Exception as e:
         logger.error(f"<red>Error creating Spotify client: {e}</red>")
         raise InvalidSpotifyCredentialsError(f"Invalid credentials: {e}")
 
-    # Spotipy does not set the permissions on the cache file correctly, so we do it manually
-    # I filed https://github.com/spotipy-dev/spotipy/security/advisories/GHSA-pwhh-q4h6-w599
+    # Lets the client be pointed at a stand-in for the API, like the one in benchmarks/
+    api_prefix = os.environ.get(API_PREFIX_ENV_VAR)
+    if api_prefix:
+        logger.warning(f"<yellow>Using the Spotify API at {api_prefix}</yellow>")
+        client.prefix = api_prefix
+
+    # Spotipy does not set the permissions on the cache file correctly, so we do it
+    # manually. I filed
+    # https://github.com/spotipy-dev/spotipy/security/advisories/GHSA-pwhh-q4h6-w599
     # chmod(cache_path, 0o600)
     logger.info("<green>Successfully created Spotify client!</green>")
     return client
@@ -343,65 +718,170 @@ def create_spotify_client() -> spotipy.Spotify:
 #####
 
 
-def get_playlist_file_name(playlist: SpotifyPlaylist | DeletedPlaylist) -> Path:
+def get_playlist_file_name(playlist: PlaylistRecord) -> Path:
     """Generate the file path for a playlist's tracks file.
 
     Args:
-        snapshots_repo_name: Base directory for snapshots
-        playlist: Either a Spotify playlist dict or DeletedPlaylist object
+        playlist: The playlist to get the tracks file of
 
     Returns:
         Path object for the playlist's tracks file
     """
-    # Handle both dict and dataclass access patterns
-    playlist_name = playlist["name"] if isinstance(playlist, dict) else playlist.name
-    playlist_id = playlist["id"] if isinstance(playlist, dict) else playlist.id
-
-    escaped_playlist_name = playlist_name.replace("/", "\u2215")
+    escaped_playlist_name = playlist.name.replace("/", "\u2215")
     output_manager = SpotifySnapshotOutputManager.get_instance()
-    return output_manager.playlists_dir_path / Path(
-        f"{escaped_playlist_name} ({playlist_id}).tsv"
+    return output_manager.get_playlist_dir_path(playlist.id) / Path(
+        f"{escaped_playlist_name} ({playlist.id}).tsv"
     )
 
 
-def write_liked_songs_to_git_repo(sp_client: spotipy.Spotify) -> None:
+@profiler.phase("backup_liked_songs")
+def write_liked_songs_to_git_repo(
+    sp_client: spotipy.Spotify,
+    full_sync_interval_hours: float = DEFAULT_FULL_SYNC_INTERVAL_HOURS,
+) -> None:
     logger = get_colorized_logger()
-    liked_songs = get_liked_songs(sp_client)
+    logger.info("<blue>Getting liked songs</blue>...")
     output_manager = SpotifySnapshotOutputManager.get_instance()
     dest_file = output_manager.liked_songs_path
-    outputfileutils.write_to_file(
-        data=liked_songs,
-        sort_lambda=lambda item: (item["added_at"], item["track"]["name"]),
+    row_count = _backup_saved_collection(
+        collection_name="liked songs",
+        fetch_page=lambda offset: _to_record_page(
+            sp_client.current_user_saved_tracks(
+                SAVED_TRACKS_REQUEST_LIMIT, offset, market=MARKET
+            ),
+            TrackRecord.from_api_item,
+        ),
+        page_size=SAVED_TRACKS_REQUEST_LIMIT,
+        tsv_path=dest_file,
+        record_type=TrackRecord,
         header_row=outputfileutils.TRACK_HEADER_ROW,
-        item_to_row_lambda=outputfileutils.track_to_row,
-        output_filename=dest_file,
+        record_to_row=outputfileutils.track_to_row,
+        exporting=parquet_exporter.exporting_liked_songs(),
+        full_sync_interval_hours=full_sync_interval_hours,
     )
     logger.info(
-        f"<green>Wrote</green> {len(liked_songs)} <green>liked songs to</green> {dest_file}"
+        f"<green>Wrote</green> {row_count} <green>liked songs to</green> {dest_file}"
     )
 
 
-def write_saved_albums_to_git_repo(sp_client: spotipy.Spotify) -> None:
+@profiler.phase("backup_saved_albums")
+def write_saved_albums_to_git_repo(
+    sp_client: spotipy.Spotify,
+    full_sync_interval_hours: float = DEFAULT_FULL_SYNC_INTERVAL_HOURS,
+) -> None:
     logger = get_colorized_logger()
-    saved_albums = get_saved_albums(sp_client)
+    logger.info("<green>Fetching saved albums</green>...")
     output_manager = SpotifySnapshotOutputManager.get_instance()
     dest_file = output_manager.albums_path
-    outputfileutils.write_to_file(
-        data=saved_albums,
-        sort_lambda=lambda item: (item["added_at"], item["album"]["name"]),
+    row_count = _backup_saved_collection(
+        collection_name="saved albums",
+        fetch_page=lambda offset: _to_record_page(
+            sp_client.current_user_saved_albums(
+                SAVED_ALBUMS_REQUEST_LIMIT, offset, market=MARKET
+            ),
+            AlbumRecord.from_api_item,
+        ),
+        page_size=SAVED_ALBUMS_REQUEST_LIMIT,
+        tsv_path=dest_file,
+        record_type=AlbumRecord,
         header_row=outputfileutils.ALBUM_HEADER_ROW,
-        item_to_row_lambda=outputfileutils.album_to_row,
-        output_filename=dest_file,
+        record_to_row=outputfileutils.album_to_row,
+        exporting=parquet_exporter.exporting_saved_albums(),
+        full_sync_interval_hours=full_sync_interval_hours,
     )
     logger.info(
-        f"<green>Wrote</green> {len(saved_albums)} <green>albums to</green> {dest_file}"
+        f"<green>Wrote</green> {row_count} <green>albums to</green> {dest_file}"
     )
 
 
-def write_playlists_to_git_repo(sp_client: spotipy.Spotify) -> None:
+def _backup_playlist_tracks(
+    sp_client: spotipy.Spotify,
+    playlist: PlaylistRecord,
+    playlist_tracks_file: Path,
+    checkpoints: CheckpointStore | None = None,
+) -> bool:
+    """
+    Fetches the tracks on a playlist and writes them to its tracks file as they
+    arrive. Safe to run from several threads at once, since each playlist has its
+    own file.
+
+    Returns:
+        False if the playlist was empty (and no file was written), True otherwise
+    """
+    with profiler.phase("backup_playlist_tracks", playlist_id=playlist.id) as details:
+        playlist_tracks = get_tracks_from_playlist(sp_client, playlist, checkpoints)
+        first_track = next(playlist_tracks, None)
+        if first_track is None:
+            details["tracks"] = 0
+            return False
+        with parquet_exporter.exporting_playlist_tracks(playlist.id) as export_track:
+            details["tracks"] = outputfileutils.write_items_to_file(
+                items=itertools.chain([first_track], playlist_tracks),
+                sort_lambda=lambda track: (track.added_at, track.name),
+                header_row=outputfileutils.TRACK_IN_PLAYLIST_HEADER_ROW,
+                item_to_row_lambda=outputfileutils.playlist_track_to_row,
+                # Note that the playlist name needs to have slashes replaced with
+                # a Unicode character that looks just like a slash
+                output_filename=playlist_tracks_file,
+                # A track that's on the playlist more than once is written once
+                id_lambda=lambda track: track.id,
+                on_item_written=export_track,
+            )
+    return True
+
+
+def remove_stale_playlist_files(
+    previous_manifest: PlaylistManifest, manifest: PlaylistManifest, base_dir: Path
+) -> None:
+    """
+    Deletes the tracks files of playlists that have been deleted, renamed (since the
+    file name has the playlist's name in it) or emptied since previous_manifest.
+    """
+    logger = get_colorized_logger()
+    playlists_dir_path = SpotifySnapshotOutputManager.get_instance().playlists_dir_path
+    current_files = {entry.file for entry in manifest.entries.values()}
+    for entry in previous_manifest.entries.values():
+        if entry.file is None or entry.file in current_files:
+            continue
+        stale_file = base_dir / entry.file
+        if stale_file.exists():
+            logger.info(f"<red>Deleting <bold>{stale_file}</bold></red>")
+            stale_file.unlink()
+            outputfileutils.written_files.add(stale_file)
+            content_hashes.remove(stale_file)
+            # Don't leave empty shard directories behind
+            if stale_file.parent != playlists_dir_path and not any(
+                stale_file.parent.iterdir()
+            ):
+                stale_file.parent.rmdir()
+
+
+def _needs_parquet_export(entry: PlaylistManifestEntry, playlist_id: str) -> bool:
+    """
+    Whether a playlist that's already backed up has to be fetched again anyway, so
+    its tracks can be exported to Parquet, like when the export's just been enabled.
+    Its TSV file won't do, since that doesn't keep the artists' names apart.
+    """
+    # Empty playlists don't have anything to export
+    return entry.file is not None and parquet_exporter.is_playlist_missing(playlist_id)
+
+
+def write_playlists_to_git_repo(
+    sp_client: spotipy.Spotify, max_workers: int = DEFAULT_PLAYLIST_FETCH_WORKERS
+) -> None:
     """
-    Extracts a list of all playlists the user owns or is subscribed to, and writes them to a file. Then, for each playlist,
-    it fetches all the tracks on the playlist and writes them to a separate file.
+    Extracts a list of all playlists the user owns or is subscribed to, and writes
+    them to a file. Then, for each playlist, it fetches all the tracks on the
+    playlist and writes them to a separate file. Playlists that are unchanged since
+    the last backup (according to their snapshot_id) are skipped, and up to
+    max_workers playlists are fetched at once.
+
+    Progress is checkpointed as playlists are written, so if any playlist can't be
+    fetched, the rest are still backed up and a rerun only fetches the ones that
+    failed.
+
+    Raises:
+        IncompleteFetchError: If any playlist couldn't be fetched
     """
     logger = get_colorized_logger()
     playlists = get_playlists(sp_client)
@@ -409,34 +889,118 @@ def write_playlists_to_git_repo(sp_client: spotipy.Spotify) -> None:
     playlists_file = output_manager.playlists_index_path
     outputfileutils.write_to_file(
         data=playlists,
-        sort_lambda=lambda item: item["id"],
+        sort_lambda=lambda playlist: playlist.id,
         header_row=outputfileutils.PLAYLIST_HEADER_ROW,
         item_to_row_lambda=outputfileutils.playlist_to_row,
         output_filename=playlists_file,
     )
+    parquet_exporter.export_playlists(playlists.values())
+
+    # Playlists whose snapshot_id hasn't changed since the last run don't need to
+    # be fetched again, since their tracks file is already up to date
+    previous_manifest = PlaylistManifest.load(output_manager.playlists_manifest_path)
+    manifest = PlaylistManifest()
+    checkpoints = CheckpointStore.for_output_dir(output_manager.base_dir)
 
     # Keep track of skipped playlists
     skipped_playlists = []
     total_playlists_backed_up = 0
+    total_playlists_unchanged = 0
+    failed_playlists = []
 
-    # Snapshot the contents of each playlist too
+    playlists_to_fetch: list[tuple[PlaylistRecord, Path, str]] = []
     for playlist in playlists.values():
-        playlist_tracks = get_tracks_from_playlist(sp_client, playlist)
-        # If the playlist is empty, skip it and log a warning
-        if not playlist_tracks:
-            skipped_playlists.append(playlist["name"])
-            continue
         playlist_tracks_file = get_playlist_file_name(playlist)
-        outputfileutils.write_to_file(
-            data=playlist_tracks,
-            sort_lambda=lambda item: (item["added_at"], item["track"]["name"]),
-            header_row=outputfileutils.TRACK_IN_PLAYLIST_HEADER_ROW,
-            item_to_row_lambda=outputfileutils.playlist_track_to_row,
-            # Note that the playlist name needs to have slashes replaced with
-            # a Unicode character that looks just like a slash
-            output_filename=playlist_tracks_file,
+        relative_playlist_tracks_file = playlist_tracks_file.relative_to(
+            output_manager.base_dir
+        ).as_posix()
+        unchanged_entry = previous_manifest.get_unchanged_entry(
+            playlist_id=playlist.id,
+            snapshot_id=playlist.snapshot_id,
+            base_dir=output_manager.base_dir,
+            expected_file=relative_playlist_tracks_file,
+        )
+        if unchanged_entry is not None and not _needs_parquet_export(
+            unchanged_entry, playlist.id
+        ):
+            # Entries from older manifests don't have a name
+            manifest.entries[playlist.id] = replace(unchanged_entry, name=playlist.name)
+            if unchanged_entry.file is None:
+                skipped_playlists.append(playlist.name)
+            else:
+                total_playlists_unchanged += 1
+            continue
+        # An earlier run may have written this playlist before it failed
+        completed_entry = checkpoints.get_completed_playlist(
+            playlist_id=playlist.id,
+            snapshot_id=playlist.snapshot_id,
+            base_dir=output_manager.base_dir,
+            expected_file=relative_playlist_tracks_file,
+        )
+        if completed_entry is not None and not _needs_parquet_export(
+            completed_entry, playlist.id
+        ):
+            manifest.entries[playlist.id] = replace(completed_entry, name=playlist.name)
+            if completed_entry.file is None:
+                skipped_playlists.append(playlist.name)
+            else:
+                # Still has to be committed, even though it was written last run
+                outputfileutils.written_files.add(playlist_tracks_file)
+                total_playlists_backed_up += 1
+            continue
+        playlists_to_fetch.append(
+            (playlist, playlist_tracks_file, relative_playlist_tracks_file)
         )
-        total_playlists_backed_up += 1
+
+    # Snapshot the contents of each changed playlist too. All the workers share
+    # rate_limiter, so the total request rate stays the same however many there
+    # are. The pool just keeps requests in flight while others wait on responses
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="playlist-fetch"
+    ) as executor:
+        futures = {}
+        for playlist, tracks_file, relative_tracks_file in playlists_to_fetch:
+            future = executor.submit(
+                _backup_playlist_tracks, sp_client, playlist, tracks_file, checkpoints
+            )
+            futures[future] = (playlist, relative_tracks_file)
+        for future in as_completed(futures):
+            playlist, relative_playlist_tracks_file = futures[future]
+            try:
+                was_written = future.result()
+            except (IncompleteFetchError, requests.exceptions.ReadTimeout) as e:
+                logger.error(
+                    "<red>Failed to back up playlist</red>"
+                    f" <yellow><bold>{playlist.name}</bold></yellow><red>: {e!r}</red>"
+                )
+                failed_playlists.append(playlist.name)
+                continue
+            # If the playlist is empty, skip it and log a warning
+            if not was_written:
+                entry = PlaylistManifestEntry(
+                    snapshot_id=playlist.snapshot_id, file=None, name=playlist.name
+                )
+                skipped_playlists.append(playlist.name)
+            else:
+                entry = PlaylistManifestEntry(
+                    snapshot_id=playlist.snapshot_id,
+                    file=relative_playlist_tracks_file,
+                    name=playlist.name,
+                )
+                total_playlists_backed_up += 1
+            manifest.entries[playlist.id] = entry
+            checkpoints.mark_playlist_complete(playlist.id, entry)
+
+    if failed_playlists:
+        raise IncompleteFetchError(
+            f"Failed to back up {len(failed_playlists)} playlists:"
+            f" {', '.join(sorted(failed_playlists))}. Run the backup again to resume"
+        )
+
+    manifest.save(output_manager.playlists_manifest_path)
+    outputfileutils.written_files.add(output_manager.playlists_manifest_path)
+    remove_stale_playlist_files(previous_manifest, manifest, output_manager.base_dir)
+    parquet_exporter.remove_stale_playlist_partitions(manifest)
 
     # Print summary of skipped playlists with rich styling
     if skipped_playlists:
@@ -446,6 +1010,12 @@ def write_playlists_to_git_repo(sp_client: spotipy.Spotify) -> None:
         for playlist_name in sorted(skipped_playlists):
             logger.info(f"<red>  • {playlist_name}</red>")
 
+    if total_playlists_unchanged:
+        logger.info(
+            f"<yellow>Skipped {total_playlists_unchanged} playlists that are unchanged"
+            " since the last backup</yellow>"
+        )
+
     logger.info(
         f"<green>Successfully backed up</green> {total_playlists_backed_up} playlists"
     )
@@ -1,4 +1,7 @@
+import sys
+from collections.abc import Iterable, Mapping
 from dataclasses import dataclass
+from typing import Any, Generic, TypeVar
 
 
 @dataclass
@@ -87,7 +90,183 @@ class SpotifyPlaylistsResponse:
     total: int
 
 
-@dataclass
-class DeletedPlaylist:
+#####
+# Records
+#
+# Compact versions of the API objects above, holding only what ends up in the TSV
+# files. These are what the fetchers produce and the writers consume, since there
+# can be hundreds of thousands of them in memory at once: they use __slots__, keep
+# artists in a tuple, and intern strings that repeat across records (artist and
+# album names, user IDs).
+#####
+
+
+# How artists' names are joined together in TSV files
+ARTISTS_SEPARATOR = ", "
+
+
+def _intern_artists(artists: list[dict[str, Any]]) -> tuple[str, ...]:
+    return tuple(sys.intern(artist["name"]) for artist in artists)
+
+
+def _split_artists(artists: str, known: list[str] | None = None) -> tuple[str, ...]:
+    # Names with the separator in them (like "Earth, Wind & Fire") would be split
+    # too, so those are taken from known instead, as long as it still matches
+    if known is not None and ARTISTS_SEPARATOR.join(known) == artists:
+        return tuple(sys.intern(name) for name in known)
+    if not artists:
+        return ()
+    return tuple(sys.intern(name) for name in artists.split(ARTISTS_SEPARATOR))
+
+
+@dataclass(slots=True)
+class TrackRecord:
+    name: str
+    artists: tuple[str, ...]
+    album_name: str
+    added_at: str
+    # None for local files, which don't have a Spotify ID
+    id: str | None
+    # Only set for tracks on a playlist
+    added_by: str | None = None
+
+    @classmethod
+    def from_api_item(cls, item: dict[str, Any]) -> "TrackRecord | None":
+        """
+        Build a record straight from a saved track / playlist item, or return None if
+        the item has no track (which happens for tracks that have been taken down).
+        """
+        track = item["track"]
+        if track is None:
+            return None
+        added_by = None
+        if "added_by" in item:
+            added_by = sys.intern((item["added_by"] or {}).get("id") or "")
+        # When a track isn't playable in the user's market, the API swaps in one
+        # that is. Keep the ID of the track that was actually saved
+        linked_from = track.get("linked_from")
+        return cls(
+            name=track["name"],
+            artists=_intern_artists(track["artists"]),
+            album_name=sys.intern(track["album"]["name"]),
+            added_at=item["added_at"],
+            id=linked_from["id"] if linked_from else track["id"],
+            added_by=added_by,
+        )
+
+    @classmethod
+    def from_tsv_row(
+        cls, row: list[str], known_artists: Mapping[str, list[str]] | None = None
+    ) -> "TrackRecord":
+        """
+        Reads back a row of liked_songs.tsv. The artists' names are split where they
+        were joined, unless known_artists (from get_unsplittable_artists) has them,
+        and local files' empty IDs become None again, to match the records built
+        from the API.
+        """
+        name, artists, album_name, added_at, track_id = row
+        return cls(
+            name=name,
+            artists=_split_artists(artists, (known_artists or {}).get(track_id)),
+            album_name=sys.intern(album_name),
+            added_at=added_at,
+            id=track_id or None,
+        )
+
+    @classmethod
+    def from_playlist_tsv_row(cls, row: list[str]) -> "TrackRecord":
+        """Reads back a row of a playlist's tracks file, in the same way."""
+        name, artists, album_name, added_at, added_by, track_id = row
+        return cls(
+            name=name,
+            artists=_split_artists(artists),
+            album_name=sys.intern(album_name),
+            added_at=added_at,
+            id=track_id or None,
+            added_by=sys.intern(added_by),
+        )
+
+
+@dataclass(slots=True)
+class AlbumRecord:
+    name: str
+    artists: tuple[str, ...]
+    added_at: str
+    id: str
+
+    @classmethod
+    def from_api_item(cls, item: dict[str, Any]) -> "AlbumRecord | None":
+        album = item["album"]
+        if album is None:
+            return None
+        return cls(
+            name=album["name"],
+            artists=_intern_artists(album["artists"]),
+            added_at=item["added_at"],
+            id=album["id"],
+        )
+
+    @classmethod
+    def from_tsv_row(
+        cls, row: list[str], known_artists: Mapping[str, list[str]] | None = None
+    ) -> "AlbumRecord":
+        """Reads back a row of saved_albums.tsv, in the same way as TrackRecord."""
+        name, artists, added_at, album_id = row
+        return cls(
+            name=name,
+            artists=_split_artists(artists, (known_artists or {}).get(album_id)),
+            added_at=added_at,
+            id=album_id,
+        )
+
+
+@dataclass(slots=True)
+class PlaylistRecord:
     name: str
+    description: str
+    track_count: int
+    owner_id: str
+    collaborative: bool
     id: str
+    snapshot_id: str
+
+    @classmethod
+    def from_api_item(cls, playlist: dict[str, Any]) -> "PlaylistRecord":
+        return cls(
+            name=playlist["name"],
+            description=playlist["description"],
+            track_count=playlist["tracks"]["total"],
+            owner_id=sys.intern(playlist["owner"]["id"]),
+            collaborative=playlist["collaborative"],
+            id=playlist["id"],
+            snapshot_id=playlist["snapshot_id"],
+        )
+
+
+RecordT = TypeVar("RecordT", TrackRecord, AlbumRecord)
+
+
+def get_unsplittable_artists(
+    records: Iterable[TrackRecord | AlbumRecord],
+) -> dict[str, list[str]]:
+    """
+    The artists of each record with a name that has ARTISTS_SEPARATOR in it, by ID
+    (empty for a local file). Splitting their TSV column would give back the wrong
+    names, so these are kept to pass to from_tsv_row as known_artists.
+    """
+    return {
+        record.id or "": list(record.artists)
+        for record in records
+        if any(ARTISTS_SEPARATOR in name for name in record.artists)
+    }
+
+
+@dataclass(slots=True)
+class RecordPage(Generic[RecordT]):
+    """A page of API results, with its items already turned into records."""
+
+    records: list[RecordT]
+    # Raw items that couldn't be turned into records, kept so they can be logged
+    skipped_items: list[dict[str, Any]]
+    next: str | None
+    total: int
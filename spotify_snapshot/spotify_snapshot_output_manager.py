@@ -1,32 +1,60 @@
+import hashlib
 from pathlib import Path
 from typing import Optional
 
 from spotify_snapshot.logging import get_colorized_logger
 
-
 logger = get_colorized_logger()
 
+# Sharded playlists are split between 16 ** 2 = 256 subdirectories
+PLAYLIST_SHARD_LENGTH = 2
+
+
+def get_playlist_shard(playlist_id: str) -> str:
+    """
+    The subdirectory a playlist's tracks file goes in, in the sharded layout. This
+    hashes the ID rather than using the start of it, since IDs differ in case and
+    not every filesystem does.
+    """
+    return hashlib.sha1(playlist_id.encode("utf-8")).hexdigest()[:PLAYLIST_SHARD_LENGTH]
+
 
 class SpotifySnapshotOutputManager:
     _instance: Optional["SpotifySnapshotOutputManager"] = None
 
-    def __init__(self, base_dir: Path | str = Path(".")):
+    def __init__(
+        self,
+        base_dir: Path | str = Path("."),
+        playlists_layout: str = "flat",
+        create_output_dirs: bool = True,
+    ):
         if SpotifySnapshotOutputManager._instance is not None:
             raise RuntimeError(
                 "Use SpotifySnapshotOutputManager.initialize() or get_instance()"
             )
         logger.info(
-            f"<blue>Initializing SpotifySnapshotOutputManager with base dir</blue> <green><bold>{base_dir}</bold></green>"
+            "<blue>Initializing SpotifySnapshotOutputManager with base dir</blue>"
+            f" <green><bold>{base_dir}</bold></green>"
         )
         self.base_dir = Path(base_dir)
-        self.ensure_output_dirs()
+        self.playlists_layout = playlists_layout
+        if create_output_dirs:
+            self.ensure_output_dirs()
 
     @classmethod
     def initialize(
-        cls, base_dir: Path | str = Path(".")
+        cls,
+        base_dir: Path | str = Path("."),
+        playlists_layout: str = "flat",
+        create_output_dirs: bool = True,
     ) -> "SpotifySnapshotOutputManager":
+        """
+        Args:
+            create_output_dirs: Whether to create the output directories, which
+                commands that only read the repo don't need
+        """
         if cls._instance is None:
-            cls._instance = cls(base_dir)
+            cls._instance = cls(base_dir, playlists_layout, create_output_dirs)
         return cls._instance
 
     @classmethod
@@ -52,6 +80,11 @@ class SpotifySnapshotOutputManager:
         """Filename for playlists index file"""
         return "playlists.tsv"
 
+    @property
+    def playlists_manifest_filename(self) -> str:
+        """Filename for the manifest of playlist snapshot IDs"""
+        return "playlists_manifest.json"
+
     @property
     def liked_songs_path(self) -> Path:
         """Full path to liked songs file"""
@@ -67,20 +100,33 @@ class SpotifySnapshotOutputManager:
         """Full path to playlists index file"""
         return self.base_dir / self.playlists_index_filename
 
+    @property
+    def playlists_manifest_path(self) -> Path:
+        """Full path to the manifest of playlist snapshot IDs"""
+        return self.base_dir / self.playlists_manifest_filename
+
     @property
     def playlists_dir_path(self) -> Path:
         return self.base_dir / "playlists"
 
+    def get_playlist_dir_path(self, playlist_id: str) -> Path:
+        """Directory that a playlist's tracks file goes in, for the current layout"""
+        if self.playlists_layout == "sharded":
+            return self.playlists_dir_path / get_playlist_shard(playlist_id)
+        return self.playlists_dir_path
+
     def ensure_output_dirs(self) -> None:
         """Ensure all output directories exist"""
         if not self.base_dir.exists():
             logger.info(
-                f"<blue>Creating directory</blue> <green><bold>{self.base_dir}</bold></green>"
+                "<blue>Creating directory</blue>"
+                f" <green><bold>{self.base_dir}</bold></green>"
             )
             self.base_dir.mkdir(parents=True, exist_ok=True)
 
         if not self.playlists_dir_path.exists():
             logger.info(
-                f"<blue>Creating directory</blue> <green><bold>{self.playlists_dir_path}</bold></green>"
+                "<blue>Creating directory</blue>"
+                f" <green><bold>{self.playlists_dir_path}</bold></green>"
             )
             self.playlists_dir_path.mkdir(parents=True, exist_ok=True)
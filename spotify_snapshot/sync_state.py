@@ -0,0 +1,79 @@
+import json
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from spotify_snapshot.config import SpotifySnapshotConfig
+from spotify_snapshot.logging import get_colorized_logger
+
+logger = get_colorized_logger()
+
+
+@dataclass
+class CollectionSyncState:
+    # Total number of items in the collection according to the API
+    total: int
+    # Number of rows that were written to the collection's TSV file
+    row_count: int
+    # Unix timestamp of the last time every page of the collection was fetched
+    last_full_sync: float
+    # The artists of items that can't be split back out of the TSV file, by ID (see
+    # get_unsplittable_artists). None in sync states from before they were kept
+    artists: dict[str, list[str]] | None = None
+
+    def is_full_sync_due(self, full_sync_interval_hours: float) -> bool:
+        return time.time() - self.last_full_sync >= full_sync_interval_hours * 3600
+
+
+class SyncStateStore:
+    """
+    Remembers what each collection looked like the last time it was backed up on this
+    machine, which is what lets a collection be fetched incrementally. Collections are
+    keyed by the path of their TSV file, so test and prod repos don't clash.
+    """
+
+    def __init__(self, path: Path, states: dict[str, CollectionSyncState]):
+        self.path = path
+        self._states = states
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_default_path() -> Path:
+        return SpotifySnapshotConfig.get_cache_dir() / "sync_state.json"
+
+    @classmethod
+    def load(cls, path: Path | None = None) -> "SyncStateStore":
+        path = path or cls.get_default_path()
+        if not path.exists():
+            return cls(path, {})
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                states = {
+                    key: CollectionSyncState(**state)
+                    for key, state in json.load(f).items()
+                }
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(
+                f"<yellow>Could not read sync state at {path}, collections will be"
+                f" fully fetched: {e}</yellow>"
+            )
+            return cls(path, {})
+
+        return cls(path, states)
+
+    def get(self, tsv_path: Path) -> CollectionSyncState | None:
+        return self._states.get(str(tsv_path.resolve()))
+
+    def set(self, tsv_path: Path, state: CollectionSyncState) -> None:
+        """Record the state of a collection and write it to disk straight away."""
+        with self._lock:
+            self._states[str(tsv_path.resolve())] = state
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {key: asdict(state) for key, state in self._states.items()},
+                    f,
+                    indent=2,
+                )
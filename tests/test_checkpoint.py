@@ -0,0 +1,57 @@
+from spotify_snapshot.checkpoint import CheckpointStore
+from spotify_snapshot.spotify import get_saved_collection_checkpoint_key
+from spotify_snapshot.spotify_datatypes import RecordPage, TrackRecord
+
+
+def make_track(track_id: str, added_at: str) -> TrackRecord:
+    return TrackRecord(
+        name=track_id, artists=("A",), album_name="B", added_at=added_at, id=track_id
+    )
+
+
+def make_first_page(tracks: list[TrackRecord], total: int) -> RecordPage:
+    return RecordPage(records=tracks, skipped_items=[], next="next", total=total)
+
+
+def test_saved_collection_key_changes_when_total_does_not(tmp_path):
+    before = make_first_page(
+        [
+            make_track("T2", "2024-01-02T00:00:00Z"),
+            make_track("T1", "2024-01-01T00:00:00Z"),
+        ],
+        total=100,
+    )
+    # One song liked and another unliked, so the total is the same but every
+    # offset has moved
+    after = make_first_page(
+        [
+            make_track("T3", "2024-01-03T00:00:00Z"),
+            make_track("T2", "2024-01-02T00:00:00Z"),
+        ],
+        total=100,
+    )
+    before_key = get_saved_collection_checkpoint_key("liked_songs.tsv", before)
+    after_key = get_saved_collection_checkpoint_key("liked_songs.tsv", after)
+    assert before_key != after_key
+    assert before_key == get_saved_collection_checkpoint_key("liked_songs.tsv", before)
+
+    # So pages saved before the change aren't resumed from after it
+    checkpoints = CheckpointStore(tmp_path)
+    checkpoints.pages(before_key, TrackRecord).save(50, before)
+    assert checkpoints.pages(before_key, TrackRecord).load().keys() == {50}
+    assert checkpoints.pages(after_key, TrackRecord).load() == {}
+
+
+def test_pages_are_loaded_as_they_were_saved(tmp_path):
+    local_file = TrackRecord(
+        name="Local", artists=("A", "B"), album_name="", added_at="", id=None
+    )
+    page = RecordPage(
+        records=[make_track("T1", "2024-01-01T00:00:00Z"), local_file],
+        skipped_items=[{"track": None, "added_at": "2024-01-01T00:00:00Z"}],
+        next=None,
+        total=3,
+    )
+    checkpoint = CheckpointStore(tmp_path).pages("key", TrackRecord)
+    checkpoint.save(0, page)
+    assert checkpoint.load() == {0: page}
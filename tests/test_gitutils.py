@@ -0,0 +1,204 @@
+from pathlib import Path
+
+import git
+import pytest
+
+from spotify_snapshot import git_plumbing, gitutils, outputfileutils
+from spotify_snapshot.config import GIT_BACKENDS, SpotifySnapshotConfig
+from spotify_snapshot.gitutils import FileChange
+from spotify_snapshot.install import RUNNING_INSIDE_CRONTAB_ENV_VAR
+from spotify_snapshot.spotify_snapshot_output_manager import (
+    SpotifySnapshotOutputManager,
+)
+
+INITIAL_FILES = {
+    "liked_songs.tsv": "name\tid\nSong 1\tT1\n",
+    "playlists/A (P1).tsv": "name\tid\nSong 1\tT1\nSong 2\tT2\n",
+    "playlists/B (P2).tsv": "name\tid\nSong 3\tT3\n",
+}
+
+
+def make_repo(tmp_path: Path, monkeypatch, git_backend: str) -> git.Repo:
+    """
+    A snapshots repo with INITIAL_FILES written, but not committed, which
+    commit_files commits with git_backend.
+    """
+    repo_dir = tmp_path / "repo"
+    repo = git.Repo.init(repo_dir)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "Test")
+        config.set_value("user", "email", "test@example.com")
+        config.set_value("commit", "gpgsign", "false")
+
+    monkeypatch.setattr(gitutils, "_repo_instance", repo)
+    monkeypatch.setattr(
+        SpotifySnapshotConfig,
+        "load",
+        classmethod(lambda cls: cls(git_backend=git_backend)),
+    )
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv(RUNNING_INSIDE_CRONTAB_ENV_VAR, "1")
+    monkeypatch.setattr(SpotifySnapshotOutputManager, "_instance", None)
+    SpotifySnapshotOutputManager.initialize(repo_dir)
+    outputfileutils.written_files.clear()
+    for path, contents in INITIAL_FILES.items():
+        write_file(repo, path, contents)
+    return repo
+
+
+def write_file(repo: git.Repo, path: str, contents: str) -> None:
+    file_path = Path(repo.working_tree_dir) / path
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path.write_text(contents, encoding="utf-8")
+    outputfileutils.written_files.add(file_path)
+
+
+def delete_file(repo: git.Repo, path: str) -> None:
+    file_path = Path(repo.working_tree_dir) / path
+    file_path.unlink()
+    outputfileutils.written_files.add(file_path)
+
+
+def change_files(repo: git.Repo) -> None:
+    """Renames, deletes, adds (in a new nested directory) and modifies a file."""
+    delete_file(repo, "playlists/A (P1).tsv")
+    write_file(
+        repo, "playlists/A renamed (P1).tsv", INITIAL_FILES["playlists/A (P1).tsv"]
+    )
+    delete_file(repo, "playlists/B (P2).tsv")
+    write_file(repo, "playlists/ab/cd/C (P3).tsv", "name\tid\nSong 4\tT4\n")
+    write_file(repo, "liked_songs.tsv", "name\tid\nSong 1\tT1\nSong 5\tT5\n")
+
+
+def get_index_tree_hexsha(repo: git.Repo) -> str:
+    """The tree `git add -A` and `git commit` would have committed."""
+    repo.git.add(A=True)
+    return str(repo.git.write_tree())
+
+
+EXPECTED_CHANGES = [
+    FileChange(path="liked_songs.tsv", change_type="M", insertions=1, deletions=0),
+    FileChange(
+        path="playlists/A renamed (P1).tsv",
+        change_type="R",
+        insertions=0,
+        deletions=0,
+        old_path="playlists/A (P1).tsv",
+    ),
+    FileChange(path="playlists/B (P2).tsv", change_type="D", insertions=0, deletions=2),
+    FileChange(
+        path="playlists/ab/cd/C (P3).tsv", change_type="A", insertions=2, deletions=0
+    ),
+]
+
+
+def sort_changes(changes: list[FileChange]) -> list[FileChange]:
+    return sorted(changes, key=lambda change: change.path)
+
+
+def test_tree_and_staged_changesets_are_parsed_the_same(tmp_path, monkeypatch):
+    repo = make_repo(tmp_path, monkeypatch, "worktree")
+    repo.git.add(A=True)
+    repo.git.commit("-m", "Initial snapshot")
+    change_files(repo)
+
+    tree_hexsha, _ = git_plumbing.write_tree_from_files(
+        repo, outputfileutils.written_files.get_paths()
+    )
+    tree_changeset = gitutils.get_tree_changeset(repo, tree_hexsha)
+    repo.git.add(A=True)
+    staged_changeset = gitutils.get_staged_changeset(repo)
+
+    assert sort_changes(tree_changeset.files) == EXPECTED_CHANGES
+    assert sort_changes(staged_changeset.files) == EXPECTED_CHANGES
+    assert not tree_changeset.is_first_commit
+    assert not staged_changeset.is_first_commit
+
+
+def test_parse_diff_without_changes():
+    assert gitutils._parse_diff("") == []
+
+
+@pytest.mark.parametrize("git_backend", GIT_BACKENDS)
+def test_commit_files(tmp_path, monkeypatch, git_backend):
+    repo = make_repo(tmp_path, monkeypatch, git_backend)
+    assert gitutils.commit_files(is_test_mode=True, username="user")
+    first_commit = repo.head.commit
+    assert first_commit.message.startswith("Initial Spotify Snapshot - user")
+    assert {blob.path for blob in first_commit.tree.traverse()} >= set(INITIAL_FILES)
+
+    change_files(repo)
+    expected_tree_hexsha = get_index_tree_hexsha(repo)
+    # Back to just what was committed, like a backup run leaves the index
+    repo.git.reset()
+    assert gitutils.commit_files(is_test_mode=True, username="user")
+    second_commit = repo.head.commit
+    assert second_commit.parents == (first_commit,)
+    assert second_commit.tree.hexsha == expected_tree_hexsha
+    # The index and working tree match the new commit, with nothing left over
+    assert not repo.is_dirty(untracked_files=True)
+    assert outputfileutils.written_files.get_paths() == set()
+
+    # Writing a file again with the same contents doesn't make a commit
+    write_file(repo, "liked_songs.tsv", "name\tid\nSong 1\tT1\nSong 5\tT5\n")
+    assert not gitutils.commit_files(is_test_mode=True, username="user")
+    assert repo.head.commit == second_commit
+
+
+def test_write_tree_matches_git(tmp_path, monkeypatch):
+    repo = make_repo(tmp_path, monkeypatch, "plumbing")
+    tree_hexsha, changed_paths = git_plumbing.write_tree_from_files(
+        repo, outputfileutils.written_files.get_paths()
+    )
+    assert changed_paths == sorted(INITIAL_FILES)
+    assert tree_hexsha == get_index_tree_hexsha(repo)
+    repo.git.commit("-m", "Initial snapshot")
+    outputfileutils.written_files.clear()
+
+    change_files(repo)
+    tree_hexsha, changed_paths = git_plumbing.write_tree_from_files(
+        repo, outputfileutils.written_files.get_paths()
+    )
+    assert changed_paths == [
+        "liked_songs.tsv",
+        "playlists/A (P1).tsv",
+        "playlists/A renamed (P1).tsv",
+        "playlists/B (P2).tsv",
+        "playlists/ab/cd/C (P3).tsv",
+    ]
+    assert tree_hexsha == get_index_tree_hexsha(repo)
+
+
+def test_write_tree_without_changes_reuses_the_tree(tmp_path, monkeypatch):
+    repo = make_repo(tmp_path, monkeypatch, "plumbing")
+    repo.git.add(A=True)
+    repo.git.commit("-m", "Initial snapshot")
+
+    # Every file written again with the same contents
+    tree_hexsha, changed_paths = git_plumbing.write_tree_from_files(
+        repo, outputfileutils.written_files.get_paths()
+    )
+    assert changed_paths == []
+    assert tree_hexsha == repo.head.commit.tree.hexsha
+
+
+def test_write_tree_drops_directories_left_empty(tmp_path, monkeypatch):
+    repo = make_repo(tmp_path, monkeypatch, "plumbing")
+    repo.git.add(A=True)
+    repo.git.commit("-m", "Initial snapshot")
+    outputfileutils.written_files.clear()
+
+    delete_file(repo, "playlists/A (P1).tsv")
+    delete_file(repo, "playlists/B (P2).tsv")
+    tree_hexsha, _ = git_plumbing.write_tree_from_files(
+        repo, outputfileutils.written_files.get_paths()
+    )
+    assert tree_hexsha == get_index_tree_hexsha(repo)
+    assert repo.git.ls_tree("--name-only", tree_hexsha) == "liked_songs.tsv"
+
+    # Deleting everything leaves git's empty tree
+    delete_file(repo, "liked_songs.tsv")
+    tree_hexsha, _ = git_plumbing.write_tree_from_files(
+        repo, outputfileutils.written_files.get_paths()
+    )
+    assert tree_hexsha == git_plumbing.EMPTY_TREE_HEXSHA
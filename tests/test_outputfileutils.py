@@ -0,0 +1,74 @@
+import random
+
+from spotify_snapshot.outputfileutils import (
+    TRACK_HEADER_ROW,
+    read_tsv_rows,
+    track_to_row,
+    write_items_to_file,
+    write_to_file,
+)
+from spotify_snapshot.spotify_datatypes import TrackRecord
+
+
+def make_tracks(count: int) -> list[TrackRecord]:
+    """Tracks with plenty of duplicate IDs and sort keys, in a random order."""
+    rng = random.Random(0)
+    return [
+        TrackRecord(
+            name=f"Song {rng.randrange(5)}",
+            artists=("A",),
+            album_name="B",
+            added_at=f"2024-01-0{rng.randrange(1, 4)}T00:00:00Z",
+            id=rng.choice([f"T{rng.randrange(count // 3)}", None]),
+        )
+        for _ in range(count)
+    ]
+
+
+def write_tracks(tracks, path, **kwargs) -> int:
+    return write_items_to_file(
+        items=iter(tracks),
+        sort_lambda=lambda track: (track.added_at, track.name),
+        item_to_row_lambda=track_to_row,
+        header_row=TRACK_HEADER_ROW,
+        output_filename=path,
+        **kwargs,
+    )
+
+
+def test_sorting_on_disk_writes_the_same_file_as_in_memory(tmp_path):
+    tracks = make_tracks(100)
+    write_tracks(tracks, tmp_path / "in_memory.tsv")
+    write_tracks(tracks, tmp_path / "on_disk.tsv", max_items_in_memory=7)
+    on_disk = (tmp_path / "on_disk.tsv").read_bytes()
+    assert on_disk == (tmp_path / "in_memory.tsv").read_bytes()
+
+
+def test_items_with_the_same_id_are_written_like_a_dict_of_them(tmp_path):
+    tracks = make_tracks(100)
+    tracks_by_id = {}
+    for track in tracks:
+        tracks_by_id[track.id] = track
+    write_to_file(
+        data=tracks_by_id,
+        sort_lambda=lambda track: (track.added_at, track.name),
+        item_to_row_lambda=track_to_row,
+        header_row=TRACK_HEADER_ROW,
+        output_filename=tmp_path / "from_dict.tsv",
+    )
+
+    for max_items_in_memory in (1000, 7):
+        path = tmp_path / f"streamed-{max_items_in_memory}.tsv"
+        written_tracks = []
+        row_count = write_tracks(
+            tracks,
+            path,
+            id_lambda=lambda track: track.id,
+            on_item_written=written_tracks.append,
+            max_items_in_memory=max_items_in_memory,
+        )
+        assert path.read_bytes() == (tmp_path / "from_dict.tsv").read_bytes()
+        assert row_count == len(tracks_by_id)
+        assert [track_to_row(track) for track in written_tracks] == list(
+            read_tsv_rows(path)
+        )
@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import pytest
+
+from spotify_snapshot.outputfileutils import playlist_track_to_row, track_to_row
+from spotify_snapshot.parquet_export import LIKED_SONGS_DATASET, ParquetExporter
+from spotify_snapshot.spotify_datatypes import TrackRecord, get_unsplittable_artists
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+LIKED_SONG_ROW = ["Song", "Artist A, Artist B", "Album", "2024-01-01T00:00:00Z", "T1"]
+
+
+def read_artists(path: Path) -> list[list[str]]:
+    return pq.read_table(path)["artists"].to_pylist()
+
+
+def test_artists_of_tsv_records_are_split(tmp_path):
+    exporter = ParquetExporter()
+    exporter.enable(tmp_path)
+    playlist_row = [*LIKED_SONG_ROW[:-1], "user", LIKED_SONG_ROW[-1]]
+    liked_song = TrackRecord.from_tsv_row(LIKED_SONG_ROW)
+    playlist_track = TrackRecord.from_playlist_tsv_row(playlist_row)
+    # Still written back to the TSV files exactly as they were read
+    assert track_to_row(liked_song) == LIKED_SONG_ROW
+    assert playlist_track_to_row(playlist_track) == playlist_row
+
+    with exporter.exporting_liked_songs() as export_liked_song:
+        export_liked_song(liked_song)
+    with exporter.exporting_playlist_tracks("P1") as export_playlist_track:
+        export_playlist_track(playlist_track)
+
+    liked_songs_path = exporter._get_path(LIKED_SONGS_DATASET)
+    assert read_artists(liked_songs_path) == [["Artist A", "Artist B"]]
+    assert read_artists(exporter._get_playlist_path("P1")) == [["Artist A", "Artist B"]]
+
+
+def test_artists_with_the_separator_in_their_names_are_kept(tmp_path):
+    exporter = ParquetExporter()
+    exporter.enable(tmp_path)
+    from_api = TrackRecord(
+        name="Song",
+        artists=("Earth, Wind & Fire", "Artist B"),
+        album_name="Album",
+        added_at="2024-01-01T00:00:00Z",
+        id="T1",
+    )
+    row = track_to_row(from_api)
+    assert TrackRecord.from_tsv_row(row).artists == ("Earth", "Wind & Fire", "Artist B")
+    from_tsv = TrackRecord.from_tsv_row(row, get_unsplittable_artists([from_api]))
+    assert from_tsv == from_api
+
+    with exporter.exporting_liked_songs() as export_liked_song:
+        export_liked_song(from_tsv)
+
+    liked_songs_path = exporter._get_path(LIKED_SONGS_DATASET)
+    assert read_artists(liked_songs_path) == [["Earth, Wind & Fire", "Artist B"]]
+
+
+def test_file_is_left_alone_if_fetching_fails(tmp_path):
+    exporter = ParquetExporter()
+    exporter.enable(tmp_path)
+    liked_song = TrackRecord.from_tsv_row(LIKED_SONG_ROW)
+    with exporter.exporting_liked_songs() as export_liked_song:
+        export_liked_song(liked_song)
+
+    with pytest.raises(RuntimeError):
+        with exporter.exporting_liked_songs() as export_liked_song:
+            export_liked_song(liked_song)
+            export_liked_song(liked_song)
+            raise RuntimeError("Fetching failed")
+
+    liked_songs_path = exporter._get_path(LIKED_SONGS_DATASET)
+    assert pq.read_table(liked_songs_path).num_rows == 1
+    assert list(liked_songs_path.parent.iterdir()) == [liked_songs_path]
@@ -0,0 +1,87 @@
+from pathlib import Path
+
+from spotify_snapshot import outputfileutils
+from spotify_snapshot.playlist_layout import (
+    is_migration_needed,
+    migrate_playlists_layout,
+)
+from spotify_snapshot.playlist_manifest import PlaylistManifest, PlaylistManifestEntry
+from spotify_snapshot.spotify_snapshot_output_manager import (
+    SpotifySnapshotOutputManager,
+    get_playlist_shard,
+)
+
+PLAYLIST_IDS = ["P1", "P2", "P3"]
+
+
+def initialize_output_manager(
+    base_dir: Path, playlists_layout: str, monkeypatch
+) -> SpotifySnapshotOutputManager:
+    # The output manager is a singleton, but every test needs its own directory
+    monkeypatch.setattr(SpotifySnapshotOutputManager, "_instance", None)
+    return SpotifySnapshotOutputManager.initialize(base_dir, playlists_layout)
+
+
+def write_flat_playlists(output_manager: SpotifySnapshotOutputManager) -> None:
+    manifest = PlaylistManifest()
+    for playlist_id in PLAYLIST_IDS:
+        tracks_file = output_manager.playlists_dir_path / f"Name ({playlist_id}).tsv"
+        tracks_file.write_text(f"{playlist_id}\n", encoding="utf-8")
+        manifest.entries[playlist_id] = PlaylistManifestEntry(
+            snapshot_id="S1",
+            file=tracks_file.relative_to(output_manager.base_dir).as_posix(),
+            name="Name",
+        )
+    # An empty playlist, which has no file to move
+    manifest.entries["P4"] = PlaylistManifestEntry(
+        snapshot_id="S1", file=None, name="Empty"
+    )
+    manifest.save(output_manager.playlists_manifest_path)
+
+
+def get_tracks_files(output_manager: SpotifySnapshotOutputManager) -> list[str]:
+    return sorted(
+        path.relative_to(output_manager.base_dir).as_posix()
+        for path in output_manager.playlists_dir_path.rglob("*.tsv")
+    )
+
+
+def test_migrating_to_sharded_and_back(tmp_path, monkeypatch):
+    outputfileutils.written_files.clear()
+    flat = initialize_output_manager(tmp_path, "flat", monkeypatch)
+    write_flat_playlists(flat)
+    flat_files = get_tracks_files(flat)
+    assert not is_migration_needed(flat)
+
+    sharded = initialize_output_manager(tmp_path, "sharded", monkeypatch)
+    assert is_migration_needed(sharded)
+    assert migrate_playlists_layout(sharded) == len(PLAYLIST_IDS)
+    assert not is_migration_needed(sharded)
+    sharded_files = [
+        f"playlists/{get_playlist_shard(playlist_id)}/Name ({playlist_id}).tsv"
+        for playlist_id in PLAYLIST_IDS
+    ]
+    assert get_tracks_files(sharded) == sorted(sharded_files)
+    for playlist_id, sharded_file in zip(PLAYLIST_IDS, sharded_files):
+        assert (tmp_path / sharded_file).read_text() == f"{playlist_id}\n"
+
+    # The manifest points at the moved files, so nothing has to be fetched again
+    manifest = PlaylistManifest.load(sharded.playlists_manifest_path)
+    for playlist_id, sharded_file in zip(PLAYLIST_IDS, sharded_files):
+        assert manifest.get_unchanged_entry(
+            playlist_id, "S1", tmp_path, expected_file=sharded_file
+        )
+    assert manifest.entries["P4"].file is None
+    # Both sides of every move are committed, so git sees them as renames
+    assert outputfileutils.written_files.get_paths() == {
+        (tmp_path / path).absolute()
+        for path in [*flat_files, *sharded_files, "playlists_manifest.json"]
+    }
+
+    flat = initialize_output_manager(tmp_path, "flat", monkeypatch)
+    assert is_migration_needed(flat)
+    assert migrate_playlists_layout(flat) == len(PLAYLIST_IDS)
+    assert get_tracks_files(flat) == flat_files
+    # Without leaving empty shard directories behind
+    assert not any(path.is_dir() for path in flat.playlists_dir_path.iterdir())
+    outputfileutils.written_files.clear()
@@ -0,0 +1,59 @@
+from spotify_snapshot.playlist_manifest import PlaylistManifest, PlaylistManifestEntry
+
+
+def make_entry(name: str, snapshot_id: str = "S1") -> PlaylistManifestEntry:
+    return PlaylistManifestEntry(
+        snapshot_id=snapshot_id, file=f"playlists/{name}.tsv", name=name
+    )
+
+
+def test_changes_are_found_by_id():
+    previous = PlaylistManifest(
+        entries={
+            "P1": make_entry("Kept"),
+            "P2": make_entry("Deleted"),
+            "P3": make_entry("Old name"),
+            "P4": make_entry("Changed"),
+        }
+    )
+    manifest = PlaylistManifest(
+        entries={
+            "P1": make_entry("Kept"),
+            "P3": make_entry("New name"),
+            "P4": make_entry("Changed", snapshot_id="S2"),
+            # Same name as a deleted playlist, but a different one
+            "P5": make_entry("Deleted"),
+            "P6": make_entry("Created"),
+        }
+    )
+    changes = manifest.get_changes_since(previous)
+    assert changes.created == [make_entry("Created"), make_entry("Deleted")]
+    assert changes.deleted == [make_entry("Deleted")]
+    assert changes.renamed == [(make_entry("Old name"), make_entry("New name"))]
+
+
+def test_playlists_without_a_name_are_not_renamed():
+    # Like the entries read from the playlists index of an older snapshot, when
+    # it's missing
+    previous = PlaylistManifest(
+        entries={"P1": PlaylistManifestEntry(snapshot_id="", file=None, name="")}
+    )
+    manifest = PlaylistManifest(entries={"P1": make_entry("Playlist")})
+    changes = manifest.get_changes_since(previous)
+    assert (changes.created, changes.deleted, changes.renamed) == ([], [], [])
+
+
+def test_names_are_read_from_files_of_older_manifests(tmp_path):
+    manifest_path = tmp_path / "playlists_manifest.json"
+    manifest_path.write_text(
+        '{"version": 1, "playlists": {"P1": {"snapshot_id": "S1",'
+        ' "file": "playlists/AC\u2215DC (P1).tsv"}}}',
+        encoding="utf-8",
+    )
+    manifest = PlaylistManifest.load(manifest_path)
+    assert manifest.entries["P1"].name == "AC/DC"
+
+    renamed = PlaylistManifest(entries={"P1": make_entry("AC/DC live")})
+    assert renamed.get_changes_since(manifest).renamed == [
+        (manifest.entries["P1"], make_entry("AC/DC live"))
+    ]
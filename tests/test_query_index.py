@@ -0,0 +1,65 @@
+import csv
+from pathlib import Path
+
+import git
+
+from spotify_snapshot.outputfileutils import TRACK_HEADER_ROW
+from spotify_snapshot.query_index import (
+    ADDED_EVENT,
+    QueryIndex,
+    update_query_index_if_enabled,
+)
+from spotify_snapshot.spotify_snapshot_output_manager import (
+    SpotifySnapshotOutputManager,
+)
+
+
+def make_repo(path: Path, liked_track_ids: list[str]) -> git.Repo:
+    repo = git.Repo.init(path)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "Test")
+        config.set_value("user", "email", "test@example.com")
+        config.set_value("commit", "gpgsign", "false")
+    with open(path / "liked_songs.tsv", "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(TRACK_HEADER_ROW)
+        for track_id in liked_track_ids:
+            writer.writerow(
+                [f"Song {track_id}", "A", "B", "2024-01-01T00:00:00Z", track_id]
+            )
+    repo.git.add(A=True)
+    repo.git.commit("-q", "-m", "Snapshot")
+    return repo
+
+
+def test_history_is_rebuilt_when_its_cursor_does_not_exist(tmp_path):
+    SpotifySnapshotOutputManager.initialize(tmp_path / "old")
+    old_repo = make_repo(tmp_path / "old", ["T1"])
+    # History that doesn't have the commit the index was last updated to, like
+    # after it was rewritten and the old commits were pruned
+    new_repo = make_repo(tmp_path / "new", ["T2"])
+
+    index = QueryIndex.open(tmp_path / "index.sqlite3")
+    try:
+        index.update(old_repo)
+        index.update_history(old_repo)
+        assert index.history_cursor == old_repo.head.commit.hexsha
+
+        assert index.update(new_repo) == 1
+        assert index.update_history(new_repo) == 1
+        assert index.history_cursor == new_repo.head.commit.hexsha
+        assert index.get_item_history("T1") == []
+        assert [event.event for event in index.get_item_history("T2")] == [ADDED_EVENT]
+    finally:
+        index.close()
+
+
+def test_update_after_backup_does_not_raise_on_malformed_rows(tmp_path):
+    SpotifySnapshotOutputManager.initialize(tmp_path / "repo")
+    repo = make_repo(tmp_path / "repo", ["T1"])
+    QueryIndex.open(QueryIndex.get_path(tmp_path / "repo")).close()
+    with open(tmp_path / "repo" / "liked_songs.tsv", "a", newline="") as f:
+        f.write("Truncated row\n")
+    repo.git.commit("-q", "-am", "Snapshot")
+
+    update_query_index_if_enabled(repo, tmp_path / "repo")
@@ -0,0 +1,66 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import spotipy
+
+from spotify_snapshot.ratelimit import RateLimiter
+from spotify_snapshot.spotify import create_api_session
+
+
+class RateLimitOnceHandler(BaseHTTPRequestHandler):
+    """Responds to the first request with a 429 and to every other one with a user."""
+
+    request_count = 0
+
+    def do_GET(self) -> None:
+        type(self).request_count += 1
+        if type(self).request_count == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"id": "me", "display_name": "me"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def api_url():
+    RateLimitOnceHandler.request_count = 0
+    server = HTTPServer(("127.0.0.1", 0), RateLimitOnceHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_429_with_retry_after_reaches_rate_limiter(api_url, monkeypatch):
+    client = spotipy.Spotify(
+        auth="token", requests_session=create_api_session(http_cache_max_mb=0)
+    )
+    client.prefix = api_url
+    rate_limiter = RateLimiter()
+    retry_afters = []
+    record_rate_limited = rate_limiter.record_rate_limited
+
+    def recording_record_rate_limited(retry_after_sec: float) -> None:
+        retry_afters.append(retry_after_sec)
+        record_rate_limited(retry_after_sec)
+
+    monkeypatch.setattr(
+        rate_limiter, "record_rate_limited", recording_record_rate_limited
+    )
+
+    assert rate_limiter.call(client.current_user)["id"] == "me"
+    assert retry_afters == [0.0]
+    assert RateLimitOnceHandler.request_count == 2
@@ -0,0 +1,118 @@
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+from spotify_snapshot.outputfileutils import (
+    TRACK_HEADER_ROW,
+    track_to_row,
+    write_items_to_file,
+)
+from spotify_snapshot.exceptions import IncompleteFetchError
+from spotify_snapshot.spotify import (
+    _fetch_new_items_incrementally,
+    _fetch_paginated_tracks,
+)
+from spotify_snapshot.spotify_datatypes import (
+    RecordPage,
+    TrackRecord,
+    get_unsplittable_artists,
+)
+from spotify_snapshot.sync_state import CollectionSyncState
+
+
+def make_track(track_id: str | None, name: str, artists=("A",)) -> TrackRecord:
+    return TrackRecord(
+        name=name,
+        artists=artists,
+        album_name="B",
+        added_at="2024-01-01T00:00:00Z",
+        id=track_id,
+    )
+
+
+def fail_to_fetch_page(offset: int) -> RecordPage[TrackRecord]:
+    raise AssertionError(f"Fetched the page at offset {offset}")
+
+
+def fetch_backed_up_tracks(
+    tsv_path: Path, tracks: list[TrackRecord]
+) -> dict[str | None, TrackRecord] | None:
+    """
+    Backs tracks up to tsv_path, then fetches them incrementally with the API
+    returning exactly the same tracks on its first page, keeping the last record
+    with each ID like the writer does.
+    """
+    write_items_to_file(
+        items=tracks,
+        sort_lambda=lambda track: track.name,
+        item_to_row_lambda=track_to_row,
+        header_row=TRACK_HEADER_ROW,
+        output_filename=tsv_path,
+    )
+    records = _fetch_new_items_incrementally(
+        collection_name="liked songs",
+        initial_results=RecordPage(
+            records=tracks, skipped_items=[], next="next", total=len(tracks)
+        ),
+        fetch_page=fail_to_fetch_page,
+        page_size=len(tracks),
+        tsv_path=tsv_path,
+        record_from_row=TrackRecord.from_tsv_row,
+        sync_state=CollectionSyncState(
+            total=len(tracks),
+            row_count=len(tracks),
+            last_full_sync=time.time(),
+            artists=get_unsplittable_artists(tracks),
+        ),
+        full_sync_interval_hours=24,
+    )
+    if records is None:
+        return None
+    return {record.id: record for record in records}
+
+
+def test_local_files_already_backed_up_are_not_new(tmp_path):
+    tracks = [make_track(None, "Local file"), make_track("T1", "Song")]
+    records = fetch_backed_up_tracks(tmp_path / "liked_songs.tsv", tracks)
+    # Rather than None, which would mean fetching every page again
+    assert records == {None: tracks[0], "T1": tracks[1]}
+
+
+def test_artists_with_the_separator_in_their_names_are_read_back(tmp_path):
+    tracks = [
+        make_track("T1", "Song", artists=("Earth, Wind & Fire", "Artist B")),
+        make_track(None, "Local file", artists=("Crosby, Stills & Nash",)),
+        make_track("T2", "Other song", artists=("Artist A", "Artist B")),
+    ]
+    records = fetch_backed_up_tracks(tmp_path / "liked_songs.tsv", tracks)
+    assert records is not None
+    assert {track_id: record.artists for track_id, record in records.items()} == {
+        "T1": ("Earth, Wind & Fire", "Artist B"),
+        None: ("Crosby, Stills & Nash",),
+        "T2": ("Artist A", "Artist B"),
+    }
+
+
+def test_pages_that_failed_are_raised_after_the_rest_are_yielded(tmp_path):
+    tracks = [make_track(f"T{i}", f"Song {i}") for i in range(5)]
+
+    def fetch_page(offset: int) -> RecordPage[TrackRecord]:
+        if offset == 2:
+            raise requests.exceptions.ReadTimeout()
+        page = tracks[offset:][:2]
+        return RecordPage(
+            records=page,
+            skipped_items=[],
+            next=None,
+            total=len(tracks),
+        )
+
+    fetched_tracks = []
+    with pytest.raises(IncompleteFetchError):
+        for track in _fetch_paginated_tracks(
+            fetch_page(0), fetch_page, retry_delay=0, page_size=2
+        ):
+            fetched_tracks.append(track)
+    assert fetched_tracks == [tracks[0], tracks[1], tracks[4]]